@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Compares the list of dicts returned by ZFS.datasets() with the columnar
+# SnapshotTable for a single dataset with many snapshots.
+#
+#   python benchmarks/snapshot_table.py --count 1000000
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from zfsbackup.models.snapshot import SnapshotTable, \
+    find_incremental_base  # noqa: E402
+from zfsbackup.runner.zfs import ZFS  # noqa: E402
+
+
+def listing(count: int):
+    # what zfs list -H -p -o name,creation,createtxg,guid,written prints
+    lines = []
+    for i in range(count):
+        lines.append("tank/data@auto-%012dZ\t%d\t%d\t%d\t%d" % (
+            i, 1500000000 + i * 60, 1000 + i, random.getrandbits(64),
+            random.randrange(1 << 20)))
+    lines.append("")
+    return lines
+
+
+def measure(name: str, build):
+    # timed and traced separately, tracing slows allocations down a lot
+    gc.collect()
+    started = time.process_time()
+    result = build()
+    duration = time.process_time() - started
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    (size, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-28s %8.3fs cpu %10.1f MiB held %10.1f MiB peak" % (
+        name, duration, size / 2 ** 20, peak / 2 ** 20))
+    return result
+
+
+def timed(name: str, operations: int, func):
+    # func runs the given number of operations at once
+    started = time.process_time()
+    func()
+    print("%-28s %12.3f us per operation" % (
+        name, (time.process_time() - started) * 1e6 / operations))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+
+    lines = listing(args.count)
+    options = SnapshotTable.OPTIONS
+    zfs = ZFS()
+
+    print("%d snapshots" % args.count)
+    rows = measure("dicts (ZFS.datasets)",
+                   lambda: zfs._parse_list(lines, [], 0, options))
+    table = measure("SnapshotTable.parse",
+                    lambda: SnapshotTable.parse(lines)["tank/data"])
+    infos = measure("SnapshotInfo list",
+                    lambda: list([i for i in table]))
+
+    wanted = list([random.choice(table.names)
+                   for _ in range(args.lookups)])
+    names = measure("name list from dicts", lambda: list(
+        [r["name"].split("@", 1)[1] for r in rows]))
+    timed("membership in name list", 10,
+          lambda: [n in names for n in wanted[:10]])
+    timed("membership in table", len(wanted),
+          lambda: [n in table for n in wanted])
+
+    txg = 1000 + args.count // 2
+    timed("txg lookup by scan", 1, lambda: next(
+        i for (i, r) in enumerate(rows) if r["createtxg"] >= txg))
+    timed("txg lookup by bisect", args.lookups,
+          lambda: [table.bisect_txg(txg) for _ in range(args.lookups)])
+
+    destination = infos[:args.count // 2]
+    timed("incremental base, list", 1,
+          lambda: find_incremental_base(infos, destination))
+    timed("incremental base, table", 1,
+          lambda: find_incremental_base(table, destination))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Tuple, Union
+
+from zfsbackup.api import ConfigBuilder
+from zfsbackup.config import Config
+from zfsbackup.runner.simulation import SimulatedZFS
+from zfsbackup.runner.zfs import ZFS
+from zfsbackup.runner.zpool import ZPool
+
+
+class Loader(ZFS):
+    # answers the listings a SimulatedZFS loads its state from. Datasets
+    # map to their snapshots (name, guid) in creation order, names with
+    # a leading "#" are bookmarks.
+    def __init__(self, datasets: Dict[str, List[Tuple[str, int]]],
+                 host: str = None):
+        super().__init__(zfs="zfs", sudo="", really=False, host=host)
+        self._rows: List[Dict[str, Union[str, int]]] = []
+        self._snapshots: List[Dict[str, Union[str, int]]] = []
+        txg = 0
+        for (dataset, snapshots) in datasets.items():
+            self._rows.append({"name": dataset, "guid": len(self._rows) + 1,
+                               "createtxg": 1, "creation": 0, "used": 0,
+                               "referenced": 1024, "written": 0,
+                               "userrefs": "-"})
+            for (name, guid) in snapshots:
+                txg += 1
+                bookmark = name.startswith("#")
+                self._snapshots.append({
+                    "name": dataset + (name if bookmark else "@" + name),
+                    "guid": guid, "createtxg": txg,
+                    "creation": 1000000 + txg, "used": 0,
+                    "referenced": 1024, "written": 0,
+                    "userrefs": "-" if bookmark else 0})
+
+    def datasets(self, dataset: str = None, recurse=False,
+                 snapshot=False, options: List[str] = None,
+                 sort: str = None, sort_ascending=False,
+                 bookmark=False, parsable=False):
+        rows = self._snapshots if snapshot or bookmark else self._rows
+        found = list([r for r in rows
+                      if r["name"].split("@")[0].split("#")[0] == dataset
+                      or (recurse and r["name"].startswith(dataset + "/"))])
+        if not found and not any([r["name"] == dataset or
+                                  r["name"].startswith(dataset + "/")
+                                  for r in self._rows]):
+            return None
+        return list([{o: r.get(o, "-") for o in options} for r in found])
+
+    def diff_snapshots(self, dataset: str, lsnap: str, rsnap: str):
+        return True
+
+
+def fake_zfs(datasets: Dict[str, List[Tuple[str, int]]],
+             host: str = None) -> SimulatedZFS:
+    return SimulatedZFS(Loader(datasets, host=host))
+
+
+class Pool:
+    # a pool with its internal history, changed behind our back like an
+    # admin or a receive would. Only the last history_lines events are
+    # kept, like the fixed size history of a real pool.
+    def __init__(self, name: str, guid: int = 1, history_lines=1000):
+        self.name = name
+        self.guid = guid
+        self.history_lines = history_lines
+        self.txg = 0
+        self.history: List[str] = []
+        self.rows: Dict[str, Dict[str, Dict[str, int]]] = {}
+        self.create(name)
+
+    def _event(self, event: str, name: str, extra: str = ""):
+        self.txg += 1
+        self.history.append("2024-01-01.00:00:00 [txg:%d] %s %s (%d) %s"
+                            % (self.txg, event, name, self.txg, extra))
+        self.history = self.history[-self.history_lines:]
+
+    def _row(self) -> Dict[str, int]:
+        return {"guid": 1000 + self.txg, "createtxg": self.txg,
+                "creation": 1000000 + self.txg, "used": 0, "written": 0}
+
+    def create(self, dataset: str):
+        self._event("create", dataset)
+        self.rows[dataset] = {"": self._row()}
+
+    def snapshot(self, dataset: str, name: str):
+        self._event("snapshot", dataset + "@" + name)
+        self.rows[dataset][name] = self._row()
+
+    def destroy(self, dataset: str, name: str):
+        self._event("destroy", dataset + "@" + name)
+        del self.rows[dataset][name]
+
+    def rename(self, dataset: str, new: str):
+        self._event("rename", dataset, "-> " + new)
+        for old in list(self.rows):
+            if old == dataset or old.startswith(dataset + "/"):
+                self.rows[new + old[len(dataset):]] = self.rows.pop(old)
+
+    def promote(self, dataset: str):
+        self._event("promote", dataset)
+
+    def receive(self, dataset: str, name: str):
+        # an incremental receive goes through a temporary clone, the
+        # history names the clone only
+        clone = dataset + "/%recv"
+        self._event("receive", clone)
+        self._event("finish receiving", clone, "snap=" + name)
+        self._event("clone swap", clone,
+                    "parent=" + dataset.split("/")[-1])
+        self.rows[dataset][name] = self._row()
+        self._event("destroy", clone)
+
+
+class PoolZFS(ZFS):
+    # zfs list against a Pool, remembering what it was asked for
+    def __init__(self, pool: Pool):
+        super().__init__(zfs="zfs", sudo="", really=False)
+        self.pool = pool
+        self.listed: List[Tuple[str, bool]] = []
+
+    def datasets(self, dataset: str = None, recurse=False,
+                 snapshot=False, options: List[str] = None,
+                 sort: str = None, sort_ascending=False,
+                 bookmark=False, parsable=False):
+        self.listed.append((dataset, recurse))
+        if dataset not in self.pool.rows:
+            return None
+        found = []
+        for (name, rows) in sorted(self.pool.rows.items()):
+            if name != dataset and not (recurse and
+                                        name.startswith(dataset + "/")):
+                continue
+            for (snap, row) in rows.items():
+                if bool(snap) != snapshot:
+                    continue
+                row = dict(row, name=name + ("@" + snap if snap else ""))
+                found.append({o: row.get(o, "-") for o in options})
+        return found
+
+
+class PoolZPool(ZPool):
+    def __init__(self, pool: Pool):
+        super().__init__(zpool="zpool", sudo="", really=False)
+        self.pool = pool
+        self.scan: str = None
+
+    def guid(self, pool: str) -> int:
+        return self.pool.guid if pool == self.pool.name else None
+
+    def history(self, pool: str) -> List[str]:
+        return list(self.pool.history) if pool == self.pool.name else None
+
+    def scanning(self, pool: str) -> str:
+        return self.scan
+
+
+class Sandbox:
+    # a config with its cache and locks in a temporary directory
+    def __init__(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, "locks"))
+
+    def builder(self) -> ConfigBuilder:
+        return ConfigBuilder() \
+            .cache(os.path.join(self.dir, "cache.sqlite")) \
+            .locks(os.path.join(self.dir, "locks")) \
+            .events(os.path.join(self.dir, "events"))
+
+    def build(self, builder: ConfigBuilder, zfs: ZFS) -> Config:
+        cfg = builder.build(really=True, zfs=zfs)
+        with cfg.cache as cache:
+            cache.update_tables()
+        return cfg
+
+    def close(self):
+        shutil.rmtree(self.dir)
@@ -0,0 +1,60 @@
+import datetime
+import json
+import os
+import stat
+import unittest
+
+from zfsbackup.job.base import JobType
+
+from .fakes import Sandbox, fake_zfs
+
+
+# appends the event arguments to a log next to it
+EVENT = """#!/bin/sh
+python3 -c 'import json, os; print(json.dumps({k[10:].lower(): v
+    for (k, v) in os.environ.items() if k.startswith("ZFSBACKUP_")}))' \\
+    >> "$0.log"
+"""
+
+
+class ChainEventTest(unittest.TestCase):
+    def setUp(self):
+        self.sandbox = Sandbox()
+        events = os.path.join(self.sandbox.dir, "events")
+        os.mkdir(events)
+        self.event = os.path.join(events, "after_copy")
+        with open(self.event, "w") as f:
+            f.write(EVENT)
+        os.chmod(self.event, os.stat(self.event).st_mode | stat.S_IXUSR)
+
+    def tearDown(self):
+        self.sandbox.close()
+
+    def events(self):
+        with open(self.event + ".log") as f:
+            return list([json.loads(line) for line in f])
+
+    def test_after_copy_names_the_received_snapshot(self):
+        zfs = fake_zfs({"data/src": [("a", 1), ("b", 2), ("c", 3)],
+                        "data/h1": [("a", 1)],
+                        "data/h2": [("a", 1)]})
+        builder = self.sandbox.builder().job(
+            "chain", "x", source={"pool": "data", "dataset": "src"},
+            hop=[{"pool": "data", "dataset": "h1"},
+                 {"pool": "data", "dataset": "h2"}],
+            incremental=True)
+        cfg = self.sandbox.build(builder, zfs)
+        self.addCleanup(cfg.close)
+        job = next(cfg.list_jobs(JobType.chain, ["x"]))
+        job.run(now=datetime.datetime.utcnow())
+
+        events = sorted(self.events(), key=lambda e: e["destination"])
+        self.assertEqual(
+            list([(e["source"], e["source_snapshot"], e["destination"],
+                   e["destination_snapshot"]) for e in events]),
+            [("data/src", "c", "data/h1", "c"),
+             ("data/h1", "c", "data/h2", "c")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import datetime
+import unittest
+from unittest import mock
+
+from zfsbackup.job.base import JobType
+
+from .fakes import Sandbox, fake_zfs
+
+
+class RecursiveBookmarkTest(unittest.TestCase):
+    def setUp(self):
+        self.sandbox = Sandbox()
+        self.zfs = fake_zfs({"data/src": [("#old", 1), ("#new", 2)],
+                             "data/src/a": [("#old", 3), ("#new", 4)],
+                             "data/src/b": [("#new", 5)]})
+        builder = self.sandbox.builder().job(
+            "clean", "x", target={"pool": "data", "dataset": "src"},
+            keep={"days": 7}, recurse={"workers": 2})
+        self.cfg = self.sandbox.build(builder, self.zfs)
+        self.addCleanup(self.cfg.close)
+        with self.cfg.cache as cache:
+            for dataset in ("data/src", "data/src/a", "data/src/b"):
+                # only the latest bookmark per destination is needed
+                for bookmark in ("old", "new"):
+                    cache.bookmark_add(dataset, bookmark, "data/dst")
+
+    def tearDown(self):
+        self.sandbox.close()
+
+    def bookmarks(self):
+        return sorted([b["name"] for b in self.zfs.datasets(
+            dataset="data/src", recurse=True, bookmark=True,
+            options=["name"])])
+
+    def test_listed_once(self):
+        job = next(self.cfg.list_jobs(JobType.clean, ["x"]))
+        with mock.patch.object(self.zfs, "datasets",
+                               wraps=self.zfs.datasets) as datasets:
+            job.run(now=datetime.datetime.utcnow())
+        listings = list([c.kwargs for c in datasets.call_args_list
+                         if c.kwargs.get("bookmark")])
+        self.assertEqual(len(listings), 1)
+        self.assertEqual(listings[0]["dataset"], "data/src")
+        self.assertTrue(listings[0]["recurse"])
+
+        self.assertEqual(self.bookmarks(), ["data/src#new", "data/src/a#new",
+                                            "data/src/b#new"])
+        with self.cfg.cache as cache:
+            for dataset in ("data/src", "data/src/a", "data/src/b"):
+                self.assertEqual(cache.bookmarks_unneeded(dataset), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from zfsbackup.api import ConfigBuilder
+from zfsbackup.helpers import ConfigError
+
+
+class ConfigErrorTest(unittest.TestCase):
+    def test_job(self):
+        builder = ConfigBuilder().job("copy", "x",
+                                      source={"pool": "data",
+                                              "dataset": "src"})
+        with self.assertRaisesRegex(ConfigError,
+                                    "copy.x in <api>: .*'destination'"):
+            builder.build()
+
+    def test_exclusive_options(self):
+        builder = ConfigBuilder().job(
+            "copy", "x", source={"pool": "data", "dataset": "src"},
+            destination={"pool": "data", "dataset": "dst"},
+            parallel=True, replicate=True)
+        with self.assertRaisesRegex(ConfigError, "mutually exclusive"):
+            builder.build()
+
+    def test_transport(self):
+        for (transport, error) in (
+                ({"type": "carrier-pigeon"}, "unknown transport"),
+                ({"type": "ssh"}, "'host'"),
+                ({"type": "ssh", "host": "b", "compress": "rar"},
+                 "unknown compression"),
+                ({"type": "command"}, "missing receive command")):
+            builder = ConfigBuilder().job(
+                "copy", "x", source={"pool": "data", "dataset": "src"},
+                destination={"pool": "data", "dataset": "dst",
+                             "transport": transport})
+            with self.assertRaisesRegex(ConfigError, error):
+                builder.build()
+
+    def test_protection(self):
+        with self.assertRaisesRegex(ConfigError, "Unknown protection"):
+            ConfigBuilder().protection("nothing").build()
+
+    def test_jobset(self):
+        builder = ConfigBuilder().jobset("nightly", ["copy.missing"])
+        with self.assertRaisesRegex(ConfigError, "Undefined Job"):
+            builder.build()
+
+    def test_retry(self):
+        with self.assertRaisesRegex(ConfigError, "Invalid <retry>"):
+            ConfigBuilder().retry(delay="forever").build()
+
+
+if __name__ == "__main__":
+    unittest.main()
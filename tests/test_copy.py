@@ -0,0 +1,151 @@
+import datetime
+import unittest
+
+from zfsbackup.job.base import JobType
+from zfsbackup.models.snapshot import SnapshotInfo, SnapshotTable, \
+    find_incremental_base
+
+from .fakes import Sandbox, fake_zfs
+
+
+def infos(dataset, snapshots):
+    return list([SnapshotInfo(dataset, name.lstrip("#"), guid, txg,
+                              bookmark=name.startswith("#"))
+                 for (txg, (name, guid)) in enumerate(snapshots, 1)])
+
+
+def table(dataset, snapshots):
+    result = SnapshotTable(dataset)
+    for (txg, (name, guid)) in enumerate(snapshots, 1):
+        result.append(name, createtxg=txg, guid=guid)
+    return result
+
+
+class FindIncrementalBaseTest(unittest.TestCase):
+    def check(self, source, destination):
+        # lists and tables have to agree
+        for make in (infos, table):
+            if make is table and any([n.startswith("#")
+                                      for (n, _) in source]):
+                continue
+            yield find_incremental_base(make("data/src", source),
+                                        infos("data/dst", destination))
+
+    def test_renamed(self):
+        for base in self.check([("a", 1), ("b", 2)], [("renamed", 1)]):
+            self.assertEqual(base.source.name, "a")
+            self.assertEqual(base.destination.name, "renamed")
+            self.assertEqual(base.newer, [])
+
+    def test_same_name_other_guid(self):
+        for base in self.check([("a", 1), ("b", 2)], [("b", 9)]):
+            self.assertIsNone(base)
+
+    def test_newest_common(self):
+        for base in self.check([("a", 1), ("b", 2), ("c", 3)],
+                               [("a", 1), ("b", 2), ("x", 8)]):
+            self.assertEqual(base.source.name, "b")
+            self.assertEqual([s.name for s in base.newer], ["x"])
+
+    def test_bookmark(self):
+        for base in self.check([("#a", 1), ("b", 2)], [("a", 1)]):
+            self.assertTrue(base.source.bookmark)
+            self.assertEqual(base.reference, "data/src#a")
+
+    def test_snapshot_preferred_over_bookmark(self):
+        for base in self.check([("a", 1), ("#a", 1), ("b", 2)], [("a", 1)]):
+            self.assertFalse(base.source.bookmark)
+            self.assertEqual(base.reference, "a")
+
+
+class CopyBaseTest(unittest.TestCase):
+    def setUp(self):
+        self.sandbox = Sandbox()
+
+    def tearDown(self):
+        self.sandbox.close()
+
+    def job(self, datasets, rollback_base=False, bookmark=False):
+        self.zfs = fake_zfs(datasets)
+        builder = self.sandbox.builder().job(
+            "copy", "x", source={"pool": "data", "dataset": "src"},
+            destination={"pool": "data", "dataset": "dst",
+                         "rollback_to_base": rollback_base},
+            incremental=True, bookmark=bookmark)
+        self.cfg = self.sandbox.build(builder, self.zfs)
+        self.addCleanup(self.cfg.close)
+        return next(self.cfg.list_jobs(JobType.copy, ["x"]))
+
+    def snapshots(self, dataset):
+        return list([(s["name"].split("@")[1], s["guid"])
+                     for s in self.zfs.datasets(
+                         dataset=dataset, snapshot=True,
+                         options=["name", "guid"], sort="createtxg",
+                         sort_ascending=True)])
+
+    def run_job(self, job):
+        job.run(now=datetime.datetime.utcnow())
+
+    def test_base_found_after_rename(self):
+        job = self.job({"data/src": [("a", 1), ("b", 2)],
+                        "data/dst": [("renamed", 1)]})
+        self.run_job(job)
+        self.assertEqual(self.snapshots("data/dst"),
+                         [("renamed", 1), ("b", 2)])
+
+    def test_diverged_without_rollback(self):
+        job = self.job({"data/src": [("a", 1), ("b", 2)],
+                        "data/dst": [("a", 1), ("local", 7)]})
+        with self.assertRaisesRegex(Exception, "diverged"):
+            self.run_job(job)
+        # nothing on the destination was touched
+        self.assertEqual(self.snapshots("data/dst"),
+                         [("a", 1), ("local", 7)])
+
+    def test_diverged_with_rollback(self):
+        job = self.job({"data/src": [("a", 1), ("b", 2)],
+                        "data/dst": [("a", 1), ("local", 7)]},
+                       rollback_base=True)
+        self.run_job(job)
+        self.assertEqual(self.snapshots("data/dst"), [("a", 1), ("b", 2)])
+
+    def test_no_common_guid(self):
+        # a full send into a destination holding snapshots fails
+        # instead of replacing them
+        job = self.job({"data/src": [("a", 1), ("b", 2)],
+                        "data/dst": [("b", 9)]})
+        with self.assertRaises(Exception):
+            self.run_job(job)
+        self.assertEqual(self.snapshots("data/dst"), [("b", 9)])
+
+    def test_up_to_date(self):
+        job = self.job({"data/src": [("a", 1), ("b", 2)],
+                        "data/dst": [("a", 1), ("b", 2)]})
+        self.run_job(job)
+        self.assertEqual(self.snapshots("data/dst"), [("a", 1), ("b", 2)])
+
+    def test_bookmark_base(self):
+        job = self.job({"data/src": [("#a", 1), ("b", 2)],
+                        "data/dst": [("a", 1)]}, bookmark=True)
+        self.run_job(job)
+        self.assertEqual(self.snapshots("data/dst"), [("a", 1), ("b", 2)])
+
+    def test_exists_per_host(self):
+        job = self.job({"data/src": [("a", 1)], "data/dst": []})
+        remote = fake_zfs({"data/dst": []}, host="backup.example.org")
+        self.assertTrue(job._check_dataset("data/src"))
+        # the same name on another host is asked again
+        self.assertFalse(job._check_dataset("data/src", zfs=remote))
+        self.assertTrue(job._check_dataset("data/dst", zfs=remote))
+
+    def test_full_copy(self):
+        job = self.job({"data/src": [("a", 1), ("b", 2)], "data/dst": []})
+        self.run_job(job)
+        self.assertEqual(self.snapshots("data/dst"), [("b", 2)])
+        with self.cfg.cache as cache:
+            self.assertEqual(cache.snapshots(), {"data/src": {"b": 1},
+                                                 "data/dst": {"b": 1}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import datetime
+import unittest
+from unittest import mock
+
+from zfsbackup.job.base import JobType
+
+from .fakes import Sandbox, fake_zfs
+
+
+class FanoutRollbackTest(unittest.TestCase):
+    def setUp(self):
+        self.sandbox = Sandbox()
+
+    def tearDown(self):
+        self.sandbox.close()
+
+    def snapshots(self, dataset):
+        return list([s["name"].split("@")[1] for s in self.zfs.datasets(
+            dataset=dataset, snapshot=True, options=["name"],
+            sort="createtxg", sort_ascending=True)])
+
+    def test_failed_rollback_skips_only_its_destination(self):
+        self.zfs = fake_zfs({"data/src": [("a", 1), ("b", 2)],
+                             "data/d1": [("a", 1), ("x", 8)],
+                             "data/d2": [("a", 1), ("y", 9)]})
+        builder = self.sandbox.builder().job(
+            "fanout", "x", source={"pool": "data", "dataset": "src"},
+            destination=[{"pool": "data", "dataset": d,
+                          "rollback_to_base": True} for d in ("d1", "d2")],
+            incremental=True)
+        cfg = self.sandbox.build(builder, self.zfs)
+        self.addCleanup(cfg.close)
+        job = next(cfg.list_jobs(JobType.fanout, ["x"]))
+
+        rollback = self.zfs.rollback
+
+        def refuse_d1(dataset, snapshot, *args, **kwargs):
+            if dataset == "data/d1":
+                return False
+            return rollback(dataset, snapshot, *args, **kwargs)
+        with mock.patch.object(self.zfs, "rollback", side_effect=refuse_d1):
+            with self.assertRaisesRegex(Exception, "1 destinations.*d1"):
+                job.run(now=datetime.datetime.utcnow())
+
+        self.assertEqual(self.snapshots("data/d1"), ["a", "x"])
+        self.assertEqual(self.snapshots("data/d2"), ["a", "b"])
+        with cfg.cache as cache:
+            keeps = cache.snapshots()
+        # the source snapshot is only kept for the destination it reached
+        self.assertEqual(keeps["data/src"]["b"], 1)
+        self.assertEqual(keeps["data/d2"]["b"], 1)
+        self.assertNotIn("data/d1", keeps)
+
+
+if __name__ == "__main__":
+    unittest.main()
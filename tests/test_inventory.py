@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from zfsbackup.cache import Cache
+from zfsbackup.inventory import Inventory
+
+from .fakes import Pool, PoolZFS, PoolZPool
+
+
+class InventoryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir, "cache.sqlite")
+        with Cache(self.file) as cache:
+            cache.update_tables()
+        self.pool = Pool("data")
+        self.pool.create("data/src")
+        self.pool.snapshot("data/src", "a")
+        self.pool.create("data/dst")
+        self.zfs = PoolZFS(self.pool)
+        self.zpool = PoolZPool(self.pool)
+        # the first lookup fills the inventory
+        self.assertEqual(self.names("data/src"), ["data/src@a"])
+        self.assertFull()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def names(self, dataset, recurse=False):
+        # every lookup is a new run, which asks zpool history again
+        self.zfs.listed = []
+        inventory = Inventory(self.zfs, self.zpool, lambda: Cache(self.file))
+        rows = inventory.snapshots(dataset, recurse=recurse)
+        return None if rows is None else list([r["name"] for r in rows])
+
+    def assertFull(self):
+        self.assertIn(("data", True), self.zfs.listed)
+
+    def assertListed(self, datasets):
+        self.assertEqual(sorted(set([d for (d, _) in self.zfs.listed])),
+                         datasets)
+        self.assertFalse(any([r for (_, r) in self.zfs.listed]))
+
+    def test_unchanged(self):
+        self.assertEqual(self.names("data", recurse=True), ["data/src@a"])
+        self.assertListed([])
+
+    def test_same_run(self):
+        inventory = Inventory(self.zfs, self.zpool, lambda: Cache(self.file))
+        inventory.snapshots("data/src")
+        self.pool.snapshot("data/src", "b")
+        self.zfs.listed = []
+        # nothing is asked twice within a run
+        self.assertEqual(list([r["name"] for r in
+                               inventory.snapshots("data/src")]),
+                         ["data/src@a"])
+        self.assertEqual(self.zfs.listed, [])
+        inventory.invalidate()
+        self.assertEqual(list([r["name"] for r in
+                               inventory.snapshots("data/src")]),
+                         ["data/src@a", "data/src@b"])
+
+    def test_external_snapshot(self):
+        self.pool.snapshot("data/src", "b")
+        self.assertEqual(self.names("data/src"),
+                         ["data/src@a", "data/src@b"])
+        self.assertListed(["data/src"])
+
+    def test_external_destroy(self):
+        self.pool.snapshot("data/src", "b")
+        self.pool.destroy("data/src", "a")
+        self.assertEqual(self.names("data/src"), ["data/src@b"])
+        self.assertListed(["data/src"])
+
+    def test_properties(self):
+        self.pool.snapshot("data/src", "b")
+        inventory = Inventory(self.zfs, self.zpool, lambda: Cache(self.file))
+        rows = inventory.snapshots("data/src",
+                                   options=["name", "guid", "createtxg"])
+        self.assertEqual(rows[-1], {
+            "name": "data/src@b",
+            "guid": self.pool.rows["data/src"]["b"]["guid"],
+            "createtxg": self.pool.txg})
+
+    def test_new_dataset(self):
+        self.pool.create("data/src/child")
+        self.pool.snapshot("data/src/child", "c")
+        self.assertEqual(self.names("data/src", recurse=True),
+                         ["data/src@a", "data/src/child@c"])
+        self.assertListed(["data/src/child"])
+
+    def test_missing_dataset(self):
+        self.assertIsNone(self.names("data/none"))
+        self.assertIsNone(self.names("other/src"))
+
+    def test_watermark_dropped_from_history(self):
+        self.pool.history_lines = 3
+        for i in range(5):
+            self.pool.snapshot("data/src", "s%d" % i)
+        self.assertEqual(len(self.names("data/src")), 6)
+        self.assertFull()
+
+    def test_history_at_its_limit(self):
+        # the watermark event is the oldest one left
+        self.pool.history_lines = 2
+        self.pool.history = self.pool.history[-1:]
+        self.pool.snapshot("data/src", "b")
+        self.assertEqual(len(self.names("data/src")), 2)
+        self.assertListed(["data/src"])
+
+    def test_pool_guid_changed(self):
+        self.pool.guid = 2
+        self.assertEqual(self.names("data/src"), ["data/src@a"])
+        self.assertFull()
+
+    def test_rename(self):
+        self.pool.rename("data/src", "data/moved")
+        self.assertIsNone(self.names("data/src"))
+        self.assertFull()
+        self.assertEqual(self.names("data/moved"), ["data/moved@a"])
+        self.assertListed([])
+
+    def test_promote(self):
+        self.pool.promote("data/dst")
+        self.names("data/src")
+        self.assertFull()
+
+    def test_receive(self):
+        # the events name data/dst/%recv, data/dst is what changed
+        self.pool.receive("data/dst", "r")
+        self.assertEqual(self.names("data/dst"), ["data/dst@r"])
+        self.assertListed(["data/dst"])
+
+    def test_receive_into_pool(self):
+        self.pool.receive("data", "r")
+        self.assertEqual(self.names("data"), ["data@r"])
+        self.assertListed(["data"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import io
+import json
+import logging
+import unittest
+from unittest import mock
+
+from zfsbackup.logs import LogPipeline
+
+
+class JSONPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.root = logging.getLogger()
+        self.handlers = list(self.root.handlers)
+        self.level = self.root.level
+        with mock.patch("sys.stderr", new_callable=io.StringIO) as stream:
+            self.stream = stream
+            self.pipeline = LogPipeline("INFO", fmt="json")
+
+    def tearDown(self):
+        self.pipeline.close()
+        self.root.handlers = self.handlers
+        self.root.setLevel(self.level)
+
+    def entries(self):
+        # close() flushes the queue through the background thread
+        self.pipeline.close()
+        return list([json.loads(line)
+                     for line in self.stream.getvalue().splitlines()])
+
+    def test_exception(self):
+        log = logging.getLogger("test")
+        try:
+            raise ValueError("broken")
+        except ValueError:
+            log.exception("Job %s failed", "x", extra={"job": "x"})
+        (entry,) = self.entries()
+        self.assertEqual(entry["message"], "Job x failed")
+        self.assertEqual(entry["job"], "x")
+        self.assertEqual(entry["level"], "ERROR")
+        self.assertIn("Traceback", entry["exception"])
+        self.assertIn("ValueError: broken", entry["exception"])
+
+    def test_plain(self):
+        logging.getLogger("test").info("Copied %d", 3, extra={"count": 3})
+        (entry,) = self.entries()
+        self.assertEqual(entry["message"], "Copied 3")
+        self.assertEqual(entry["count"], 3)
+        self.assertNotIn("exception", entry)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from zfsbackup.cache import Cache
+from zfsbackup.job.base import JobType
+from zfsbackup.models.snapshot import SnapshotInfo
+from zfsbackup.protection import CacheProtection, HoldProtection
+from zfsbackup.runner.zfs import ZFS
+
+from .fakes import Sandbox, fake_zfs
+
+
+class CacheProtectionTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir, "cache.sqlite")
+        with Cache(self.file) as cache:
+            cache.update_tables()
+        self.protection = CacheProtection(lambda: Cache(self.file), True)
+        self.local = ZFS(zfs="zfs", sudo="")
+        self.remote = ZFS(zfs="zfs", sudo="", host="backup.example.org")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def keeps(self):
+        with Cache(self.file) as cache:
+            return cache.snapshots()
+
+    def test_remote_datasets_are_keyed_by_host(self):
+        self.protection.protect(self.remote, "tank/backup", ["a"], "copy.x")
+        self.assertEqual(self.keeps(),
+                         {"backup.example.org:tank/backup": {"a": 1}})
+        # a local dataset of the same name is not protected by it
+        self.assertEqual(self.protection.protected(
+            self.local, "tank/backup", ["tank/backup"]),
+            {"tank/backup": set()})
+
+    def test_release_stays_on_its_side(self):
+        self.protection.protect(self.local, "tank/backup", ["a"], "copy.x")
+        self.protection.protect(self.remote, "tank/backup", ["a"], "copy.y")
+        self.protection.release(self.remote, "tank/backup", ["a"], "copy.y")
+        self.assertEqual(self.protection.protected(
+            self.local, "tank/backup", ["tank/backup"]),
+            {"tank/backup": set(["a"])})
+        self.assertEqual(self.protection.protected(
+            self.remote, "tank/backup", ["tank/backup"]),
+            {"tank/backup": set()})
+
+    def test_inherited_from_root(self):
+        self.protection.protect(self.local, "tank/backup", ["a"], "copy.x",
+                                recurse=True)
+        self.assertEqual(self.protection.protected(
+            self.local, "tank/backup", ["tank/backup", "tank/backup/x"]),
+            {"tank/backup": set(["a"]), "tank/backup/x": set(["a"])})
+
+    def test_not_really(self):
+        protection = CacheProtection(lambda: Cache(self.file), False)
+        protection.protect(self.local, "tank/backup", ["a"], "copy.x")
+        self.assertEqual(self.keeps(), {})
+
+    def test_keep_counts(self):
+        # the debug count comes from the statement itself, older sqlite
+        # versions without RETURNING only lose it from the log
+        for returning in (Cache.RETURNING, False):
+            with mock.patch.object(Cache, "RETURNING", returning), \
+                    Cache(self.file) as cache:
+                with self.assertLogs(cache._log, "DEBUG") as logs:
+                    cache.snapshot_keep_increase("tank", "a")
+                    cache.snapshot_keep_increase("tank", "a")
+                    cache.snapshot_keep_decrease("tank", "a")
+                self.assertEqual(cache.snapshot_keep("tank", "a"), 1)
+                cache.snapshot_keep_decrease("tank", "a")
+                cache.commit()
+            if returning:
+                self.assertIn("Decreased tank@a count to 1", logs.output[-1])
+
+
+class Holds(ZFS):
+    # zfs hold and release refusing the snapshots in refuse, and
+    # existing tags like zfs does
+    def __init__(self, refuse=(), tags=None):
+        super().__init__(zfs="zfs", sudo="", really=True)
+        self.refuse = set(refuse)
+        self.tags = tags if tags else {}
+
+    def _change(self, tag, snapshots, held):
+        if any([s in self.refuse or (tag in self.tags.get(s, set())) == held
+                for s in snapshots]):
+            return False
+        for s in snapshots:
+            if held:
+                self.tags.setdefault(s, set()).add(tag)
+            else:
+                self.tags.get(s, set()).discard(tag)
+        return True
+
+    def hold(self, tag, snapshots, recurse=False):
+        return self._change(tag, snapshots, True)
+
+    def release(self, tag, snapshots, recurse=False):
+        return self._change(tag, snapshots, False)
+
+    def holds(self, snapshots):
+        return {s: set(self.tags.get(s, set())) for s in snapshots}
+
+
+class HoldProtectionTest(unittest.TestCase):
+    def setUp(self):
+        self.protection = HoldProtection(True)
+        self.tag = HoldProtection.tag("copy.x")
+
+    def test_failed_holds_are_returned(self):
+        zfs = Holds(refuse=["tank/a@2"])
+        self.assertEqual(self.protection.protect(
+            zfs, "tank/a", ["1", "2", "3"], "copy.x"), ["2"])
+        self.assertEqual(zfs.holds(["tank/a@1", "tank/a@2", "tank/a@3"]),
+                         {"tank/a@1": set([self.tag]), "tank/a@2": set(),
+                          "tank/a@3": set([self.tag])})
+
+    def test_existing_hold(self):
+        zfs = Holds(tags={"tank/a@1": set([self.tag])})
+        self.assertEqual(self.protection.protect(
+            zfs, "tank/a", ["1", "2"], "copy.x"), [])
+        self.assertEqual(self.protection.release(
+            zfs, "tank/a", ["1", "2", "3"], "copy.x"), [])
+        self.assertEqual(zfs.holds(["tank/a@1", "tank/a@2"]),
+                         {"tank/a@1": set(), "tank/a@2": set()})
+
+    def test_failed_release(self):
+        zfs = Holds(tags={"tank/a@1": set([self.tag])}, refuse=["tank/a@1"])
+        self.assertEqual(self.protection.release(
+            zfs, "tank/a", ["1"], "copy.x"), ["1"])
+
+
+class FailedHoldCopyTest(unittest.TestCase):
+    def setUp(self):
+        self.sandbox = Sandbox()
+
+    def tearDown(self):
+        self.sandbox.close()
+
+    def test_base_stays_protected(self):
+        zfs = fake_zfs({"data/src": [("a", 1), ("b", 2)],
+                        "data/dst": [("a", 1)]})
+        builder = self.sandbox.builder().protection("holds").job(
+            "copy", "x", source={"pool": "data", "dataset": "src"},
+            destination={"pool": "data", "dataset": "dst"},
+            incremental=True)
+        cfg = self.sandbox.build(builder, zfs)
+        self.addCleanup(cfg.close)
+        job = next(cfg.list_jobs(JobType.copy, ["x"]))
+
+        def hold(tag, snapshots, recurse=False):
+            return "data/dst@b" not in snapshots
+        with mock.patch.object(zfs, "hold", side_effect=hold), \
+                mock.patch.object(zfs, "holds", return_value={}), \
+                mock.patch.object(zfs, "release",
+                                  return_value=True) as release:
+            with self.assertRaisesRegex(Exception, "data/dst@b"):
+                job.run(now=datetime.datetime.utcnow())
+        # the old base is still needed, its holds are kept
+        self.assertEqual(release.call_args_list, [])
+
+
+class ExpectedKeepsTest(unittest.TestCase):
+    def setUp(self):
+        self.sandbox = Sandbox()
+
+    def tearDown(self):
+        self.sandbox.close()
+
+    def test_remote_keys_match_protection(self):
+        builder = self.sandbox.builder().job(
+            "copy", "x", source={"pool": "data", "dataset": "src"},
+            destination={"pool": "tank", "dataset": "backup"},
+            incremental=True)
+        cfg = self.sandbox.build(builder, fake_zfs({"data/src": []}))
+        job = next(cfg.list_jobs(JobType.copy, ["x"]))
+        remote = ZFS(zfs="zfs", sudo="", host="backup.example.org")
+        ssnaps = {"data/src": [SnapshotInfo("data/src", "a", 1, 1)]}
+        dsnaps = {"tank/backup": [SnapshotInfo("tank/backup", "a", 1, 1)]}
+        self.assertEqual(
+            job._expected("data/src", "tank/backup", ssnaps, dsnaps,
+                          dzfs=remote),
+            [("data/src", "a"), ("backup.example.org:tank/backup", "a")])
+        cfg.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
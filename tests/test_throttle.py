@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import xml.etree.ElementTree as ET
+
+from zfsbackup.throttle import Throttle
+
+from .fakes import Pool, PoolZPool
+
+
+PSI = """some avg10=%.2f avg60=%.2f avg300=%.2f total=123456
+full avg10=50.00 avg60=50.00 avg300=50.00 total=654321
+"""
+
+
+class Clock:
+    # stands in for time.monotonic and time.sleep
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+        self.on_sleep = None
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+        if self.on_sleep:
+            self.on_sleep()
+
+
+class ThrottleTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.zpool = PoolZPool(Pool("data"))
+        self.clock = Clock()
+        for (name, func) in (("monotonic", self.clock.monotonic),
+                             ("sleep", self.clock.sleep)):
+            patcher = mock.patch("zfsbackup.throttle.time.%s" % name, func)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def psi(self, resource: str, avg10: float, avg60=0.0, avg300=0.0):
+        with open(os.path.join(self.dir, resource), "w") as f:
+            f.write(PSI % (avg10, avg60, avg300))
+
+    def throttle(self, really=True, **attrib) -> Throttle:
+        attrib = dict({"psi": self.dir, "scrub": "no"}, **attrib)
+        return Throttle(ET.Element("throttle", attrib), self.zpool, really)
+
+    def test_pressure(self):
+        self.psi("io", 12.5, 7.25, 3.0)
+        self.assertEqual(self.throttle().pressure("io"), 12.5)
+        self.assertEqual(self.throttle(window="avg60").pressure("io"), 7.25)
+        self.assertEqual(self.throttle(window="avg300").pressure("io"), 3.0)
+
+    def test_unknown_window(self):
+        with self.assertRaises(ValueError):
+            self.throttle(window="avg1")
+
+    def test_missing_psi(self):
+        # kernels without PSI never throttle
+        throttle = self.throttle(io="1")
+        self.assertIsNone(throttle.pressure("io"))
+        self.assertIsNone(throttle.busy())
+        with open(os.path.join(self.dir, "cpu"), "w") as f:
+            f.write("garbage\n")
+        self.assertIsNone(throttle.pressure("cpu"))
+
+    def test_thresholds(self):
+        self.psi("io", 20)
+        self.psi("cpu", 5)
+        self.assertIsNone(self.throttle(io="20", cpu="10").busy())
+        self.assertEqual(self.throttle(io="10", cpu="10").busy(),
+                         "io pressure 20.00% above 10.00%")
+        # only configured resources count
+        self.assertIsNone(self.throttle(cpu="10").busy())
+
+    def test_window(self):
+        self.psi("io", 50, 5, 1)
+        self.assertIsNotNone(self.throttle(io="10").busy())
+        self.assertIsNone(self.throttle(io="10", window="avg60").busy())
+
+    def test_wait_until_pressure_drops(self):
+        self.psi("io", 50)
+        throttle = self.throttle(io="10", interval="30s")
+        calls = []
+
+        def relieve():
+            calls.append(1)
+            if len(calls) == 3:
+                self.psi("io", 1)
+        self.clock.on_sleep = relieve
+        self.assertTrue(throttle.wait("send"))
+        self.assertEqual(self.clock.slept, [30, 30, 30])
+
+    def test_wait_gives_up(self):
+        self.psi("io", 50)
+        throttle = self.throttle(io="10", interval="40s",
+                                 **{"max-wait": "100s"})
+        self.assertFalse(throttle.wait("send"))
+        # the last nap is cut short to end at max-wait
+        self.assertEqual(self.clock.slept, [40, 40, 20])
+
+    def test_not_really(self):
+        self.psi("io", 50)
+        self.assertTrue(self.throttle(really=False, io="10").wait("send"))
+        self.assertEqual(self.clock.slept, [])
+
+    def test_scrub(self):
+        self.zpool.scan = "scrub"
+        with mock.patch.object(self.zpool, "scanning",
+                               wraps=self.zpool.scanning) as scanning:
+            throttle = self.throttle(scrub="yes", interval="30s")
+            self.assertEqual(throttle.busy(["data", "data"]),
+                             "scrub running on data")
+            # asked once per interval
+            self.zpool.scan = None
+            self.assertIsNotNone(throttle.busy(["data"]))
+            self.assertEqual(scanning.call_count, 1)
+            self.clock.now += 30
+            self.assertIsNone(throttle.busy(["data"]))
+            self.assertEqual(scanning.call_count, 2)
+
+    def test_scrub_ignored(self):
+        self.zpool.scan = "resilver"
+        self.assertIsNone(self.throttle(scrub="no").busy(["data"]))
+        self.assertEqual(self.throttle(scrub="yes").busy(["data"]),
+                         "resilver running on data")
+
+
+if __name__ == "__main__":
+    unittest.main()
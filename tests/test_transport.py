@@ -0,0 +1,133 @@
+import json
+import os
+import shlex
+import shutil
+import stat
+import tempfile
+import unittest
+
+from zfsbackup.runner.zfs import ZFS
+from zfsbackup.transport import SSH, get_transport
+
+
+# logs its arguments and runs the remote command locally
+SSH_SCRIPT = """#!/bin/sh
+python3 -c 'import json, sys; print(json.dumps(sys.argv[1:]))' "$@" \\
+    >> "%(log)s"
+for arg; do
+    if [ "$arg" = "-O" ]; then exit 0; fi
+    last="$arg"
+done
+exec /bin/sh -c "$last"
+"""
+
+# answers zfs list for a single dataset
+ZFS_SCRIPT = """#!/bin/sh
+echo "$@" >> "%(log)s"
+echo tank/backup
+"""
+
+
+def script(path: str, content: str):
+    with open(path, "w") as f:
+        f.write(content)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+class SSHTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.ssh_log = os.path.join(self.dir, "ssh.log")
+        self.zfs_log = os.path.join(self.dir, "zfs.log")
+        self.ssh = os.path.join(self.dir, "ssh")
+        self.zfs = os.path.join(self.dir, "zfs")
+        script(self.ssh, SSH_SCRIPT % {"log": self.ssh_log})
+        script(self.zfs, ZFS_SCRIPT % {"log": self.zfs_log})
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def transport(self, **spec) -> SSH:
+        spec = dict({"type": "ssh", "host": "backup.example.org"}, **spec)
+        local = ZFS(zfs="/sbin/zfs", sudo="sudo", really=True)
+        return get_transport(spec, local, self.ssh, self.dir)
+
+    def calls(self):
+        if not os.path.exists(self.ssh_log):
+            return []
+        with open(self.ssh_log) as f:
+            return list([json.loads(line) for line in f])
+
+    def options(self, *extra):
+        return ["-o", "BatchMode=yes", "-o", "ControlMaster=auto",
+                "-o", "ControlPath=%s" % os.path.join(self.dir, "ssh-%C"),
+                "-o", "ControlPersist=60"] + list(extra)
+
+    def test_receive(self):
+        transport = self.transport(user="backup", port="2222")
+        self.assertEqual(
+            transport.receive(["recv", "-F", "tank/backup"]),
+            [[self.ssh] + self.options("-l", "backup", "-p", "2222")
+             + ["backup.example.org", "sudo /sbin/zfs recv -F tank/backup"]])
+
+    def test_receive_remote_programs(self):
+        transport = self.transport(zfs="/usr/local/sbin/zfs", sudo="doas")
+        self.assertEqual(
+            transport.receive(["recv", "tank/my backup"])[0][-1],
+            "doas /usr/local/sbin/zfs recv 'tank/my backup'")
+
+    def test_compressed_receive(self):
+        transport = self.transport(compress="zstd")
+        self.assertEqual(
+            transport.receive(["recv", "-F", "tank/backup"]),
+            [["zstd", "-c", "-q"],
+             [self.ssh] + self.options()
+             + ["backup.example.org",
+                "zstd -dc -q | sudo /sbin/zfs recv -F tank/backup"]])
+
+    def test_unknown_compression(self):
+        with self.assertRaises(KeyError):
+            self.transport(compress="bzip2")
+
+    def test_remote_command(self):
+        transport = self.transport(zfs=self.zfs, sudo="")
+        self.assertTrue(transport.zfs.has_dataset("tank/backup"))
+        calls = self.calls()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][:-1],
+                         self.options() + ["backup.example.org"])
+        self.assertEqual(shlex.split(calls[0][-1])[0], self.zfs)
+        with open(self.zfs_log) as f:
+            self.assertIn("tank/backup", f.read())
+
+    def test_command_placeholders(self):
+        transport = get_transport(
+            {"type": "command",
+             "command": "mbuffer -q | {recv} && echo ${HOME} {} {target}"},
+            ZFS(zfs="/sbin/zfs", sudo="", really=True), self.ssh, self.dir)
+        self.assertEqual(
+            transport.receive(["recv", "tank/my backup"]),
+            [["/bin/sh", "-c", "mbuffer -q | /sbin/zfs recv "
+              "'tank/my backup' && echo ${HOME} {} 'tank/my backup'"]])
+
+    def test_close_unused(self):
+        self.transport().close()
+        self.assertEqual(self.calls(), [])
+
+    def test_close(self):
+        # the exit has to reach the socket the connection used, which
+        # is derived from user and port as well
+        transport = self.transport(user="backup", port="2222")
+        transport.receive(["recv", "tank/backup"])
+        transport.close()
+        self.assertEqual(self.calls(), [
+            self.options("-l", "backup", "-p", "2222")
+            + ["-O", "exit", "backup.example.org"]])
+
+        # a second close has nothing left to do
+        transport.close()
+        self.assertEqual(len(self.calls()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
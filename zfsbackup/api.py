@@ -0,0 +1,278 @@
+import datetime
+import logging
+import time
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, List, Union
+
+from .cache import Cache
+from .config import Config
+from .job.archive import Archive
+from .job.base import JobBase, JobType
+from .runner.process import CommandTimeout
+from .runner.zfs import ZFS
+from .status import StatusReport
+
+
+def _element(tag: str, value: Any) -> List[ET.Element]:
+    # True -> <tag />, scalars -> <tag>value</tag>, dicts hold attributes
+    # (scalars), children (dicts, lists and booleans) and "text",
+    # lists repeat the element
+    if value is None or value is False:
+        return []
+    if isinstance(value, list):
+        return list([e for v in value for e in _element(tag, v)])
+    element = ET.Element(tag)
+    if value is True:
+        return [element]
+    if not isinstance(value, dict):
+        element.text = str(value)
+        return [element]
+    for (key, child) in value.items():
+        name = key.replace("_", "-")
+        if key == "text":
+            element.text = str(child)
+        elif isinstance(child, (dict, list, bool)):
+            element.extend(_element(name, child))
+        elif child is not None:
+            element.set(name, str(child))
+    return [element]
+
+
+class ConfigBuilder:
+    def __init__(self):
+        self._root = ET.Element("zfsbackup")
+        self._commands = ET.SubElement(self._root, "commands")
+        self._jobs = ET.SubElement(self._root, "jobs")
+        self._jobsets = ET.SubElement(self._root, "jobsets")
+
+    def _set(self, tag: str, value: Any) -> "ConfigBuilder":
+        for old in self._root.findall(tag):
+            self._root.remove(old)
+        self._root.extend(_element(tag, value))
+        return self
+
+    def cache(self, path: str): return self._set("cache", path)
+
+    def locks(self, path: str): return self._set("locks", path)
+
+    def events(self, path: str): return self._set("events", path)
+
+    def history(self, days: int): return self._set("history", {"days": days})
+
+    def protection(self, name: str): return self._set("protection", name)
+
+    def inventory(self, enabled=True): return self._set("inventory", enabled)
+
+    def retry(self, **options): return self._set("retry", options)
+
+    def throttle(self, **options): return self._set("throttle", options)
+
+    def timeouts(self, **options):
+        # commands= and jobs= take dicts, e.g. commands={"send": "12h"}
+        return self._set("timeouts", options)
+
+    def programs(self, zfs: str = None, zpool: str = None, sudo: str = None,
+                 ssh: str = None) -> "ConfigBuilder":
+        for (tag, path) in (("zfs", zfs), ("zpool", zpool), ("sudo", sudo),
+                            ("ssh", ssh)):
+            if path is not None:
+                self._commands.extend(_element(tag, path))
+        return self
+
+    def command(self, name: str, command: str, args: List[str] = None,
+                sudo=False, readonly=False) -> "ConfigBuilder":
+        self._commands.extend(_element("command", {
+            "name": name, "command": {"text": command},
+            "arguments": {"arg": list(args)} if args else None,
+            "sudo": sudo, "readonly": readonly}))
+        return self
+
+    def job(self, typ: Union[JobType, str], name: str, enabled=True,
+            **spec) -> "ConfigBuilder":
+        # spec follows the xml config, e.g.
+        #   job("clean", "daily", target={"pool": "data"},
+        #       keep={"days": 7}, recurse=True)
+        typ = typ.name if isinstance(typ, JobType) else typ
+        self._jobs.extend(_element(typ, dict(name=name, enabled=enabled,
+                                              **spec)))
+        return self
+
+    def jobset(self, name: str, jobs: List[str]) -> "ConfigBuilder":
+        # jobs are given as type.name, jobset.name includes another set
+        jobset = ET.SubElement(self._jobsets, "jobset", name=name)
+        for job in jobs:
+            (typ, _, jobname) = job.partition(".")
+            ET.SubElement(jobset, typ).text = jobname
+        return self
+
+    @property
+    def element(self) -> ET.Element: return self._root
+
+    def build(self, really=False, simulate=False, verbose=False,
+              zfs: ZFS = None, cache: Cache = None) -> Config:
+        cfg = Config()
+        cfg.load("<api>", really, simulate=simulate, verbose=verbose,
+                 root=self._root)
+        if zfs is not None:
+            cfg.zfs = zfs
+        if cache is not None:
+            cfg.cache = cache
+        return cfg
+
+
+class JobResult:
+    def __init__(self, job: str, started: float, duration: float,
+                 error: str = None, records: List[Dict[str, Any]] = None,
+                 destroyed: List[str] = None, timed_out=False):
+        self._job = job
+        self._started = started
+        self._duration = duration
+        self._error = error
+        self._records = records if records else []
+        self._destroyed = destroyed if destroyed else []
+        self._timed_out = timed_out
+
+    @property
+    def job(self): return self._job
+
+    @property
+    def ok(self) -> bool:
+        return self._error is None and all(
+            [r["exitcode"] == 0 for r in self._records])
+
+    @property
+    def error(self): return self._error
+
+    @property
+    def timed_out(self): return self._timed_out
+
+    @property
+    def started(self): return self._started
+
+    @property
+    def duration(self): return self._duration
+
+    @property
+    def records(self): return self._records
+
+    @property
+    def created(self) -> List[str]:
+        return list(["%s@%s" % (r["dataset"], r["snapshot"])
+                     for r in self._records
+                     if r["action"] == "snapshot" and r["snapshot"]
+                     and r["exitcode"] == 0])
+
+    @property
+    def destroyed(self) -> List[str]: return self._destroyed
+
+    @property
+    def bytes_sent(self) -> int:
+        return sum([r["bytes"] or 0 for r in self._records
+                    if r["action"] in ("copy", "fanout", "chain")
+                    and r["exitcode"] == 0])
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "job": self.job,
+            "ok": self.ok,
+            "error": self.error,
+            "timed_out": self.timed_out,
+            "started": self.started,
+            "duration": self.duration,
+            "created": self.created,
+            "destroyed": self.destroyed,
+            "bytes_sent": self.bytes_sent,
+            "records": self.records,
+        }
+
+
+class ZfsBackup:
+    RECORD = ["job", "dataset", "action", "snapshot", "started", "duration",
+              "bytes", "exitcode"]
+
+    def __init__(self, cfg: Config):
+        self._cfg = cfg
+        self._log = logging.getLogger("zfsbackup")
+        with cfg.cache as cache:
+            if not cache.is_current:
+                raise Exception("cache update is needed")
+
+    @property
+    def config(self): return self._cfg
+
+    def _run(self, job: JobBase, now: datetime.datetime) -> JobResult:
+        started = time.time()
+        error = None
+        if self._cfg.inventory:
+            self._cfg.inventory.invalidate()
+        timeouts = self._cfg.timeouts
+        expirations = timeouts.expirations
+        timed_out = False
+        try:
+            with timeouts.deadline(timeouts.job(job.type.name)):
+                job.run(now=now)
+        except Exception as e:
+            self._log.exception("%s failed: %s", job.owner, str(e))
+            error = str(e)
+            timed_out = isinstance(e, CommandTimeout)
+        timed_out = timed_out or timeouts.expirations > expirations
+        (records, destroyed) = job.results()
+        job.flush_history()
+        return JobResult(job.owner, started, time.time() - started,
+                         error=error,
+                         records=list([dict(zip(self.RECORD, r))
+                                       for r in records]),
+                         destroyed=destroyed, timed_out=timed_out)
+
+    def run_job(self, typ: Union[JobType, str], name: str,
+                now: datetime.datetime = None) -> JobResult:
+        typ = typ if isinstance(typ, JobType) else JobType[typ]
+        now = now if now else datetime.datetime.utcnow()
+        for job in self._cfg.list_jobs(typ, [name], no_all=True):
+            return self._run(job, now)
+        raise KeyError("unknown job %s.%s" % (typ.name, name))
+
+    def run_jobset(self, name: str,
+                   now: datetime.datetime = None) -> List[JobResult]:
+        now = now if now else datetime.datetime.utcnow()
+        jobs = list(self._cfg.list_jobsets([name], no_all=True))
+        return list([self._run(job, now) for job in jobs])
+
+    def restore(self, name: str, target: str, snapshot: str = None,
+                rollback=False) -> JobResult:
+        # name is a copy job with a files destination
+        for job in self._cfg.list_jobs(JobType.copy, [name], no_all=True):
+            if not isinstance(job, Archive):
+                break
+            started = time.time()
+            error = None
+            try:
+                job.restore(target, snapshot=snapshot, rollback=rollback)
+            except Exception as e:
+                self._log.exception("restore of %s failed: %s", job.owner,
+                                    str(e))
+                error = str(e)
+            (records, _) = job.results()
+            job.flush_history()
+            return JobResult(job.owner, started, time.time() - started,
+                             error=error,
+                             records=list([dict(zip(self.RECORD, r))
+                                           for r in records]))
+        raise KeyError("no archiving copy job %s" % name)
+
+    def status(self, names: List[str] = None,
+               workers=8) -> List[Dict[str, Any]]:
+        # lag of every destination of the enabled copy, fanout and chain
+        # jobs, all of them by default
+        lags = StatusReport(self._cfg, workers=workers).collect(
+            self._cfg.list_copies(names if names else ["all"]))
+        return list([lag.as_dict() for lag in lags])
+
+    def close(self):
+        self._cfg.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,366 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+import hashlib
+import json
+import logging
+import lzma
+import multiprocessing
+import os
+import shutil
+import time
+from typing import Any, BinaryIO, Dict, List, Tuple
+from urllib.parse import quote
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .models.snapshot import SnapshotInfo
+
+
+EXTENSIONS = {"zstd": ".zst", "xz": ".xz", "zlib": ".zz", "none": ""}
+
+
+def available(codec: str) -> bool:
+    return codec in EXTENSIONS and (codec != "zstd" or zstandard is not None)
+
+
+def _compress(codec: str, level: int, data: bytes) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(
+            level=3 if level is None else level).compress(data)
+    if codec == "xz":
+        return lzma.compress(data, preset=6 if level is None else level)
+    if codec == "zlib":
+        return zlib.compress(data, 6 if level is None else level)
+    return data
+
+
+def _decompress(codec: str, data: bytes) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "xz":
+        return lzma.decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    return data
+
+
+def _pack(path: str, codec: str, level: int,
+          data: bytes) -> Tuple[int, int, str]:
+    # runs in a worker process, only the checksum travels back
+    packed = _compress(codec, level, data)
+    with open(path, "wb") as f:
+        f.write(packed)
+    return (len(data), len(packed), hashlib.sha256(packed).hexdigest())
+
+
+def _unpack(path: str, codec: str, sha256: str) -> bytes:
+    with open(path, "rb") as f:
+        packed = f.read()
+    if hashlib.sha256(packed).hexdigest() != sha256:
+        raise ValueError("checksum mismatch in %s" % path)
+    return _decompress(codec, packed)
+
+
+class Manifest:
+    VERSION = 1
+
+    def __init__(self, dataset: str, snapshot: str, guid: int,
+                 createtxg: int, codec: str, chunk_size: int,
+                 base: str = None, base_guid: int = None, replicate=False,
+                 chunks: List[Dict[str, Any]] = None, created: float = None):
+        self._dataset = dataset
+        self._snapshot = snapshot
+        self._guid = guid
+        self._createtxg = createtxg
+        self._codec = codec
+        self._chunk_size = chunk_size
+        self._base = base
+        self._base_guid = base_guid
+        self._replicate = replicate
+        self._chunks = chunks if chunks else []
+        self._created = created if created else time.time()
+
+    @property
+    def dataset(self): return self._dataset
+
+    @property
+    def snapshot(self): return self._snapshot
+
+    @property
+    def guid(self): return self._guid
+
+    @property
+    def createtxg(self): return self._createtxg
+
+    @property
+    def codec(self): return self._codec
+
+    @property
+    def base(self): return self._base
+
+    @property
+    def base_guid(self): return self._base_guid
+
+    @property
+    def replicate(self): return self._replicate
+
+    @property
+    def chunks(self): return self._chunks
+
+    @property
+    def created(self): return self._created
+
+    @property
+    def full(self) -> bool: return self._base_guid is None
+
+    @property
+    def size(self) -> int: return sum([c["size"] for c in self._chunks])
+
+    @property
+    def stored(self) -> int: return sum([c["stored"] for c in self._chunks])
+
+    @property
+    def info(self) -> SnapshotInfo:
+        return SnapshotInfo(self._dataset, self._snapshot, self._guid,
+                            self._createtxg)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "version": self.VERSION,
+            "dataset": self._dataset,
+            "snapshot": self._snapshot,
+            "guid": self._guid,
+            "createtxg": self._createtxg,
+            "base": self._base,
+            "base_guid": self._base_guid,
+            "replicate": self._replicate,
+            "codec": self._codec,
+            "chunk_size": self._chunk_size,
+            "created": self._created,
+            "size": self.size,
+            "stored": self.stored,
+            "chunks": self._chunks,
+        }
+
+    @staticmethod
+    def load(path: str) -> "Manifest":
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != Manifest.VERSION:
+            raise ValueError("unsupported manifest version %s in %s" % (
+                data.get("version"), path))
+        return Manifest(data["dataset"], data["snapshot"], data["guid"],
+                        data["createtxg"], data["codec"],
+                        data["chunk_size"], base=data["base"],
+                        base_guid=data["base_guid"],
+                        replicate=data["replicate"], chunks=data["chunks"],
+                        created=data["created"])
+
+    def save(self, path: str):
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.as_dict(), f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+
+
+class ArchiveStore:
+    # every archived snapshot is a directory <path>/<dataset>/<snapshot>
+    # with the compressed chunks of its send stream and a manifest. The
+    # manifest is written last, a directory without one is incomplete.
+    MANIFEST = "manifest.json"
+    PARTIAL = ".partial"
+
+    def __init__(self, path: str, codec: str = None, level: int = None,
+                 chunk_size=64 * 1024 * 1024, workers: int = None,
+                 really=True):
+        self._path = path
+        self._codec = codec if codec else \
+            "zstd" if available("zstd") else "zlib"
+        if not available(self._codec):
+            raise KeyError("unknown or unavailable codec '%s'" % codec)
+        self._level = level
+        self._chunk_size = chunk_size
+        self._workers = workers if workers else os.cpu_count() or 1
+        self._really = really
+        self._executor: ProcessPoolExecutor = None
+        self._log = logging.getLogger("Archive")
+
+    @property
+    def path(self): return self._path
+
+    @property
+    def codec(self): return self._codec
+
+    @property
+    def chunk_size(self): return self._chunk_size
+
+    @property
+    def workers(self): return self._workers
+
+    @property
+    def log(self): return self._log
+
+    def directory(self, dataset: str, snapshot: str = None) -> str:
+        directory = os.path.join(self._path, quote(dataset, safe=""))
+        return os.path.join(directory, snapshot) if snapshot else directory
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # spawned instead of forked, our threads hold locks and pipes
+        if not self._executor:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._workers,
+                mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+    def manifests(self, dataset: str) -> List[Manifest]:
+        directory = self.directory(dataset)
+        if not os.path.isdir(directory):
+            return []
+        result = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name, self.MANIFEST)
+            if name.endswith(self.PARTIAL):
+                continue
+            if not os.path.exists(path):
+                self.log.warning("%s has no manifest, ignoring it",
+                                 os.path.join(directory, name))
+                continue
+            result.append(Manifest.load(path))
+        return sorted(result, key=lambda m: m.createtxg)
+
+    def chains(self, dataset: str) -> List[List[Manifest]]:
+        # a full archive starts a chain, incrementals extend the chain
+        # holding their base. Incrementals without their base can't be
+        # restored and form chains on their own.
+        chains: List[List[Manifest]] = []
+        owner: Dict[int, List[Manifest]] = {}
+        for manifest in self.manifests(dataset):
+            chain = owner.get(manifest.base_guid)
+            if manifest.full or chain is None:
+                if not manifest.full:
+                    self.log.warning("Base of %s@%s is missing",
+                                     dataset, manifest.snapshot)
+                chain = []
+                chains.append(chain)
+            chain.append(manifest)
+            owner[manifest.guid] = chain
+        return chains
+
+    def chain(self, dataset: str, snapshot: str = None) -> List[Manifest]:
+        # the archives to restore, oldest first
+        manifests = self.manifests(dataset)
+        wanted = list([m for m in manifests
+                       if not snapshot or m.snapshot == snapshot])
+        if not wanted:
+            raise KeyError("no archive of %s@%s" % (
+                dataset, snapshot if snapshot else "*"))
+        by_guid = dict({m.guid: m for m in manifests})
+        chain = [wanted[-1]]
+        while not chain[0].full:
+            base = by_guid.get(chain[0].base_guid)
+            if not base:
+                raise KeyError("base %s of %s@%s is missing" % (
+                    chain[0].base, dataset, chain[0].snapshot))
+            chain.insert(0, base)
+        return chain
+
+    @staticmethod
+    def _cancel(futures: List[Future]):
+        # chunks already being worked on are waited for, so nothing
+        # writes into a directory after it was discarded
+        for future in futures:
+            future.cancel()
+        wait(futures)
+
+    def write(self, dataset: str, snapshot: SnapshotInfo,
+              base: SnapshotInfo, stream: BinaryIO,
+              replicate=False) -> Manifest:
+        # reads the stream in chunks which are compressed in parallel,
+        # at most two chunks per worker are in flight
+        partial = self.directory(dataset, snapshot.name) + self.PARTIAL
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        manifest = Manifest(dataset, snapshot.name, snapshot.guid,
+                            snapshot.createtxg, self._codec,
+                            self._chunk_size,
+                            base=base.name if base else None,
+                            base_guid=base.guid if base else None,
+                            replicate=replicate)
+        pool = self._pool()
+        pending = deque()
+
+        def collect():
+            (name, future) = pending.popleft()
+            (size, stored, sha256) = future.result()
+            manifest.chunks.append({"file": name, "size": size,
+                                    "stored": stored, "sha256": sha256})
+
+        try:
+            while True:
+                data = stream.read(self._chunk_size)
+                if not data:
+                    break
+                name = "%06d%s" % (len(manifest.chunks) + len(pending),
+                                   EXTENSIONS[self._codec])
+                pending.append((name, pool.submit(
+                    _pack, os.path.join(partial, name), self._codec,
+                    self._level, data)))
+                if len(pending) >= 2 * self._workers:
+                    collect()
+            while pending:
+                collect()
+        except BaseException:
+            self._cancel(list([f for (_, f) in pending]))
+            raise
+        return manifest
+
+    def commit(self, manifest: Manifest):
+        partial = self.directory(manifest.dataset,
+                                 manifest.snapshot) + self.PARTIAL
+        manifest.save(os.path.join(partial, self.MANIFEST))
+        os.rename(partial, self.directory(manifest.dataset,
+                                          manifest.snapshot))
+
+    def discard(self, dataset: str, snapshot: str):
+        shutil.rmtree(self.directory(dataset, snapshot) + self.PARTIAL,
+                      ignore_errors=True)
+
+    def read(self, manifest: Manifest, out: BinaryIO):
+        # chunks are verified and decompressed in parallel and written
+        # in order
+        directory = self.directory(manifest.dataset, manifest.snapshot)
+        pool = self._pool()
+        pending = deque()
+        try:
+            for chunk in manifest.chunks:
+                pending.append(pool.submit(
+                    _unpack, os.path.join(directory, chunk["file"]),
+                    manifest.codec, chunk["sha256"]))
+                if len(pending) >= 2 * self._workers:
+                    out.write(pending.popleft().result())
+            while pending:
+                out.write(pending.popleft().result())
+        except BaseException:
+            self._cancel(list(pending))
+            raise
+
+    def remove(self, manifest: Manifest):
+        directory = self.directory(manifest.dataset, manifest.snapshot)
+        if not self._really:
+            self.log.info("Would remove %s", directory)
+            return
+        self.log.info("Removing %s", directory)
+        # without its manifest the directory is ignored, even if
+        # removing the chunks fails halfway
+        os.unlink(os.path.join(directory, self.MANIFEST))
+        shutil.rmtree(directory)
@@ -1,9 +1,14 @@
 import logging
+import queue
 import sqlite3
-from typing import Dict
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Tuple
 
 
 class Cache:
+    # UPDATE/INSERT ... RETURNING needs sqlite 3.35
+    RETURNING = sqlite3.sqlite_version_info >= (3, 35)
+
     MIGRATIONS = [
         # db version 1
         """
@@ -44,12 +49,124 @@ class Cache:
         UPDATE db_version SET version=2;
         COMMIT;
         """,
+        # db version 3
+        """
+        BEGIN TRANSACTION;
+        CREATE TABLE bookmarks (
+            dataset TEXT NOT NULL,
+            bookmark TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            needed INT NOT NULL,
+            UNIQUE(dataset, bookmark, destination)
+        );
+        UPDATE db_version SET version=3;
+        COMMIT;
+        """,
+        # db version 4
+        """
+        BEGIN TRANSACTION;
+        CREATE TABLE history (
+            id INTEGER PRIMARY KEY,
+            job TEXT NOT NULL,
+            dataset TEXT NOT NULL,
+            action TEXT NOT NULL,
+            snapshot TEXT,
+            started REAL NOT NULL,
+            duration REAL NOT NULL,
+            bytes INT,
+            exitcode INT NOT NULL
+        );
+        CREATE INDEX history_job_started ON history (job, started);
+        CREATE INDEX history_started ON history (started);
+        UPDATE db_version SET version=4;
+        COMMIT;
+        """,
+        # db version 5
+        """
+        BEGIN TRANSACTION;
+        CREATE TABLE inventory (
+            pool TEXT NOT NULL,
+            dataset TEXT NOT NULL,
+            snapshot TEXT NOT NULL,
+            guid INT,
+            createtxg INT,
+            creation INT,
+            used INT,
+            written INT,
+            PRIMARY KEY(dataset, snapshot)
+        ) WITHOUT ROWID;
+        CREATE INDEX inventory_pool ON inventory (pool);
+        CREATE TABLE inventory_pools (
+            pool TEXT PRIMARY KEY,
+            guid INT NOT NULL,
+            txg INT NOT NULL,
+            refreshed REAL NOT NULL
+        );
+        UPDATE db_version SET version=5;
+        COMMIT;
+        """,
+        # db version 6
+        """
+        BEGIN TRANSACTION;
+        CREATE TABLE journal (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL,
+            started REAL NOT NULL,
+            finished REAL
+        );
+        CREATE INDEX journal_key ON journal (key, finished);
+        CREATE TABLE journal_jobs (
+            journal INT NOT NULL,
+            position INT NOT NULL,
+            job TEXT NOT NULL,
+            state TEXT NOT NULL,
+            attempts INT NOT NULL,
+            next_retry REAL,
+            error TEXT,
+            updated REAL NOT NULL,
+            PRIMARY KEY(journal, job)
+        );
+        UPDATE db_version SET version=6;
+        COMMIT;
+        """,
+        # db version 7
+        """
+        BEGIN TRANSACTION;
+        CREATE TABLE verifications (
+            id INTEGER PRIMARY KEY,
+            job TEXT NOT NULL,
+            source TEXT NOT NULL,
+            snapshot TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            source_guid INT NOT NULL,
+            destination_guid INT,
+            algorithm TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            bytes INT NOT NULL,
+            verified INT NOT NULL,
+            checked REAL NOT NULL
+        );
+        CREATE INDEX verifications_snapshot
+            ON verifications (source, snapshot);
+        CREATE INDEX verifications_checked ON verifications (checked);
+        UPDATE db_version SET version=7;
+        COMMIT;
+        """,
     ]
 
-    def __init__(self, file: str, autocommit=True):
+    # columns of the inventory as listed by zfs list -p, datasets
+    # themselves are stored with an empty snapshot name
+    INVENTORY = ["guid", "createtxg", "creation", "used", "written"]
+
+    def __init__(self, file: str, autocommit=True, shared=False):
         self._file = file
         self._db: sqlite3.Connection = None
         self._autocommit = autocommit
+        # a shared cache keeps its connection open across with blocks,
+        # threads take turns through the lock
+        self._shared = shared
+        self._lock = threading.RLock()
+        self._depth = 0
         self._log = logging.getLogger("Cache")
 
     def __enter__(self):
@@ -59,17 +176,43 @@ class Cache:
     def __exit__(self, type, value, traceback):
         self.close()
 
+    @property
+    def file(self): return self._file
+
+    @property
+    def shared(self): return self._shared
+
     def open(self):
+        if self._shared:
+            self._lock.acquire()
+            self._depth += 1
         if self._db:
             return
         self._log.debug("Opening cache file %s", self._file)
-        self._db = sqlite3.connect(self._file)
+        self._db = sqlite3.connect(self._file,
+                                   check_same_thread=not self._shared)
 
     def close(self):
         if not self._db:
             return
+        if self._shared:
+            self._depth -= 1
+            if self._depth == 0 and self._autocommit:
+                self.commit()
+            self._lock.release()
+            return
         if self._autocommit:
             self.commit()
+        self._disconnect()
+
+    def disconnect(self):
+        # closes a shared cache for good
+        with self._lock:
+            if self._db:
+                self.commit()
+                self._disconnect()
+
+    def _disconnect(self):
         self._log.debug("Closing cache file %s", self._file)
         self._db.close()
         self._db = None
@@ -91,6 +234,9 @@ class Cache:
     def commit(self):
         self._db.commit()
 
+    def rollback(self):
+        self._db.rollback()
+
     def update_tables(self):
         version = self.db_version
         if version < 0:
@@ -108,10 +254,150 @@ class Cache:
             result[dataset][snapshot] = count
         return result
 
-    def snapshots_cleanup(self):
+    def snapshots_cleanup(self) -> int:
         cur = self._db.cursor()
         cur.execute("DELETE FROM keep_snapshots WHERE count <= 0")
-        cur.fetchall()
+        return cur.rowcount
+
+    def snapshot_keep_set(self, dataset: str, snapshot: str, count: int):
+        cur = self._db.cursor()
+        cur.execute("INSERT OR REPLACE INTO keep_snapshots VALUES (?, ?, ?)",
+                    [dataset, snapshot, count])
+
+    def snapshots_delete(self, snapshots: List[Tuple[str, str]]):
+        cur = self._db.cursor()
+        cur.executemany(
+            "DELETE FROM keep_snapshots WHERE dataset=? AND snapshot=?",
+            snapshots
+        )
+
+    def snapshots_orphaned(self, pools: List[str],
+                           live: Iterable[Tuple[str, str]]
+                           ) -> List[Tuple[str, str, int]]:
+        # the live snapshots of the listed pools go into a temp table,
+        # so a single anti-join finds every row without a snapshot
+        cur = self._db.cursor()
+        cur.executescript(
+            """
+            DROP TABLE IF EXISTS temp.live_pools;
+            DROP TABLE IF EXISTS temp.live_snapshots;
+            CREATE TEMP TABLE live_pools (pool TEXT PRIMARY KEY);
+            CREATE TEMP TABLE live_snapshots (
+                dataset TEXT NOT NULL,
+                snapshot TEXT NOT NULL,
+                PRIMARY KEY(dataset, snapshot)
+            ) WITHOUT ROWID;
+            """
+        )
+        cur.executemany("INSERT INTO live_pools VALUES (?)",
+                        [(p,) for p in pools])
+        cur.executemany("INSERT OR IGNORE INTO live_snapshots VALUES (?, ?)",
+                        live)
+        cur.execute(
+            """
+            SELECT k.dataset, k.snapshot, k.count
+            FROM keep_snapshots k
+            WHERE
+                substr(k.dataset, 1, instr(k.dataset || '/', '/') - 1)
+                    IN (SELECT pool FROM live_pools)
+                AND NOT EXISTS (
+                    SELECT 1 FROM live_snapshots l
+                    WHERE l.dataset = k.dataset AND l.snapshot = k.snapshot)
+            ORDER BY k.dataset, k.snapshot
+            """
+        )
+        result = cur.fetchall()
+        cur.executescript(
+            """
+            DROP TABLE temp.live_pools;
+            DROP TABLE temp.live_snapshots;
+            """
+        )
+        return result
+
+    def optimize(self):
+        # VACUUM cannot run inside a transaction
+        self.commit()
+        self._db.execute("ANALYZE")
+        self._db.execute("VACUUM")
+
+    def backup(self, file: str):
+        target = sqlite3.connect(file)
+        try:
+            self._db.backup(target)
+        finally:
+            target.close()
+
+    @staticmethod
+    def _signed(guid: int) -> int:
+        # guids use all 64 bits, sqlite integers are signed
+        if not isinstance(guid, int):
+            return None
+        return guid - (1 << 64) if guid >= (1 << 63) else guid
+
+    @staticmethod
+    def _unsigned(guid: int) -> int:
+        return guid + (1 << 64) if guid is not None and guid < 0 else guid
+
+    def inventory_watermark(self, pool: str) -> Tuple[int, int]:
+        cur = self._db.cursor()
+        cur.execute("SELECT guid, txg FROM inventory_pools WHERE pool=?",
+                    [pool])
+        row = cur.fetchone()
+        return (self._unsigned(row[0]), row[1]) if row else None
+
+    def inventory_update(self, pool: str, guid: int, txg: int,
+                         refreshed: float, rows: List[Dict[str, Any]],
+                         datasets: List[str] = None):
+        # without datasets the whole pool is replaced, otherwise only
+        # the rows of the given datasets
+        cur = self._db.cursor()
+        if datasets is None:
+            cur.execute("DELETE FROM inventory WHERE pool=?", [pool])
+        else:
+            cur.executemany("DELETE FROM inventory WHERE dataset=?",
+                            [(ds,) for ds in datasets])
+
+        def values(row):
+            (dataset, _, snapshot) = row["name"].partition("@")
+            return [pool, dataset, snapshot] + list([
+                self._signed(row.get(c)) if c == "guid"
+                else row.get(c) if isinstance(row.get(c), int) else None
+                for c in self.INVENTORY])
+
+        cur.executemany("INSERT OR REPLACE INTO inventory VALUES " +
+                        "(?, ?, ?, ?, ?, ?, ?, ?)",
+                        [values(row) for row in rows])
+        cur.execute("INSERT OR REPLACE INTO inventory_pools " +
+                    "VALUES (?, ?, ?, ?)",
+                    [pool, self._signed(guid), txg, refreshed])
+
+    def inventory_datasets(self, dataset: str, recurse=False) -> List[str]:
+        cur = self._db.cursor()
+        cur.execute(
+            """
+            SELECT dataset FROM inventory
+            WHERE snapshot = '' AND (dataset = ?1 OR (?2 AND
+                substr(dataset, 1, length(?1) + 1) = ?1 || '/'))
+            ORDER BY dataset
+            """, [dataset, recurse])
+        return list([row[0] for row in cur.fetchall()])
+
+    def inventory_snapshots(self, dataset: str, recurse=False
+                            ) -> List[Dict[str, Any]]:
+        cur = self._db.cursor()
+        cur.execute(
+            """
+            SELECT dataset || '@' || snapshot, %s FROM inventory
+            WHERE snapshot != '' AND (dataset = ?1 OR (?2 AND
+                substr(dataset, 1, length(?1) + 1) = ?1 || '/'))
+            ORDER BY createtxg, dataset
+            """ % ", ".join(self.INVENTORY), [dataset, recurse])
+        columns = ["name"] + self.INVENTORY
+        rows = list([dict(zip(columns, row)) for row in cur.fetchall()])
+        for row in rows:
+            row["guid"] = self._unsigned(row["guid"])
+        return rows
 
     def snapshot_keep(self, dataset: str, snapshot: str) -> int:
         cur = self._db.cursor()
@@ -122,7 +408,10 @@ class Cache:
         result = cur.fetchone()
         return result[0] if result else 0
 
-    def snapshot_keep_increase(self, dataset: str, snapshot: str):
+    def _snapshot_keep_change(self, dataset: str, snapshot: str,
+                              delta: int) -> int:
+        # the new count comes back with the statement where sqlite
+        # supports it, it is only wanted for debug logging
         cur = self._db.cursor()
         cur.execute(
             """
@@ -133,31 +422,270 @@ class Cache:
                 COALESCE(
                     (SELECT count FROM keep_snapshots
                     WHERE dataset=? AND snapshot=?),
-                    0) + 1)
-            """,
-            [dataset, snapshot, dataset, snapshot]
+                    0) + ?)
+            """ + (" RETURNING count" if self.RETURNING else ""),
+            [dataset, snapshot, dataset, snapshot, delta]
         )
-        if self._log.getEffectiveLevel() == logging.DEBUG:
-            self._log.debug("Increased %s@%s count to %d",
-                            dataset, snapshot,
-                            self.snapshot_keep(dataset, snapshot))
+        result = cur.fetchone() if self.RETURNING else None
+        return result[0] if result else None
+
+    def snapshot_keep_increase(self, dataset: str, snapshot: str):
+        count = self._snapshot_keep_change(dataset, snapshot, 1)
+        self._log.debug("Increased %s@%s count to %s",
+                        dataset, snapshot, count)
 
     def snapshot_keep_decrease(self, dataset: str, snapshot: str):
+        count = self._snapshot_keep_change(dataset, snapshot, -1)
+        self._log.debug("Decreased %s@%s count to %s",
+                        dataset, snapshot, count)
+
+    def bookmark_add(self, dataset: str, bookmark: str, destination: str):
+        # only the most recent bookmark is needed as incremental base
         cur = self._db.cursor()
         cur.execute(
             """
-            INSERT OR REPLACE INTO keep_snapshots
-            VALUES (
-                ?,
-                ?,
-                COALESCE(
-                    (SELECT count FROM keep_snapshots
-                    WHERE dataset=? AND snapshot=?),
-                    0) - 1)
+            UPDATE bookmarks SET needed=0
+            WHERE dataset=? AND destination=? AND bookmark!=?
+            """,
+            [dataset, destination, bookmark]
+        )
+        cur.execute(
+            "INSERT OR REPLACE INTO bookmarks VALUES (?, ?, ?, 1)",
+            [dataset, bookmark, destination]
+        )
+        self._log.debug("Marked %s#%s as needed by %s",
+                        dataset, bookmark, destination)
+
+    def bookmarks_unneeded(self, dataset: str) -> List[str]:
+        cur = self._db.cursor()
+        cur.execute(
+            """
+            SELECT bookmark FROM bookmarks WHERE dataset=?
+            GROUP BY bookmark HAVING MAX(needed) <= 0
+            """,
+            [dataset]
+        )
+        return list([row[0] for row in cur.fetchall()])
+
+    def bookmarks_remove(self, dataset: str, bookmarks: List[str]):
+        cur = self._db.cursor()
+        cur.executemany(
+            "DELETE FROM bookmarks WHERE dataset=? AND bookmark=?",
+            [(dataset, bookmark) for bookmark in bookmarks]
+        )
+
+    def history_add(self, entries: List[Tuple]):
+        # (job, dataset, action, snapshot, started, duration,
+        #  bytes, exitcode), written within the current transaction
+        cur = self._db.cursor()
+        cur.executemany(
+            """
+            INSERT INTO history (job, dataset, action, snapshot, started,
+                                 duration, bytes, exitcode)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            entries
+        )
+
+    def history_prune(self, before: float) -> int:
+        cur = self._db.cursor()
+        cur.execute("DELETE FROM history WHERE started < ?", [before])
+        return cur.rowcount
+
+    def verification_add(self, job: str, source: str, snapshot: str,
+                         destination: str, source_guid: int,
+                         destination_guid: int, algorithm: str, digest: str,
+                         size: int, verified: bool, checked: float):
+        cur = self._db.cursor()
+        cur.execute(
+            """
+            INSERT INTO verifications (job, source, snapshot, destination,
+                                       source_guid, destination_guid,
+                                       algorithm, digest, bytes, verified,
+                                       checked)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [job, source, snapshot, destination, self._signed(source_guid),
+             self._signed(destination_guid), algorithm, digest, size,
+             1 if verified else 0, checked]
+        )
+
+    def verifications(self, source: str, snapshot: str = None
+                      ) -> List[Dict[str, Any]]:
+        cur = self._db.cursor()
+        cur.execute(
+            """
+            SELECT job, source, snapshot, destination, source_guid,
+                   destination_guid, algorithm, digest, bytes, verified,
+                   checked
+            FROM verifications
+            WHERE source = ?1 AND (?2 IS NULL OR snapshot = ?2)
+            ORDER BY checked
+            """, [source, snapshot])
+        columns = ["job", "source", "snapshot", "destination",
+                   "source_guid", "destination_guid", "algorithm", "digest",
+                   "bytes", "verified", "checked"]
+        rows = list([dict(zip(columns, row)) for row in cur.fetchall()])
+        for row in rows:
+            row["source_guid"] = self._unsigned(row["source_guid"])
+            row["destination_guid"] = self._unsigned(row["destination_guid"])
+            row["verified"] = bool(row["verified"])
+        return rows
+
+    def verifications_prune(self, before: float) -> int:
+        cur = self._db.cursor()
+        cur.execute("DELETE FROM verifications WHERE checked < ?", [before])
+        return cur.rowcount
+
+    def journal_unfinished(self, key: str, since: float) -> int:
+        cur = self._db.cursor()
+        cur.execute(
+            """
+            SELECT id FROM journal
+            WHERE key = ? AND finished IS NULL AND started >= ?
+            ORDER BY started DESC LIMIT 1
+            """,
+            [key, since]
+        )
+        result = cur.fetchone()
+        return result[0] if result else None
+
+    def journal_create(self, key: str, started: float) -> int:
+        cur = self._db.cursor()
+        cur.execute("INSERT INTO journal (key, started) VALUES (?, ?)",
+                    [key, started])
+        return cur.lastrowid
+
+    def journal_add_jobs(self, journal: int, jobs: List[Tuple[int, str]],
+                         updated: float):
+        cur = self._db.cursor()
+        cur.executemany(
+            """
+            INSERT INTO journal_jobs (journal, position, job, state,
+                                      attempts, updated)
+            VALUES (?, ?, ?, 'pending', 0, ?)
+            """,
+            [(journal, i, job, updated) for (i, job) in jobs]
+        )
+
+    def journal_jobs(self, journal: int) -> Dict[str, Tuple[str, int]]:
+        cur = self._db.cursor()
+        cur.execute(
+            """
+            SELECT job, state, attempts FROM journal_jobs
+            WHERE journal = ? ORDER BY position
             """,
-            [dataset, snapshot, dataset, snapshot]
+            [journal]
         )
-        if self._log.getEffectiveLevel() == logging.DEBUG:
-            self._log.debug("Decreased %s@%s count to %d",
-                            dataset, snapshot,
-                            self.snapshot_keep(dataset, snapshot))
+        return {job: (state, attempts)
+                for (job, state, attempts) in cur.fetchall()}
+
+    def journal_update(self, journal: int, job: str, state: str,
+                       attempts: int, next_retry: float = None,
+                       error: str = None, updated: float = None):
+        cur = self._db.cursor()
+        cur.execute(
+            """
+            UPDATE journal_jobs
+            SET state = ?, attempts = ?, next_retry = ?, error = ?,
+                updated = ?
+            WHERE journal = ? AND job = ?
+            """,
+            [state, attempts, next_retry, error, updated, journal, job]
+        )
+
+    def journal_finish(self, journal: int, finished: float):
+        cur = self._db.cursor()
+        cur.execute("UPDATE journal SET finished = ? WHERE id = ?",
+                    [finished, journal])
+
+    def journal_prune(self, before: float) -> int:
+        # unfinished journals are kept until they are old enough too
+        cur = self._db.cursor()
+        cur.execute(
+            """
+            DELETE FROM journal_jobs WHERE journal IN (
+                SELECT id FROM journal WHERE started < ?)
+            """,
+            [before]
+        )
+        cur.execute("DELETE FROM journal WHERE started < ?", [before])
+        return cur.rowcount
+
+    def history_stats(self, since: float = 0,
+                      job: str = None) -> List[Dict[str, Any]]:
+        # percentiles come from the row number within each
+        # (job, dataset, action) ordered by duration, the trend is the
+        # least squares slope of duration over time in seconds per day
+        cur = self._db.cursor()
+        cur.execute(
+            """
+            WITH runs AS (
+                SELECT
+                    job, dataset, action, duration, bytes, exitcode,
+                    started - MIN(started) OVER part AS t,
+                    ROW_NUMBER() OVER (part ORDER BY duration) AS n,
+                    COUNT(*) OVER part AS total
+                FROM history
+                WHERE started >= ? AND (? IS NULL OR job = ?)
+                WINDOW part AS (PARTITION BY job, dataset, action)
+            ), stats AS (
+                SELECT
+                    job, dataset, action,
+                    COUNT(*) AS runs,
+                    SUM(exitcode != 0) AS failed,
+                    MIN(CASE WHEN n >= 0.5 * total THEN duration END)
+                        AS p50,
+                    MIN(CASE WHEN n >= 0.9 * total THEN duration END)
+                        AS p90,
+                    MAX(duration) AS max,
+                    AVG(bytes) AS bytes,
+                    (COUNT(*) * SUM(t * duration) - SUM(t) * SUM(duration))
+                        / NULLIF(COUNT(*) * SUM(t * t) - SUM(t) * SUM(t), 0)
+                        * 86400 AS trend
+                FROM runs
+                GROUP BY job, dataset, action
+            )
+            SELECT
+                RANK() OVER (ORDER BY p90 DESC) AS rank, *
+            FROM stats
+            ORDER BY rank
+            """,
+            [since, job, job]
+        )
+        columns = [c[0] for c in cur.description]
+        return list([dict(zip(columns, row)) for row in cur.fetchall()])
+
+
+class CacheWriter:
+    # funnels the writes of several threads into a single connection
+    # owned by one thread, committed when the writer is closed
+    def __init__(self, cache: Cache):
+        self._cache = cache
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread = None
+        self._log = logging.getLogger("Cache.Writer")
+
+    def submit(self, write: Callable[[Cache], None]):
+        self._queue.put(write)
+
+    def _run(self):
+        with self._cache as cache:
+            while True:
+                write = self._queue.get()
+                if write is None:
+                    return
+                try:
+                    write(cache)
+                except Exception as e:
+                    self._log.error("Write failed: %s", e)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="CacheWriter", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._queue.put(None)
+        self._thread.join()
@@ -1,15 +1,30 @@
 import argparse
-from datetime import datetime
+import calendar
+from datetime import datetime, timedelta
+import humanfriendly
+import json
 import logging
 import os
-import shutil
 import sys
+import time
+from typing import Dict, List, Tuple
 
+from .cache import Cache
 from .config import Config
-from .job.base import JobType
+from .helpers import ConfigError
+from .job.archive import Archive
+from .job.base import JobBase, JobType
+from .journal import Journal
+from .logs import LogPipeline
+from .protection import HoldProtection
+from .runner.process import CommandTimeout
+from .status import OK, STATES, UNKNOWN, StatusReport, overall
 
 
 class ZfsBackupCli:
+    # problems named by status --nagios
+    PROBLEMS = 5
+
     def __init__(self):
         parser = argparse.ArgumentParser(prog="zfsbackup",
                                          description="ZFS backup utility.")
@@ -22,6 +37,12 @@ class ZfsBackupCli:
                             choices=["DEBUG", "INFO", "WARN", "WARNING",
                                      "ERROR", "CRITICAL"],
                             help="Set log level")
+        parser.add_argument("--log-format", type=str, default="text",
+                            choices=["text", "json"],
+                            help="Log as text or JSON lines. (%(default)s)")
+        parser.add_argument("-v", "--verbose", action="store_true",
+                            help="Log every snapshot decision instead of " +
+                            "a summary per dataset.")
         parser.add_argument("-r", "--really", action="store_true",
                             help="Really execute critical commands.")
 
@@ -33,6 +54,8 @@ class ZfsBackupCli:
             "snapshot": "Take a snapshot of a target.",
             "clean": "Cleanup snapshots of a target.",
             "copy": "Copy specified target to it's destination.",
+            "fanout": "Copy specified target to all of it's destinations.",
+            "chain": "Copy specified target along a chain of hops.",
             "jobset": "Run specified jobset(s)",
         }
 
@@ -42,6 +65,56 @@ class ZfsBackupCli:
                                 help="Only list jobs that would be executed")
             action.add_argument("jobs", metavar="JOB", type=str, nargs="+",
                                 help="Target(s) to run action on")
+            if actionname == "clean":
+                action.add_argument("--estimate", action="store_true",
+                                    help="Only estimate reclaimable space")
+                action.add_argument("--json", action="store_true",
+                                    help="Print the estimate as JSON")
+                action.add_argument("--workers", type=int, default=4,
+                                    help="Datasets estimated concurrently"
+                                    + " (%(default)s)")
+
+        a_sim = actions.add_parser(
+            "simulate",
+            description="Replay jobset(s) against an in-memory copy of " +
+            "the current state and report the resulting snapshots.")
+        a_sim.add_argument("--days", type=float, default=1,
+                           help="Days to replay. (%(default)s)")
+        a_sim.add_argument("--interval", type=float, default=24,
+                           help="Hours between two runs. (%(default)s)")
+        a_sim.add_argument("jobs", metavar="JOBSET", type=str, nargs="+",
+                           help="Jobset(s) to replay")
+
+        a_restore = actions.add_parser(
+            "restore",
+            description="Receive the archives written by a copy job " +
+            "with a files destination.")
+        a_restore.add_argument("--snapshot", type=str, default=None,
+                               help="Restore up to this snapshot " +
+                               "instead of the latest one")
+        a_restore.add_argument("--rollback", action="store_true",
+                               help="Receive with -F")
+        a_restore.add_argument("job", metavar="JOB", type=str,
+                               help="Copy job that wrote the archives")
+        a_restore.add_argument("target", metavar="TARGET", type=str,
+                               help="Dataset to receive into")
+
+        a_status = actions.add_parser(
+            "status",
+            description="Show how far the destinations of copy jobs lag " +
+            "behind their sources.")
+        a_status.add_argument("--json", action="store_true",
+                              help="Print the status as JSON")
+        a_status.add_argument("--nagios", action="store_true",
+                              help="Print a single line and exit with " +
+                              "the Nagios plugin state")
+        a_status.add_argument("--workers", type=int, default=8,
+                              help="Pools listed concurrently" +
+                              " (%(default)s)")
+        a_status.add_argument("jobs", metavar="JOB", type=str, nargs="*",
+                              default=["all"],
+                              help="Copy, fanout or chain job(s) to " +
+                              "check (all)")
 
         a_cache = actions.add_parser("cache",
                                      description="Cache maintenance actions")
@@ -54,7 +127,25 @@ class ZfsBackupCli:
                        help="Do not backup old cache file.")
         as_cache.add_parser("list-snapshots",
                             description="List recorded snapshots")
-        as_cache.add_parser("maint", description="Run maintenance jobs")
+        a = as_cache.add_parser("maint", description="Run maintenance jobs")
+        a.add_argument("--fix", action="store_true",
+                       help="Delete orphaned rows and rewrite keep counts" +
+                       " derived from the copy jobs. Needs --really.")
+        as_cache.add_parser("migrate-holds",
+                            description="Convert keep counts into " +
+                            "zfs user holds")
+        a = as_cache.add_parser("stats",
+                                description="Show statistics of past runs")
+        a.add_argument("--days", type=float, default=30,
+                       help="Only include runs of the last days." +
+                       " (%(default)s)")
+        a.add_argument("--job", type=str, default=None,
+                       help="Only include runs of this job (type.name)")
+        a.add_argument("--top", type=int, default=10,
+                       help="Number of slowest datasets to show." +
+                       " (%(default)s)")
+        a.add_argument("--json", action="store_true",
+                       help="Print statistics as JSON")
 
         action = actions.add_parser("list",
                                     description="List all defined jobs(ets).")
@@ -71,14 +162,19 @@ class ZfsBackupCli:
             a_cache.print_help()
             exit(1)
 
-        logging.basicConfig(
-            format="%(asctime)-15s %(name)s [%(levelname)s]: %(message)s",
-            level=logging.DEBUG if self._args.debug else self._args.loglevel
-        )
+        self._logs = LogPipeline(
+            level=logging.DEBUG if self._args.debug else self._args.loglevel,
+            fmt=self._args.log_format)
         self._log = logging.getLogger("zfsbackup")
 
         self._cfg = Config()
-        self._cfg.load(self._args.config, self._args.really)
+        try:
+            self._cfg.load(self._args.config, self._args.really,
+                           simulate=self._args.action == "simulate",
+                           verbose=self._args.verbose)
+        except ConfigError as e:
+            self._log.critical(str(e))
+            exit(1)
 
         if not self._args.action == "cache":
             with self._cfg.cache as cache:
@@ -88,27 +184,247 @@ class ZfsBackupCli:
                                        " to update cache")
                     exit(1)
 
+    def _run(self, job: JobBase, now: datetime):
+        started = time.monotonic()
+        if self._cfg.inventory:
+            # earlier jobs may have changed the pools
+            self._cfg.inventory.invalidate()
+        try:
+            timeouts = self._cfg.timeouts
+            with timeouts.deadline(timeouts.job(job.type.name)):
+                job.run(now=now)
+        finally:
+            job.flush_history()
+            duration = time.monotonic() - started
+            self._log.info("%s.%s finished after %.3fs", job.type.name,
+                           job.name, duration,
+                           extra={"job": "%s.%s" % (job.type.name, job.name),
+                                  "action": "run",
+                                  "duration": round(duration, 3)})
+
+    def _attempt(self, journal: Journal, job: JobBase,
+                 now: datetime) -> Tuple[str, float]:
+        # returns the journal state of the job and when to retry it
+        throttle = self._cfg.throttle
+        if throttle and self._cfg.optional(job):
+            reason = throttle.busy(job.pools())
+            if reason:
+                self._log.info("Deferring optional %s: %s", job.owner,
+                               reason, extra={"job": job.owner,
+                                              "action": "defer"})
+                return (Journal.PENDING, None)
+        timeouts = self._cfg.timeouts
+        remaining = timeouts.remaining()
+        if remaining is not None and remaining <= 0:
+            self._log.error("%s skipped, run deadline passed", job.owner,
+                            extra={"job": job.owner, "action": "timeout"})
+            journal.timed_out(job.owner, "run deadline passed")
+            return (Journal.TIMEOUT, None)
+
+        journal.running(job.owner)
+        expirations = timeouts.expirations
+        try:
+            self._run(job, now)
+        except Exception as e:
+            # jobs may catch the timeout of a single command and
+            # fail with a more general error
+            if isinstance(e, CommandTimeout) or \
+                    timeouts.expirations > expirations:
+                self._log.error("%s timed out: %s", job.owner, str(e),
+                                extra={"job": job.owner,
+                                       "action": "timeout"})
+                journal.timed_out(job.owner, str(e))
+                return (Journal.TIMEOUT, None)
+            self._log.exception("%s failed: %s", job.owner, str(e),
+                                extra={"job": job.owner, "action": "run"})
+            return (Journal.FAILED, journal.failed(job.owner, str(e)))
+        journal.ok(job.owner)
+        return (Journal.OK, None)
+
+    def _run_all(self, jobs: List[JobBase], now: datetime):
+        unique: Dict[str, JobBase] = {}
+        for job in jobs:
+            unique.setdefault(job.owner, job)
+        jobs = list(unique.values())
+        if self._args.list:
+            for job in jobs:
+                self._log.info("Would run %s.%s", job.type.name, job.name)
+            return
+
+        # a failing job doesn't stop the others, it is retried after
+        # its backoff while the rest of the run goes on
+        journal = self._cfg.journal(" ".join(
+            [self._args.action] + self._args.jobs))
+        remaining = journal.start(list([job.owner for job in jobs]))
+        retries: List[Tuple[float, int, JobBase]] = []
+        failed: List[str] = []
+        timed_out: List[str] = []
+
+        def attempt(i: int, job: JobBase):
+            (state, retry) = self._attempt(journal, job, now)
+            if retry is not None:
+                retries.append((retry, i, job))
+            elif state == Journal.FAILED:
+                failed.append(job.owner)
+            elif state == Journal.TIMEOUT:
+                timed_out.append(job.owner)
+
+        timeouts = self._cfg.timeouts
+        with timeouts.deadline(timeouts.run):
+            for (i, job) in enumerate([j for j in jobs
+                                       if j.owner in remaining]):
+                attempt(i, job)
+
+            while retries:
+                retries.sort(key=lambda r: r[:2])
+                (when, i, job) = retries.pop(0)
+                wait = when - time.time()
+                left = timeouts.remaining()
+                if left is not None and wait >= left:
+                    self._log.error("Not retrying %s, run deadline is "
+                                    + "too close", job.owner)
+                    failed.append(job.owner)
+                    continue
+                if wait > 0:
+                    self._log.info("Retrying %s in %.0fs", job.owner, wait)
+                    time.sleep(wait)
+                attempt(i, job)
+        journal.finish()
+
+        if timed_out:
+            self._log.error("%d jobs timed out: %s", len(timed_out),
+                            ", ".join(timed_out))
+        if failed:
+            self._log.error("%d jobs failed: %s", len(failed),
+                            ", ".join(failed))
+        if failed or timed_out:
+            exit(1)
+
     def run_job(self, typ: JobType):
         now = datetime.now().utcnow()
-        for job in self._cfg.list_jobs(typ, self._args.jobs):
-            if self._args.list:
-                self._log.info("Would run %s.%s", job.type.name, job.name)
-                continue
-            job.run(now=now)
+        self._run_all(self._cfg.list_jobs(typ, list(self._args.jobs)), now)
 
     def snapshot(self): self.run_job(JobType.snapshot)
 
-    def clean(self): self.run_job(JobType.clean)
+    def clean(self):
+        if not self._args.estimate:
+            return self.run_job(JobType.clean)
+
+        now = datetime.now().utcnow()
+        result = {}
+        total = 0
+        for job in self._cfg.list_jobs(JobType.clean, self._args.jobs):
+            estimate = job.estimate(now, workers=self._args.workers)
+            for dataset, (count, size) in estimate.items():
+                if not self._args.json and count:
+                    self._log.info("%s: %d snapshots, %s reclaimable",
+                                   dataset, count,
+                                   humanfriendly.format_size(size,
+                                                             binary=True))
+            reclaim = sum([size for (_, size) in estimate.values()])
+            total += reclaim
+            result[job.name] = {
+                "datasets": {d: {"snapshots": c, "reclaim": r}
+                             for d, (c, r) in estimate.items()},
+                "reclaim": reclaim,
+            }
+
+        if self._args.json:
+            print(json.dumps({"jobs": result, "reclaim": total}, indent=2))
+        else:
+            self._log.info("Total: %s reclaimable",
+                           humanfriendly.format_size(total, binary=True))
 
     def copy(self): self.run_job(JobType.copy)
 
+    def fanout(self): self.run_job(JobType.fanout)
+
+    def chain(self): self.run_job(JobType.chain)
+
+    def restore(self):
+        jobs = list([j for j in self._cfg.list_jobs(
+            JobType.copy, [self._args.job], no_all=True)
+            if isinstance(j, Archive)])
+        if not jobs:
+            self._log.critical("%s is no copy job with a files destination",
+                               self._args.job)
+            exit(1)
+        try:
+            jobs[0].restore(self._args.target, snapshot=self._args.snapshot,
+                            rollback=self._args.rollback)
+        finally:
+            jobs[0].flush_history()
+
+    def status(self):
+        lags = StatusReport(self._cfg, workers=self._args.workers).collect(
+            self._cfg.list_copies(self._args.jobs))
+        state = overall(lags)
+
+        if self._args.json:
+            print(json.dumps({"state": STATES[state],
+                              "replicas": [lag.as_dict() for lag in lags]},
+                             indent=2))
+        elif self._args.nagios:
+            # the first line of a plugin is shown in the overview,
+            # only the worst problems are named
+            bad = sorted([lag for lag in lags if lag.state != OK],
+                         key=lambda lag: (lag.state == UNKNOWN, -lag.state))
+            print("ZFSBACKUP %s - %d of %d replicas ok%s%s | lag=%ds "
+                  "behind=%d" % (
+                      STATES[state], len(lags) - len(bad), len(lags),
+                      "".join(["; %s %s: %s" % (lag.job, lag.destination,
+                                                lag.reason)
+                               for lag in bad[:self.PROBLEMS]]),
+                      "; %d more" % (len(bad) - self.PROBLEMS)
+                      if len(bad) > self.PROBLEMS else "",
+                      max([lag.lag or 0 for lag in lags] or [0]),
+                      max([lag.behind or 0 for lag in lags] or [0])))
+        else:
+            rows = [("JOB", "DESTINATION", "COMMON", "LAG", "BEHIND",
+                     "STATE")]
+            for lag in lags:
+                rows.append((
+                    lag.job, lag.destination, lag.common or "-",
+                    humanfriendly.format_timespan(lag.lag, max_units=2)
+                    if lag.lag is not None else "-",
+                    str(lag.behind) if lag.behind is not None else "-",
+                    STATES[lag.state] + (" (%s)" % lag.reason
+                                         if lag.reason else "")))
+            widths = [max([len(r[i]) for r in rows]) for i in range(5)]
+            for row in rows:
+                print("  ".join([c.ljust(w) for (c, w) in zip(row, widths)]
+                                + [row[-1]]))
+
+        if self._args.nagios:
+            exit(state)
+
     def jobset(self):
         now = datetime.now().utcnow()
-        for job in self._cfg.list_jobsets(self._args.jobs):
-            if self._args.list:
-                self._log.info("Would run %s.%s", job.type.name, job.name)
-                continue
-            job.run(now=now)
+        self._run_all(self._cfg.list_jobsets(list(self._args.jobs)), now)
+
+    def simulate(self):
+        if self._args.interval <= 0:
+            self._log.critical("--interval has to be positive")
+            exit(1)
+        start = datetime.now().utcnow()
+        runs = max(int(self._args.days * 24 / self._args.interval), 1)
+        for i in range(runs):
+            now = start + timedelta(hours=self._args.interval * i)
+            self._log.info("Simulating run %d of %d at %s",
+                           i + 1, runs, now.isoformat(timespec="minutes"))
+            for zfs in self._cfg.simulations:
+                zfs.clock = calendar.timegm(now.timetuple())
+            for job in self._cfg.list_jobsets(list(self._args.jobs)):
+                job.run(now=now)
+
+        for zfs in self._cfg.simulations:
+            for (dataset, before, after) in zfs.report():
+                self._log.info("%s: %d -> %d snapshots, %s -> %s", dataset,
+                               before[0], after[0],
+                               humanfriendly.format_size(before[1],
+                                                         binary=True),
+                               humanfriendly.format_size(after[1],
+                                                         binary=True))
 
     def list(self):
         typ = self._args.type.lower()
@@ -134,7 +450,8 @@ class ZfsBackupCli:
                 os.unlink(bak)
 
             self._log.info("Copying %s to %s", self._cfg.cache_path, bak)
-            shutil.copyfile(self._cfg.cache_path, bak, follow_symlinks=True)
+            with self._cfg.cache as cache:
+                cache.backup(bak)
 
         self._log.info("Updating cache file...")
         with self._cfg.cache as cache:
@@ -149,12 +466,196 @@ class ZfsBackupCli:
                     self._log.info("%s@%s: %s", dataset, snapshot,
                                    snapshots[dataset][snapshot])
 
+    def _live_snapshots(self, datasets: List[str]
+                        ) -> Tuple[List[str], List[Tuple[str, str]]]:
+        zfs = self._cfg.zfs
+        # remote datasets are counted as host:dataset, they are left
+        # alone like pools we can't see
+        pools = sorted(set([ds.split("/", 1)[0] for ds in datasets
+                            if ":" not in ds.split("/", 1)[0]]))
+
+        # one listing per pool
+        live, checked = [], []
+        for pool in pools:
+            snapshots = zfs.datasets(dataset=pool, recurse=True,
+                                     snapshot=True, options=["name"])
+            if snapshots is None:
+                self._log.warning("Cannot list pool %s, skipping", pool)
+                continue
+            checked.append(pool)
+            live += [tuple(s["name"].split("@", 1)) for s in snapshots]
+        return (checked, live)
+
+    def _mismatches(self, keeps: Dict[str, Dict[str, int]],
+                    checked: List[str], orphaned: set
+                    ) -> List[Tuple[str, str, int]]:
+        expected: Dict[Tuple[str, str], int] = {}
+        for job in self._cfg.jobs:
+            for keep in job.expected_keeps():
+                expected[keep] = expected.get(keep, 0) + 1
+
+        mismatches = []
+        current = set([(d, s) for d in keeps for s in keeps[d]])
+        for (dataset, snapshot) in sorted(current | set(expected)):
+            if (dataset, snapshot) in orphaned:
+                continue
+            if (dataset.split("/", 1)[0] not in checked
+                    and (dataset, snapshot) not in expected):
+                continue
+            count = keeps.get(dataset, {}).get(snapshot, 0)
+            wanted = expected.get((dataset, snapshot), 0)
+            if count != wanted:
+                self._log.info("%s@%s has count %d, copy jobs hold %d",
+                               dataset, snapshot, count, wanted)
+                mismatches.append((dataset, snapshot, wanted))
+        self._log.info("Found %d keep counts differing from the copy jobs",
+                       len(mismatches))
+        return mismatches
+
+    def _reconcile(self, cache: Cache):
+        keeps = cache.snapshots()
+        (checked, live) = self._live_snapshots(list(keeps))
+
+        orphans = cache.snapshots_orphaned(checked, live)
+        for (dataset, snapshot, count) in orphans:
+            self._log.info("%s@%s does not exist anymore (count %d)",
+                           dataset, snapshot, count)
+        self._log.info("Found %d orphaned keep counts", len(orphans))
+        orphaned = set([(d, s) for (d, s, _) in orphans])
+
+        # with holds the copy jobs leave the keep counts alone, the rows
+        # left over are not migrated yet and would all be reset to zero
+        mismatches = []
+        if isinstance(self._cfg.protection, HoldProtection):
+            self._log.info("Snapshots are protected by holds, not " +
+                           "comparing keep counts with the copy jobs")
+        else:
+            mismatches = self._mismatches(keeps, checked, orphaned)
+
+        if not self._args.fix:
+            return
+        if not self._cfg.really:
+            self._log.info("Would delete %d orphaned and rewrite %d " +
+                           "keep counts", len(orphaned), len(mismatches))
+            return
+        cache.snapshots_delete(list(orphaned))
+        for (dataset, snapshot, wanted) in mismatches:
+            cache.snapshot_keep_set(dataset, snapshot, wanted)
+        cache.commit()
+
     def cache_maint(self):
+        really = self._cfg.really
+        verb = "Pruned" if really else "Would prune"
+        with self._cfg.cache as cache:
+            self._reconcile(cache)
+            # released keep counts have always been dropped without
+            # --really, only the pruning below waits for it
+            self._log.info("Removed %d released keep counts",
+                           cache.snapshots_cleanup())
+            cache.commit()
+            if self._cfg.history_days > 0:
+                before = time.time() - self._cfg.history_days * 86400
+                self._log.info("%s %d history entries older than %d days",
+                               verb, cache.history_prune(before),
+                               self._cfg.history_days)
+                self._log.info("%s %d run journals", verb,
+                               cache.journal_prune(before))
+                self._log.info("%s %d copy verifications", verb,
+                               cache.verifications_prune(before))
+            if not really:
+                # the counts above came from the deletes themselves
+                cache.rollback()
+                return
+            cache.optimize()
+
+    def cache_migrate_holds(self):
+        protection = self._cfg.protection
+        if not isinstance(protection, HoldProtection):
+            self._log.critical("Set <protection>holds</protection> " +
+                               "before migrating keep counts")
+            exit(1)
+
+        # holds are owned by the job that would release them later
+        owners: Dict[Tuple[str, str], List[str]] = {}
+        recursive = set()
+        for job in self._cfg.jobs:
+            for (dataset, snapshot, owner) in job.expected_holds():
+                owners.setdefault((dataset, snapshot), []).append(owner)
+            if getattr(job, "replicate", False):
+                recursive.add(job.owner)
+
         with self._cfg.cache as cache:
-            cache.snapshots_cleanup()
+            keeps = cache.snapshots()
+        (_, live) = self._live_snapshots(list(keeps))
+        live = set(live)
+
+        groups: Dict[Tuple[str, str], List[str]] = {}
+        converted = []
+        for dataset in sorted(keeps):
+            for (snapshot, count) in sorted(keeps[dataset].items()):
+                if count <= 0:
+                    continue
+                if (dataset, snapshot) not in live:
+                    self._log.warning("%s@%s is not available here, " +
+                                      "keeping its row", dataset, snapshot)
+                    continue
+                found = owners.get((dataset, snapshot))
+                if not found:
+                    self._log.warning("No job expects %s@%s, holding it " +
+                                      "as %s", dataset, snapshot,
+                                      HoldProtection.tag("migrated"))
+                    found = ["migrated"]
+                for owner in found:
+                    groups.setdefault((owner, dataset), []).append(snapshot)
+                converted.append((dataset, snapshot))
+
+        failed = set()
+        for ((owner, dataset), snapshots) in sorted(groups.items()):
+            self._log.info("Holding %d snapshots of %s as %s",
+                           len(snapshots), dataset, protection.tag(owner))
+            failed |= set([(dataset, s) for s in protection.protect(
+                self._cfg.zfs, dataset, snapshots, owner,
+                recurse=owner in recursive)])
+        # a row only goes once every hold it stands for is placed
+        converted = list([c for c in converted if c not in failed])
+        self._log.info("Converted %d keep counts into holds",
+                       len(converted))
+
+        if self._cfg.really:
+            with self._cfg.cache as cache:
+                cache.snapshots_delete(converted)
+                cache.commit()
+        if failed:
+            self._log.error("Could not hold %d snapshots, their keep " +
+                            "counts are left in place", len(failed))
+            exit(1)
+
+    def cache_stats(self):
+        with self._cfg.cache as cache:
+            stats = cache.history_stats(
+                since=time.time() - self._args.days * 86400,
+                job=self._args.job)
+        stats = stats[:self._args.top]
+        if self._args.json:
+            print(json.dumps(stats, indent=2))
+            return
+
+        for row in stats:
+            self._log.info(
+                "#%d %s %s %s: %d runs (%d failed), p50 %.1fs, p90 %.1fs, "
+                + "max %.1fs, %s, trend %+.2fs/day", row["rank"],
+                row["job"], row["action"], row["dataset"], row["runs"],
+                row["failed"], row["p50"], row["p90"], row["max"],
+                humanfriendly.format_size(int(row["bytes"]), binary=True)
+                if row["bytes"] is not None else "size unknown",
+                row["trend"] or 0)
 
     def run(self):
-        getattr(self, self._args.action.replace("-", "_"))()
+        try:
+            getattr(self, self._args.action.replace("-", "_"))()
+        finally:
+            self._cfg.close()
+            self._logs.close()
 
 
 def main():
@@ -1,27 +1,56 @@
 import glob
+import humanfriendly
 import logging
 import os
-from typing import List, Dict, Union, Tuple
+import shutil
+import tempfile
+from typing import List, Dict, Set, Union, Tuple
 import xml.etree.ElementTree as ET
 
 from .cache import Cache
 from .runner.command import Command
+from .runner.simulation import SimulatedZFS
 from .runner.zfs import ZFS
+from .runner.zpool import ZPool
 from .job import JobBase, JobType, get_constructor
 from .events import EventRunner
+from .helpers import ConfigError
+from .inventory import Inventory
+from .journal import Journal, RetryPolicy
+from .lock import LockManager
+from .protection import Protection, get_protection
+from .throttle import Throttle
+from .timeouts import Timeouts
+from .transport import Transport, SSH, Simulated, get_transport
 
 
 class Config:
     def __init__(self):
-        self._zfs: ZFS = None
-        # self._zpool = "/usr/bin/zpool"
+        self._runner: ZFS = None
         self._really = False
+        self._simulate = False
+        self._verbose = False
+        self._simulated_cache: str = None
+        self._shared_cache: Cache = None
         self._eventdir = "/etc/zfsbackup/events.d"
         self._event_runner: EventRunner = None
         self._zfs = "/usr/bin/zfs"
+        self._zpool = "/usr/bin/zpool"
         self._sudo = "/usr/bin/sudo"
+        self._ssh = "/usr/bin/ssh"
+        self._transports: Dict[Tuple[Tuple[str, str], ...], Transport] = {}
         self._cache = "/var/cache/zfsbackup/zfsbackup.sqlite"
         self._lockdir = "/var/lock/zfsbackup"
+        self._history_days = 90
+        self._protection_name = "cache"
+        self._protection: Protection = None
+        self._retry = RetryPolicy()
+        self._timeouts = Timeouts()
+        self._use_inventory = False
+        self._inventory: Inventory = None
+        self._throttle_cfg: ET.Element = None
+        self._throttle: Throttle = None
+        self._optional: Set[str] = set()
         self._commands: Dict[str, Dict] = {}
         self._jobs: Dict[JobType, List[JobBase]] = {}
         self._jobsets: Dict[str, List[Union[JobBase, str]]] = {}
@@ -40,14 +69,53 @@ class Config:
                           for j in jobset])
 
     @property
-    def zfs(self): return ZFS(zfs=self._zfs, sudo=self._sudo,
-                              really=self._really)
+    def zfs(self) -> ZFS:
+        if not self._runner:
+            self._runner = ZFS(zfs=self._zfs, sudo=self._sudo,
+                               really=self._really, timeouts=self._timeouts)
+            if self._simulate:
+                self._runner = SimulatedZFS(self._runner)
+        return self._runner
+
+    @zfs.setter
+    def zfs(self, runner: ZFS):
+        # callers may share a single runner between many configs
+        self._runner = (SimulatedZFS(runner) if self._simulate
+                        else runner)
+        self._inventory = None
 
     @property
-    def really(self): return self._really
+    def really(self):
+        # simulated runs track their keep counts in a copy of the cache
+        return self._really or self._simulate
 
     @property
-    def cache(self): return Cache(self._cache)
+    def simulate(self): return self._simulate
+
+    @property
+    def verbose(self): return self._verbose
+
+    @property
+    def simulations(self) -> List[SimulatedZFS]:
+        runners = [self.zfs]
+        for transport in self._transports.values():
+            if transport.zfs not in runners:
+                runners.append(transport.zfs)
+        return runners
+
+    @property
+    def cache(self) -> Cache:
+        if self._simulate:
+            return Cache(self._simulated_cache)
+        if self._shared_cache:
+            return self._shared_cache
+        return Cache(self._cache)
+
+    @cache.setter
+    def cache(self, cache: Cache):
+        # a shared cache keeps one sqlite connection for all runs
+        self._shared_cache = cache
+        self._cache = cache.file
 
     @property
     def cache_path(self): return self._cache
@@ -55,9 +123,87 @@ class Config:
     @property
     def lockdir(self): return self._lockdir
 
+    @property
+    def history_days(self): return self._history_days
+
+    @property
+    def protection(self) -> Protection:
+        if not self._protection:
+            self._protection = get_protection(
+                self._protection_name, lambda: self.cache, self.really)
+        return self._protection
+
+    @property
+    def inventory(self) -> Inventory:
+        # simulations keep their whole state in memory anyway
+        if not self._use_inventory or self._simulate:
+            return None
+        if not self._inventory:
+            self._inventory = Inventory(
+                self.zfs, ZPool(zpool=self._zpool, sudo=self._sudo,
+                                really=self._really,
+                                timeouts=self._timeouts),
+                lambda: self.cache)
+        return self._inventory
+
+    @property
+    def retry(self) -> RetryPolicy: return self._retry
+
+    def journal(self, key: str) -> Journal:
+        return Journal(lambda: self.cache, key, self._retry, self._really)
+
+    @property
+    def throttle(self) -> Throttle: return self._throttle
+
+    @property
+    def timeouts(self) -> Timeouts: return self._timeouts
+
+    def optional(self, job: JobBase) -> bool:
+        # optional jobs are deferred while the throttle backs off
+        return job.owner in self._optional
+
+    @property
+    def locks(self): return LockManager(self._lockdir, self._really)
+
     @property
     def events(self): return self._event_runner
 
+    def transport(self, spec: Dict[str, str]) -> Transport:
+        # transports are shared by all jobs, so ssh connections
+        # can be reused for every copy within a run
+        key = tuple(sorted(spec.items()))
+        if key not in self._transports:
+            if self._simulate:
+                self._transports[key] = self._simulated_transport(spec)
+            else:
+                self._transports[key] = get_transport(
+                    spec, self.zfs, self._ssh, self._lockdir)
+        return self._transports[key]
+
+    def _simulated_transport(self, spec: Dict[str, str]) -> Transport:
+        local = ZFS(zfs=self._zfs, sudo=self._sudo, really=False)
+        transport = get_transport(spec, local, self._ssh, self._lockdir)
+        # remote hosts get their own state, everything else
+        # receives into the local simulation
+        zfs = (SimulatedZFS(transport.zfs) if isinstance(transport, SSH)
+               else self.zfs)
+        return Simulated(zfs, transport)
+
+    def close(self):
+        for transport in self._transports.values():
+            transport.close()
+        self._transports.clear()
+        if self._simulated_cache:
+            os.unlink(self._simulated_cache)
+            self._simulated_cache = None
+
+    def _copy_cache(self):
+        (fd, self._simulated_cache) = tempfile.mkstemp(
+            prefix="zfsbackup-simulation-", suffix=".sqlite")
+        os.close(fd)
+        if os.path.exists(self._cache):
+            shutil.copyfile(self._cache, self._simulated_cache)
+
     def get_command(self, name):
         cmd = self._commands.get(name, None)
         if cmd is None:
@@ -66,14 +212,14 @@ class Config:
                        args=cmd.get("args", []),
                        sudo=self._sudo, use_sudo=cmd.get("use_sudo", False),
                        readonly=cmd.get("readonly", False),
-                       really=self._really)
+                       really=self._really, timeouts=self._timeouts)
 
     def list_jobs(self, typ: JobType, names: List[str],
                   no_all=False) -> List[JobBase]:
         if not no_all:
             ret = False
             if "all" in names:
-                yield from self._jobs[typ]
+                yield from self._jobs.get(typ, [])
                 ret = True
             if "all-js" in names or "all-jobsets" in names:
                 yield from self.list_jobsets(["all"], typ=typ)
@@ -94,7 +240,7 @@ class Config:
             i += 1
 
         # then list all single jobs
-        for job in self._jobs[typ]:
+        for job in self._jobs.get(typ, []):
             if job.name in names:
                 names.remove(job.name)
                 yield job
@@ -103,6 +249,29 @@ class Config:
             self._log.warn("Unmatched job(set)s for %s: %s",
                            typ.name, ", ".join(names))
 
+    def list_copies(self, names: List[str]) -> List[JobBase]:
+        # enabled copy, fanout and chain jobs, single ones and those
+        # of jobsets
+        types = (JobType.copy, JobType.fanout, JobType.chain)
+        names = list(names)
+        jobs: List[JobBase] = []
+        if "all" in names:
+            names.remove("all")
+            jobs = list([j for typ in types for j in self._jobs.get(typ, [])])
+        for name in [n for n in names if n in self._jobsets]:
+            names.remove(name)
+            jobs += list([j for j in self.list_jobsets([name], no_all=True)
+                          if j.type in types and j not in jobs])
+        for job in [j for typ in types for j in self._jobs.get(typ, [])]:
+            if job.name in names or job.owner in names:
+                names = list([n for n in names
+                              if n not in (job.name, job.owner)])
+                if job not in jobs:
+                    jobs.append(job)
+        if names:
+            self._log.warn("Unmatched job(set)s: %s", ", ".join(names))
+        return list([j for j in jobs if j.enabled])
+
     def list_jobsets(self, names: List[str],
                      no_all=False, typ: JobType = None) -> List[JobBase]:
         if not no_all and "all" in names:
@@ -206,6 +375,40 @@ class Config:
         cache = cfg.find("cache")
         return cache.text if cache is not None else ""
 
+    def _load_history(self, cfg: ET.ElementTree) -> int:
+        history = cfg.find("history")
+        if history is None or "days" not in history.attrib:
+            return None
+        return int(history.attrib["days"])
+
+    def _load_protection(self, cfg: ET.ElementTree) -> str:
+        protection = cfg.find("protection")
+        return protection.text if protection is not None else ""
+
+    def _load_retry(self, cfg: ET.ElementTree) -> RetryPolicy:
+        retry = cfg.find("retry")
+        if retry is None:
+            return None
+        try:
+            return RetryPolicy(cfg=retry)
+        except (ValueError, humanfriendly.InvalidTimespan) as e:
+            raise ConfigError("Invalid <retry>: %s" % str(e))
+
+    def _load_timeouts(self, cfg: ET.ElementTree) -> Timeouts:
+        timeouts = cfg.find("timeouts")
+        if timeouts is None:
+            return None
+        try:
+            return Timeouts(cfg=timeouts)
+        except humanfriendly.InvalidTimespan as e:
+            raise ConfigError("Invalid <timeouts>: %s" % str(e))
+
+    def _load_throttle(self, cfg: ET.ElementTree) -> ET.Element:
+        return cfg.find("throttle")
+
+    def _load_inventory(self, cfg: ET.ElementTree) -> bool:
+        return cfg.find("inventory") is not None
+
     def _load_lockdir(self, cfg: ET.ElementTree) -> str:
         lockdir = cfg.find("locks")
         return lockdir.text if lockdir is not None else ""
@@ -224,9 +427,15 @@ class Config:
             if cmd.tag == "zfs":
                 yield ("zfs", cmd.text)
                 continue
+            if cmd.tag == "zpool":
+                yield ("zpool", cmd.text)
+                continue
             if cmd.tag == "sudo":
                 yield ("sudo", cmd.text)
                 continue
+            if cmd.tag == "ssh":
+                yield ("ssh", cmd.text)
+                continue
 
             name = cmd.attrib["name"]
             command = cmd.find("command")
@@ -257,8 +466,17 @@ class Config:
                 self._log.error("Unknown JobType for %s: %s",
                                 name, job.tag)
                 continue
-            ctor = get_constructor(typ)
-            yield ctor(name, file, enabled, self, job)
+            owner = "%s.%s" % (typ.name, name)
+            if job.find("optional") is not None:
+                self._optional.add(owner)
+            else:
+                self._optional.discard(owner)
+            ctor = get_constructor(typ, job)
+            try:
+                instance = ctor(name, file, enabled, self, job)
+            except ConfigError as e:
+                raise ConfigError("%s in %s: %s" % (owner, file, e))
+            yield instance
 
     def _load_jobsets(self, cfg: ET.ElementTree) -> List[ET.Element]:
         jobsets = cfg.find("jobsets")
@@ -266,11 +484,18 @@ class Config:
             return
         yield from jobsets
 
-    def _load_file(self, file: str):
-        root = ET.parse(file).getroot()
+    def _load_file(self, file: str, root: ET.Element = None):
+        if root is None:
+            root = ET.parse(file).getroot()
         return (self._load_include(root),
                 self._load_cache(root),
                 self._load_lockdir(root),
+                self._load_history(root),
+                self._load_protection(root),
+                self._load_inventory(root),
+                self._load_retry(root),
+                self._load_throttle(root),
+                self._load_timeouts(root),
                 self._load_eventdir(root),
                 self._load_commands(root),
                 self._load_jobs(file, root),
@@ -313,18 +538,16 @@ class Config:
             try:
                 jt = JobType[jc.tag]
             except KeyError:
-                self._log.error("Invalid JobType %s in JobSet %s for %s",
-                                jc.tag, name, jn)
-                exit(1)
+                raise ConfigError("Invalid JobType %s in JobSet %s for %s"
+                                  % (jc.tag, name, jn))
 
-            for job in self._jobs[jt]:
+            for job in self._jobs.get(jt, []):
                 if job.name == jn:
                     jobs.append(job)
                     break
             else:
-                self._log.error("Undefined Job %s.%s in JobSet %s",
-                                jt.name, jn, name)
-                exit(1)
+                raise ConfigError("Undefined Job %s.%s in JobSet %s"
+                                  % (jt.name, jn, name))
 
         self._jobsets[name] = jobs
         self._jobset_files[name] = file
@@ -335,9 +558,8 @@ class Config:
         try:
             typ = JobType[jobset.tag]
         except KeyError:
-            self._log.error("Invalid JobType %s for JobSet %s",
-                            jobset.tag, name)
-            exit(1)
+            raise ConfigError("Invalid JobType %s for JobSet %s"
+                              % (jobset.tag, name))
 
         if name in self._jobsets:
             self._log.warn("JobSet %s already defined in %s, " +
@@ -347,14 +569,13 @@ class Config:
         jobs = []
         for jc in jobset:
             jn = jc.text
-            for job in self._jobs[typ]:
+            for job in self._jobs.get(typ, []):
                 if job.name == jn:
                     jobs.append(job)
                     break
             else:
-                self._log.error("Undefined Job %s.%s in JobSet %s",
-                                typ.name, jn, name)
-                exit(1)
+                raise ConfigError("Undefined Job %s.%s in JobSet %s"
+                                  % (typ.name, jn, name))
 
         self._jobsets[name] = jobs
         self._jobset_files[name] = file
@@ -370,13 +591,22 @@ class Config:
         for name, command in commands:
             if name == "zfs":
                 self._zfs = command
+            elif name == "zpool":
+                self._zpool = command
             elif name == "sudo":
                 self._sudo = command
+            elif name == "ssh":
+                self._ssh = command
             else:
                 self._commands[name] = command
 
-    def load(self, file: str, really: bool):
-        self._really = really
+    def load(self, file: str, really: bool, simulate=False, verbose=False,
+             root: ET.Element = None):
+        # root replaces the contents of file, e.g. for configs built
+        # in code, file is only used to name the source of the jobs
+        self._really = really and not simulate
+        self._simulate = simulate
+        self._verbose = verbose
 
         # we defer jobset parsing till we loaded all jobs
         alljobsets = []
@@ -384,8 +614,9 @@ class Config:
         files = [file]
         i = 0
         while i < len(files):
-            (inc, cache, lockdir, eventdir,
-             cmds, jobs, js) = self._load_file(files[i])
+            (inc, cache, lockdir, history, protection, inventory, retry,
+             throttle, timeouts, eventdir, cmds, jobs, js) = self._load_file(
+                 files[i], root if i == 0 else None)
             if inc:
                 files.extend([f for f in glob.iglob(inc, recursive=True)
                               if os.path.isfile(f)])
@@ -393,6 +624,18 @@ class Config:
                 self._cache = cache
             if lockdir:
                 self._lockdir = lockdir
+            if history is not None:
+                self._history_days = history
+            if protection:
+                self._protection_name = protection
+            if inventory:
+                self._use_inventory = True
+            if retry:
+                self._retry = retry
+            if throttle is not None:
+                self._throttle_cfg = throttle
+            if timeouts:
+                self._timeouts = timeouts
             if eventdir:
                 self._eventdir = eventdir
             if cmds:
@@ -408,4 +651,19 @@ class Config:
             self._append_jobsets(file, jobsets)
         del self._jobset_files
 
-        self._event_runner = EventRunner(self._eventdir, self._really)
+        if self._protection_name not in ["cache", "holds"]:
+            raise ConfigError("Unknown protection %s" % self._protection_name)
+        self._event_runner = EventRunner(self._eventdir, self._really,
+                                         self._timeouts)
+        # simulations don't have any load to watch
+        if self._throttle_cfg is not None and not self._simulate:
+            try:
+                self._throttle = Throttle(
+                    self._throttle_cfg,
+                    ZPool(zpool=self._zpool, sudo=self._sudo,
+                          really=self._really, timeouts=self._timeouts),
+                    self._really)
+            except (ValueError, humanfriendly.InvalidTimespan) as e:
+                raise ConfigError("Invalid <throttle>: %s" % str(e))
+        if self._simulate:
+            self._copy_cache()
@@ -1,19 +1,31 @@
 import json
 import logging
 import os
-from subprocess import Popen, PIPE
+from subprocess import PIPE
 from typing import Dict, Any
 
+from .runner.process import Watchdog
+from .timeouts import Timeouts
+
 
 class EventRunner:
-    def __init__(self, directory: str, really: bool):
+    def __init__(self, directory: str, really: bool,
+                 timeouts: Timeouts = None):
         self._directory = directory
         self._really = really
+        self._timeouts = timeouts
         self._log = logging.getLogger("Event")
 
     @property
     def directory(self): return self._directory
 
+    def _watchdog(self, event: str, log: logging.Logger) -> Watchdog:
+        what = "event %s" % event
+        if not self._timeouts:
+            return Watchdog(what, log=log)
+        return Watchdog(what, self._timeouts.events, self._timeouts.grace,
+                        self._timeouts.expired, log)
+
     def run(self, event: str, args: Dict[str, Any]) -> int:
         log = self._log.getChild(event)
 
@@ -33,9 +45,10 @@ class EventRunner:
         env["ZFSBACKUP_REALLY"] = str(self._really)
 
         log.debug("Executing with environment: %s", json.dumps(env))
-        p = Popen([os.path.join(self.directory, event)],
-                  stdout=PIPE, stderr=PIPE, stdin=PIPE, env=env)
-        (stdout, stderr) = p.communicate()
+        with self._watchdog(event, log) as watchdog:
+            p = watchdog.popen([os.path.join(self.directory, event)],
+                               stdout=PIPE, stderr=PIPE, stdin=PIPE, env=env)
+            (stdout, stderr) = p.communicate()
 
         if p.returncode != 0:
             log.error("Failed with returncode %d: %s", p.returncode,
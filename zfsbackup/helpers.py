@@ -1,2 +1,7 @@
 missing_option = "missing required option '%s'"
 missing_attribute = "missing required attribute '%s'"
+
+
+class ConfigError(Exception):
+    # an invalid configuration, the cli exits on it
+    pass
@@ -0,0 +1,135 @@
+import logging
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+from .cache import Cache
+from .runner.zfs import ZFS
+from .runner.zpool import ZPool
+
+
+class Inventory:
+    # internal history lines look like
+    #   2024-01-01.00:00:00 [txg:1234] snapshot data/src@snap (567)
+    EVENT = re.compile(r"\[txg:(\d+)\] ([a-z ]+?) (\S+) \(\d+\)")
+    # events moving snapshots between datasets, names in the
+    # inventory can't be patched for those
+    RELIST = ["rename", "promote"]
+    PROPERTIES = ["name"] + Cache.INVENTORY
+
+    def __init__(self, zfs: ZFS, zpool: ZPool, cache: Callable[[], Cache]):
+        self._zfs = zfs
+        self._zpool = zpool
+        self._cache = cache
+        self._fresh: Set[str] = set()
+        self._lock = threading.Lock()
+        self._log = logging.getLogger("Inventory")
+
+    @property
+    def log(self): return self._log
+
+    def invalidate(self):
+        # the next lookup of every pool asks zpool history again
+        with self._lock:
+            self._fresh.clear()
+
+    def _events(self, history: List[str]) -> List[Tuple[int, str, str]]:
+        events = []
+        for line in history:
+            match = self.EVENT.search(line)
+            if match:
+                events.append((int(match.group(1)), match.group(2),
+                               match.group(3)))
+        return events
+
+    def _dirty(self, pool: str, watermark: Tuple[int, int], guid: int,
+               events: List[Tuple[int, str, str]]) -> List[str]:
+        # returns the datasets changed since the watermark,
+        # None if the whole pool has to be listed again
+        if watermark is None:
+            self.log.info("%s: no inventory yet", pool)
+            return None
+        (known_guid, known_txg) = watermark
+        if known_guid != guid:
+            self.log.info("%s: pool guid changed", pool)
+            return None
+        # the watermark is the txg of the latest event we have seen,
+        # older events are dropped first once the history is full
+        if known_txg not in set([e[0] for e in events]):
+            self.log.info("%s: history does not reach back to txg %d",
+                          pool, known_txg)
+            return None
+
+        dirty = set()
+        for (txg, event, name) in events:
+            if txg <= known_txg:
+                continue
+            if event in self.RELIST:
+                self.log.info("%s: %s of %s, listing everything",
+                              pool, event, name)
+                return None
+            # receives name their temporary clone, like data/dst/%recv
+            dirty.add(re.split("[@#%]", name, 1)[0].rstrip("/"))
+        return sorted(dirty)
+
+    def _list(self, dataset: str, recurse: bool) -> List[Dict[str, Any]]:
+        own = self._zfs.datasets(dataset=dataset, recurse=recurse,
+                                 options=self.PROPERTIES, parsable=True)
+        if own is None:
+            return None
+        return own + (self._zfs.datasets(dataset=dataset, recurse=recurse,
+                                         snapshot=True,
+                                         options=self.PROPERTIES,
+                                         parsable=True) or [])
+
+    def _refresh(self, cache: Cache, pool: str) -> bool:
+        if pool in self._fresh:
+            return True
+        guid = self._zpool.guid(pool)
+        if guid is None:
+            return False
+
+        # history is read before listing, changes in between are
+        # listed again on the next refresh
+        history = self._zpool.history(pool)
+        events = self._events(history) if history is not None else []
+        watermark = cache.inventory_watermark(pool)
+        dirty = (self._dirty(pool, watermark, guid, events)
+                 if history is not None else None)
+        # the new watermark has to be an event still in the history
+        txg = max([e[0] for e in events] + [0])
+
+        if dirty is None:
+            rows = self._list(pool, True)
+            if rows is None:
+                return False
+        else:
+            txg = max(txg, watermark[1])
+            rows = []
+            for dataset in dirty:
+                rows += self._list(dataset, False) or []
+        self.log.debug("%s: %s, %d rows listed at txg %d", pool,
+                       "full listing" if dirty is None
+                       else "%d datasets changed" % len(dirty),
+                       len(rows), txg)
+        cache.inventory_update(pool, guid, txg, time.time(), rows,
+                               datasets=dirty)
+        cache.commit()
+        self._fresh.add(pool)
+        return True
+
+    def snapshots(self, dataset: str, recurse=False,
+                  options: List[str] = None) -> List[Dict[str, Any]]:
+        # sorted by createtxg like zfs list -s createtxg, None if the
+        # dataset does not exist
+        options = options if options else ["name"]
+        pool = dataset.split("/", 1)[0]
+        with self._lock, self._cache() as cache:
+            if not self._refresh(cache, pool):
+                return None
+            if not cache.inventory_datasets(dataset):
+                return None
+            rows = cache.inventory_snapshots(dataset, recurse=recurse)
+        return list([{o: r[o] if r.get(o) is not None else "-"
+                      for o in options} for r in rows])
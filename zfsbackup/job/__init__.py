@@ -1,11 +1,22 @@
+import xml.etree.ElementTree as ET
+
 from .base import JobBase, JobType
+from .archive import Archive
+from .chain import Chain
 from .clean import Clean
 from .copy import Copy
+from .fanout import Fanout
 from .snapshot import Snapshot
 
 
 _ctors = dict({t: globals()[t.name.capitalize()] for t in JobType})
 
 
-def get_constructor(typ: JobType):
+def get_constructor(typ: JobType, cfg: ET.Element = None):
+    # copies into plain directories are archived instead of received
+    if typ == JobType.copy and cfg is not None:
+        destination = cfg.find("destination")
+        if destination is not None and \
+                destination.attrib.get("type") == "files":
+            return Archive
     return _ctors[typ]
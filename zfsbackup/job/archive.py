@@ -0,0 +1,293 @@
+import calendar
+import datetime
+import time
+from typing import List, Tuple
+import xml.etree.ElementTree as ET
+
+import dateutil.relativedelta as RD
+import humanfriendly
+
+from .base import JobType
+from .copy import CopyBase
+from ..archive import ArchiveStore, Manifest
+from ..helpers import ConfigError, missing_attribute
+from ..models.snapshot import SnapshotInfo, find_incremental_base, \
+    latest_snapshot
+from ..status import Replica
+
+
+class Archive(CopyBase):
+    # a copy into a plain directory: the send stream is stored as
+    # compressed chunks instead of being received by zfs
+    def __init__(self, name: str, file: str,
+                 enabled: bool, globalCfg, cfg: ET.Element):
+        super().__init__(name, file, JobType.copy, enabled, globalCfg, cfg)
+
+        destination = cfg.find("destination")
+        keep = cfg.find("keep")
+
+        for option in ["parallel", "bookmark"]:
+            if cfg.find(option) is not None:
+                raise ConfigError("<%s> cannot be used with files "
+                                  "destinations" % option)
+        self._replicate = cfg.find("replicate") is not None
+
+        attr = destination.attrib
+        if not attr.get("path"):
+            raise ConfigError(missing_attribute % "path")
+        try:
+            self._store = ArchiveStore(
+                attr["path"], codec=attr.get("codec"),
+                level=int(attr["level"]) if "level" in attr else None,
+                chunk_size=humanfriendly.parse_size(
+                    attr.get("chunk-size", "64M"), binary=True),
+                workers=int(attr["workers"]) if "workers" in attr else None,
+                really=self.really)
+        except KeyError as e:
+            raise ConfigError(str(e))
+        self._full = humanfriendly.parse_timespan(attr["full"]) \
+            if "full" in attr else None
+
+        # without <keep> every chain is kept
+        self._keep = None
+        self._keep_chains = None
+        if keep is not None:
+            attr = keep.attrib
+            if "chains" in attr:
+                self._keep_chains = max(int(attr["chains"]), 1)
+            if set(attr) & set(["years", "months", "days", "minutes"]):
+                self._keep = RD.relativedelta(
+                    years=int(attr.get("years", 0)),
+                    months=int(attr.get("months", 0)),
+                    days=int(attr.get("days", 0)),
+                    minutes=int(attr.get("minutes", 0)))
+
+    @property
+    def store(self): return self._store
+
+    @property
+    def replicate(self): return self._replicate
+
+    @property
+    def full(self): return self._full
+
+    @property
+    def keep(self): return self._keep
+
+    @property
+    def keep_chains(self): return self._keep_chains
+
+    @property
+    def destination_key(self) -> str:
+        return "files:%s" % self.store.directory(self.source.joined)
+
+    def pools(self) -> List[str]: return [self.source.pool]
+
+    def replicas(self) -> List[Replica]:
+        source = self.source.joined
+        return [Replica(source, self.zfs, self.store.directory(source),
+                        snapshots=list([m.info for m in
+                                        self.store.manifests(source)]))]
+
+    def expected_keeps(self) -> List[Tuple[str, str]]:
+        # the latest archive is the base of the next one
+        if not self.incremental:
+            return []
+        chains = self.store.chains(self.source.joined)
+        if not chains:
+            return []
+        return [(self.source.joined, chains[-1][-1].snapshot)]
+
+    def _before(self) -> bool:
+        args = {
+            "source": self.source.joined,
+            "destination": self.store.path,
+        }
+        return self.globalCfg.events.run("before_copy", args=args) == 0
+
+    def _after(self, source_snap, base_snap) -> bool:
+        args = {
+            "source": self.source.joined,
+            "source_snapshot": source_snap,
+            "destination": self.store.path,
+            "destination_snapshot": base_snap if base_snap else "",
+        }
+        return self.globalCfg.events.run("after_copy", args=args) == 0
+
+    def _base(self, ssnaps: List[SnapshotInfo],
+              chain: List[Manifest]) -> SnapshotInfo:
+        # incrementals only extend the latest chain, a new chain is
+        # started if it can't be extended any more
+        if not self.incremental or not chain:
+            return None
+        source = self.source.joined
+        if self.full and time.time() - chain[0].created >= self.full:
+            self.log.info("Chain of %s started at %s, starting a new one",
+                          source, chain[0].snapshot)
+            return None
+        base = find_incremental_base(ssnaps, [m.info for m in chain])
+        if not base:
+            self.log.warning("No archived snapshot of %s left, starting "
+                             + "a new chain", source)
+            return None
+        if base.newer:
+            self.log.warning("%s is gone from %s, starting a new chain",
+                             ", ".join([s.name for s in base.newer]),
+                             source)
+            return None
+        self.log.info("Using %s (guid %d, txg %d) as incremental base",
+                      base.source.joined, base.source.guid,
+                      base.source.createtxg)
+        return base.source
+
+    def _transfer(self, ssnap: SnapshotInfo, base: SnapshotInfo,
+                  previous: str = None):
+        source = self.source.joined
+        self._throttle("archive of %s" % ssnap.joined)
+        self._protect(self.zfs, source, [ssnap.name], self.owner,
+                      recurse=self.replicate)
+
+        started = time.time()
+        written: List[Manifest] = []
+        try:
+            failed = self.zfs.send_stream(
+                source, ssnap.name, lambda stream: written.append(
+                    self.store.write(source, ssnap, base, stream,
+                                     replicate=self.replicate)),
+                incremental="@" + base.name if base else None,
+                replicate=self.replicate)
+            if failed:
+                raise Exception("archive of %s failed" % ssnap.joined)
+            if written:
+                self.store.commit(written[0])
+        except Exception:
+            self.store.discard(source, ssnap.name)
+            self._record(source, "copy", started, snapshot=ssnap.name,
+                         exitcode=1)
+            self.protection.release(self.zfs, source, [ssnap.name],
+                                    self.owner, recurse=self.replicate)
+            raise
+
+        if written:
+            manifest = written[0]
+            self.log.info("Archived %s: %s in %d chunks, %s stored",
+                          ssnap.joined,
+                          humanfriendly.format_size(manifest.size,
+                                                    binary=True),
+                          len(manifest.chunks),
+                          humanfriendly.format_size(manifest.stored,
+                                                    binary=True))
+            self._record(source, "copy", started, snapshot=ssnap.name,
+                         size=manifest.size)
+        # the previous archive is either our base or ends an older chain
+        if previous:
+            self.protection.release(self.zfs, source, [previous],
+                                    self.owner, recurse=self.replicate)
+
+    def _archive(self) -> Tuple[str, str]:
+        source = self.source.joined
+        ssnaps = self._snapshots(source).get(source, [])
+        ssnap = latest_snapshot(ssnaps)
+        if not ssnap:
+            self.log.error("Source '%s' has no snapshots, cannot archive!",
+                           source)
+            return None
+
+        chains = self.store.chains(source)
+        if any([m.guid == ssnap.guid for chain in chains for m in chain]):
+            self.log.info("%s is already archived. Nothing to do!",
+                          ssnap.joined)
+            return None
+        base = self._base(ssnaps, chains[-1] if chains else [])
+        previous = chains[-1][-1].snapshot if chains else None
+
+        self.log.info("Archiving %s%s", ssnap.joined,
+                      " from @%s" % base.name if base else " in full")
+        self._transfer(ssnap, base,
+                       previous if previous in ssnaps else None)
+        return (ssnap.name, base.name if base else None)
+
+    def _prune(self, now: datetime.datetime):
+        # the latest chain is always kept, older chains go once enough
+        # newer chains exist and their last archive has expired
+        if self.keep is None and self.keep_chains is None:
+            return
+        source = self.source.joined
+        until = None
+        if self.keep is not None:
+            until = calendar.timegm((now - self.keep).timetuple())
+        chains = self.store.chains(source)
+        for (i, chain) in enumerate(chains[:-1]):
+            newer = len(chains) - 1 - i
+            if self.keep_chains is not None and newer < self.keep_chains:
+                continue
+            if until is not None and chain[-1].created >= until:
+                continue
+            self.log.info("Pruning chain of %s from %s to %s "
+                          + "(%d archives)", source, chain[0].snapshot,
+                          chain[-1].snapshot, len(chain))
+            # newest first, an interrupted prune leaves a restorable chain
+            for manifest in reversed(chain):
+                self.store.remove(manifest)
+
+    def run(self, now: datetime.datetime = None, *args, **kwargs):
+        now = now if now else datetime.datetime.utcnow()
+        self.log.info("Archiving %s to %s", self.source.joined,
+                      self.store.path)
+
+        if not self._before():
+            self._log.error("before event failed")
+            return
+
+        if not self._check_dataset(self.source.joined,
+                                   msg="Source dataset '%s' does not exist!"):
+            return
+
+        try:
+            with self._locks(datasets=[self.source.joined,
+                                       self.destination_key]):
+                snapshots = self._archive()
+                self._prune(now)
+        finally:
+            self.store.close()
+        if not snapshots:
+            return
+
+        if not self._after(*snapshots):
+            self._log.error("after event failed")
+
+    def restore(self, target: str, snapshot: str = None, rollback=False):
+        # receives the chain up to snapshot (the latest by default),
+        # archives already present on target are skipped
+        source = self.source.joined
+        chain = self.store.chain(source, snapshot)
+        present = set()
+        if self.zfs.has_dataset(target):
+            present = set([s.guid for s in self._snapshots(target).get(
+                target, [])])
+        done = list([i for (i, m) in enumerate(chain) if m.guid in present])
+        todo = chain[done[-1] + 1:] if done else chain
+        if not todo:
+            self.log.info("%s already holds %s", target, chain[-1].snapshot)
+            return
+
+        try:
+            with self._locks(datasets=[target, self.destination_key]):
+                for manifest in todo:
+                    self.log.info("Restoring %s@%s into %s (%s)", source,
+                                  manifest.snapshot, target,
+                                  humanfriendly.format_size(manifest.size,
+                                                            binary=True))
+                    started = time.time()
+                    failed = self.zfs.receive_stream(
+                        target, lambda out, m=manifest: self.store.read(
+                            m, out), rollback=rollback)
+                    self._record(target, "restore", started,
+                                 snapshot=manifest.snapshot,
+                                 size=manifest.size,
+                                 exitcode=1 if failed else 0)
+                    if failed:
+                        raise Exception("restore of %s@%s failed" % (
+                            source, manifest.snapshot))
+        finally:
+            self.store.close()
@@ -2,20 +2,25 @@ import abc
 import datetime
 from enum import Enum
 import logging
-import os.path
-from typing import Dict
-
-import filelock
+import time
+from typing import Dict, List, Tuple
+import xml.etree.ElementTree as ET
 
 from ..cache import Cache
+from ..helpers import ConfigError
+from ..lock import DatasetLock
+from ..models.naming import NamingScheme
+from ..models.snapshot import SnapshotTable
+from ..protection import Protection
 from ..runner.zfs import ZFS
-from ..models.dataset import Dataset
 
 
 class JobType(Enum):
     copy = 0
     snapshot = 1
     clean = 2
+    fanout = 3
+    chain = 4
 
 
 class JobBase(metaclass=abc.ABCMeta):
@@ -26,6 +31,9 @@ class JobBase(metaclass=abc.ABCMeta):
         self._type = typ
         self._enabled = enabled
         self._exists: Dict[str, bool] = {}
+        self._naming = NamingScheme()
+        self._history: List[Tuple] = []
+        self._destroyed: List[str] = []
         self._globalCfg = globalCfg
         self._log = logging.getLogger("%s.%s" % (typ.name.capitalize(), name))
 
@@ -53,84 +61,110 @@ class JobBase(metaclass=abc.ABCMeta):
     @property
     def really(self) -> bool: return self._globalCfg.really
 
+    @property
+    def protection(self) -> Protection: return self._globalCfg.protection
+
+    @property
+    def owner(self) -> str: return "%s.%s" % (self.type.name, self.name)
+
     @property
     def log(self): return self._log
 
+    @property
+    def naming(self) -> NamingScheme: return self._naming
+
+    def _parse_naming(self, cfg: ET.Element):
+        if cfg is None:
+            return
+        try:
+            self._naming = NamingScheme(cfg=cfg)
+        except KeyError as e:
+            raise ConfigError(str(e))
+
     def _get_time(self, now: datetime.datetime = None):
         if not now:
             now = datetime.datetime.now().utcnow()
-        return now.strftime("%Y%m%d%H%M")
+        return self.naming.format(now)
 
     def _parse_time(self, time: str):
-        return datetime.datetime.strptime(time, "%Y%m%d%H%M")
+        return self.naming.parse(time)
 
     def _check_dataset(self, dataset: str,
-                       msg="Dataset '%s' does not exist!"):
-        if dataset in self._exists:
-            return self._exists[dataset]
-        exists = self.zfs.has_dataset(dataset)
-        self._exists[dataset] = exists
+                       msg="Dataset '%s' does not exist!", zfs: ZFS = None):
+        zfs = zfs if zfs else self.zfs
+        # the same name on another host is another dataset
+        key = zfs.key(dataset)
+        if key in self._exists:
+            return self._exists[key]
+        exists = zfs.has_dataset(dataset)
+        self._exists[key] = exists
         if not exists:
             self.log.error(msg, dataset)
         return exists
 
+    def _snapshot_tables(self, dataset: str, recurse=False, zfs: ZFS = None
+                         ) -> Dict[str, SnapshotTable]:
+        # local listings are answered by the inventory if enabled
+        zfs = zfs if zfs else self.zfs
+        inventory = self._globalCfg.inventory
+        if inventory and zfs is self.zfs:
+            rows = inventory.snapshots(dataset, recurse=recurse,
+                                       options=SnapshotTable.OPTIONS)
+            return SnapshotTable.group(rows or [])
+        return zfs.snapshot_tables(dataset, recurse=recurse) or {}
+
+    def _locks(self, datasets: List[str] = None, subtrees: List[str] = None,
+               timeout=-1) -> DatasetLock:
+        return self._globalCfg.locks.lock(
+            datasets=datasets, subtrees=subtrees, timeout=timeout,
+            name="%s.%s" % (self.type.name.capitalize(), self.name))
+
+    def pools(self) -> List[str]:
+        # local pools the job works on, a scrub on them throttles it
+        return []
+
+    def _throttle(self, what: str):
+        throttle = self._globalCfg.throttle
+        if throttle:
+            throttle.wait("%s %s" % (self.owner, what), self.pools())
+
+    def _protect(self, zfs: ZFS, dataset: str, snapshots: List[str],
+                 owner: str, recurse=False):
+        # a snapshot left unprotected could be cleaned away while it is
+        # still needed as incremental base
+        failed = self.protection.protect(zfs, dataset, snapshots, owner,
+                                         recurse=recurse)
+        if failed:
+            raise Exception("could not protect %s" % ", ".join(
+                ["%s@%s" % (dataset, s) for s in failed]))
+
+    def expected_keeps(self) -> List[Tuple[str, str]]:
+        # (dataset, snapshot) pairs this job holds a keep count for
+        return []
+
+    def expected_holds(self) -> List[Tuple[str, str, str]]:
+        return list([(d, s, self.owner) for (d, s) in self.expected_keeps()])
+
+    def _record(self, dataset: str, action: str, started: float,
+                snapshot: str = None, size: int = None, exitcode=0):
+        # started is taken from time.time(), the duration ends now
+        self._history.append((
+            self.owner, dataset, action,
+            snapshot, started, time.time() - started, size, exitcode))
+
+    def results(self) -> Tuple[List[Tuple], List[str]]:
+        # history records and destroyed snapshots since the last flush
+        return (list(self._history), list(self._destroyed))
+
+    def flush_history(self):
+        # all records of a run are written in a single transaction
+        (history, self._history) = (self._history, [])
+        self._destroyed = []
+        if not history or not self.really:
+            return
+        with self.cache as cache:
+            cache.history_add(history)
+
     @abc.abstractmethod
     def run(self, *args, **kwargs):
         raise NotImplementedError()
-
-
-class FileLockDemo:
-    def __init__(self, lock_file, timeout=-1):
-        self._lock_file = lock_file
-        self._timeout = timeout
-        self._log = logging.getLogger("FileLockDemo")
-
-    @property
-    def lock_file(self): return self._lock_file
-
-    @property
-    def timeout(self): return self._timeout
-
-    def __enter__(self):
-        self._log.info("Would lock file %s with timeout %d",
-                       self._lock_file, self.timeout)
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        self._log.info("Would unlock file %s", self._lock_file)
-        return None
-
-
-def lock_dataset(target=None, timeout=-1):
-    def outer(function):
-        def inner(self, *args, **kwargs):
-            nonlocal timeout
-            dataset = kwargs.get(target if target else "target")
-            if dataset is None:
-                raise ValueError("could not find dataset to lock")
-            if "lock_timeout" in kwargs:
-                timeout = int(kwargs["lock_timeout"])
-
-            if (not isinstance(dataset, Dataset)
-                    and not issubclass(dataset.__class__, Dataset)):
-                raise ValueError("self.%s has invalid signature: %s" % (
-                    target, dataset.__class__))
-
-            lockdir = self._globalCfg.lockdir
-            filename = "%s.lock" % dataset.joined.replace("/", "_")
-
-            if not self.really:
-                lock = FileLockDemo(os.path.join(lockdir, filename),
-                                    timeout=timeout)
-            else:
-                lock = filelock.FileLock(os.path.join(lockdir, filename),
-                                         timeout=timeout)
-
-            try:
-                with lock:
-                    return function(self, *args, **kwargs)
-            except filelock.Timeout:
-                self._log.error("Could not lock dataset %s on file %s",
-                                dataset.joined, lock.lock_file)
-        return inner
-    return outer
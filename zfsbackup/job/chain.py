@@ -0,0 +1,304 @@
+import threading
+import time
+from typing import List, Set, Tuple
+import xml.etree.ElementTree as ET
+
+from .base import JobType
+from .copy import CopyBase
+from ..helpers import ConfigError, missing_option
+from ..models.dataset import DestinationDataset
+from ..models.snapshot import SnapshotInfo, IncrementalBase
+from ..runner.zfs import ZFS
+from ..status import Replica
+
+
+class Hop:
+    def __init__(self, index: int, destination: DestinationDataset,
+                 upstream: str, szfs: ZFS, dzfs: ZFS):
+        self._index = index
+        self._destination = destination
+        self._upstream = upstream
+        self._szfs = szfs
+        self._dzfs = dzfs
+        self._base: IncrementalBase = None
+        self._checkpoints: List[str] = []
+        self._failed = False
+
+    @property
+    def index(self): return self._index
+
+    @property
+    def destination(self): return self._destination
+
+    @property
+    def upstream(self): return self._upstream
+
+    @property
+    def szfs(self): return self._szfs
+
+    @property
+    def dzfs(self): return self._dzfs
+
+    @property
+    def base(self): return self._base
+
+    @property
+    def checkpoints(self): return self._checkpoints
+
+    @property
+    def failed(self): return self._failed
+
+
+class Chain(CopyBase):
+    def __init__(self, name: str, file: str,
+                 enabled: bool, globalCfg, cfg: ET.Element):
+        super().__init__(name, file, JobType.chain, enabled, globalCfg, cfg)
+
+        hops = cfg.findall("hop")
+        if not hops:
+            raise ConfigError(missing_option % "hop")
+        try:
+            self._hops = list([DestinationDataset(h) for h in hops])
+        except KeyError as e:
+            raise ConfigError(str(e))
+
+    @property
+    def hops(self): return self._hops
+
+    def pools(self) -> List[str]: return self._local_pools(self.hops)
+
+    def _owner(self, destination: DestinationDataset) -> str:
+        # snapshots in the middle of the chain are held by the hop
+        # receiving them and by the hop sending them on
+        return "%s:%s" % (self.owner, self._destination_key(destination))
+
+    def _links(self) -> List[Hop]:
+        links = []
+        upstream, szfs = self.source.joined, self.zfs
+        for (i, destination) in enumerate(self.hops):
+            dzfs = self._transport(destination).zfs
+            links.append(Hop(i, destination, upstream, szfs, dzfs))
+            upstream, szfs = destination.joined, dzfs
+        return links
+
+    def replicas(self) -> List[Replica]:
+        # guids survive every hop, so each hop is measured against the
+        # source of the chain
+        return list([Replica(self.source.joined, self.zfs,
+                             hop.destination.joined, hop.dzfs)
+                     for hop in self._links()])
+
+    def expected_keeps(self) -> List[Tuple[str, str]]:
+        return list([(d, s) for (d, s, _) in self.expected_holds()])
+
+    def expected_holds(self) -> List[Tuple[str, str, str]]:
+        if not self.incremental:
+            return []
+        holds = []
+        for hop in self._links():
+            owner = self._owner(hop.destination)
+            holds += list([(d, s, owner) for (d, s) in self._expected(
+                hop.upstream, hop.destination.joined,
+                self._snapshots(hop.upstream, zfs=hop.szfs),
+                self._snapshots(hop.destination.joined, zfs=hop.dzfs),
+                szfs=hop.szfs, dzfs=hop.dzfs)])
+        return holds
+
+    def _before(self, hop: Hop) -> bool:
+        args = {
+            "source": hop.upstream,
+            "destination": hop.destination.joined,
+        }
+        return self.globalCfg.events.run("before_copy", args=args) == 0
+
+    def _after(self, hop: Hop) -> bool:
+        # only runs once every checkpoint of the hop is committed, the
+        # last one is what the destination holds now
+        args = {
+            "source": hop.upstream,
+            "source_snapshot": hop.checkpoints[-1],
+            "destination": hop.destination.joined,
+            "destination_snapshot": hop.checkpoints[-1],
+        }
+        return self.globalCfg.events.run("after_copy", args=args) == 0
+
+    def _plan(self, hop: Hop, upstream: List[SnapshotInfo],
+              present: Set[str], arriving: List[str]) -> List[SnapshotInfo]:
+        # upstream lists the snapshots the previous hop holds once it is
+        # done, present those it holds already and arriving the
+        # checkpoints it receives in order. Returns what this hop holds
+        # once it is done.
+        destination = hop.destination.joined
+        if not self._before(hop):
+            raise Exception("before event failed for %s" % destination)
+        if not self._check_dataset(
+                destination, msg="Destination dataset '%s' does not exist!",
+                zfs=hop.dzfs):
+            raise Exception("destination %s does not exist" % destination)
+
+        dsnaps = self._snapshots(destination, zfs=hop.dzfs).get(
+            destination, [])
+        if self.incremental:
+            hop._base = self._incremental_base(
+                hop.upstream, destination, upstream, dsnaps,
+                hop.destination.rollback_base)
+
+        names = list([s.name for s in upstream if not s.bookmark])
+        if hop.base:
+            names = names[names.index(hop.base.source.name) + 1:]
+        if not names:
+            self.log.info("%s is up to date", destination)
+        elif not hop.base:
+            # full streams only carry the latest snapshot
+            hop._checkpoints = names[-1:]
+        elif hop.index == 0:
+            # the first hop sends snapshot by snapshot, so the next
+            # hop can start with the first while the others follow
+            hop._checkpoints = names
+        else:
+            ready = list([n for n in names if n in present])
+            hop._checkpoints = ready[-1:] + list(
+                [n for n in arriving if n in names and n not in ready])
+
+        dropped = set([s.name for s in hop.base.newer]) if hop.base \
+            else set()
+        kept = list([s for s in dsnaps if s.name not in dropped])
+        guids = dict({s.name: s.guid for s in upstream})
+        return kept + list([SnapshotInfo(destination, n, guids[n], 0)
+                            for n in hop.checkpoints])
+
+    def _step(self, hop: Hop, snapshot: str, reference: str,
+              previous: Tuple[str, str]):
+        upstream = hop.upstream
+        destination = hop.destination
+        owner = self._owner(destination)
+        self._throttle("send of %s@%s" % (upstream, snapshot))
+        self.log.info("Sending %s@%s to %s%s", upstream, snapshot,
+                      destination.joined,
+                      " from %s" % reference if reference else "")
+
+        self._protect(hop.szfs, upstream, [snapshot], owner)
+        started = time.time()
+        size = hop.szfs.send_size(upstream, snapshot, reference) \
+            if self.really else None
+        try:
+            if hop.szfs.copy(source=upstream, snapshot=snapshot,
+                             target=destination.joined,
+                             incremental=reference,
+                             rollback=destination.rollback,
+                             overwrites=destination.overwrite_properties,
+                             ignores=destination.ignore_properties,
+                             transport=self._transport(destination)):
+                raise Exception("copy of %s@%s to %s failed" % (
+                    upstream, snapshot, destination.joined))
+        except Exception:
+            self._record(upstream, "chain", started, snapshot=snapshot,
+                         size=size, exitcode=1)
+            self.protection.release(hop.szfs, upstream, [snapshot], owner)
+            raise
+
+        self._record(upstream, "chain", started, snapshot=snapshot,
+                     size=size)
+        self._protect(hop.dzfs, destination.joined, [snapshot], owner)
+        if previous:
+            self.protection.release(hop.szfs, upstream, [previous[0]], owner)
+            self.protection.release(hop.dzfs, destination.joined,
+                                    [previous[1]], owner)
+
+    def _follow(self, hop: Hop, committed: List[Set[str]],
+                finished: List[bool], cond: threading.Condition):
+        upstream = committed[hop.index - 1] if hop.index else None
+        reference = hop.base.reference if hop.base else None
+        previous = (hop.base.source.name, hop.base.destination.name) \
+            if hop.base else None
+        try:
+            if hop.base and hop.base.newer and not hop.dzfs.rollback(
+                    hop.destination.joined, hop.base.destination.name):
+                raise Exception("rollback of %s to %s failed" % (
+                    hop.destination.joined, hop.base.destination.name))
+            for snapshot in hop.checkpoints:
+                if upstream is not None:
+                    with cond:
+                        cond.wait_for(lambda: snapshot in upstream
+                                      or finished[hop.index - 1])
+                        if snapshot not in upstream:
+                            raise Exception("%s@%s never arrived" % (
+                                hop.upstream, snapshot))
+                self._step(hop, snapshot, reference, previous)
+                reference, previous = snapshot, (snapshot, snapshot)
+                with cond:
+                    committed[hop.index].add(snapshot)
+                    cond.notify_all()
+        except Exception as e:
+            self.log.error("Hop to %s failed: %s",
+                           hop.destination.joined, e)
+            hop._failed = True
+        finally:
+            with cond:
+                finished[hop.index] = True
+                cond.notify_all()
+
+        if not hop.failed and hop.checkpoints and not self._after(hop):
+            self._log.error("after event failed for %s",
+                            hop.destination.joined)
+
+    def run(self, *args, **kwargs):
+        if not self.enabled:
+            return
+
+        source = self.source.joined
+        self.log.info("Copying %s along a chain of %d hops",
+                      source, len(self.hops))
+
+        if not self._check_dataset(source,
+                                   msg="Source dataset '%s' does not exist!"):
+            return
+
+        snapshots = self._snapshots(source).get(source, [])
+        if not snapshots:
+            self.log.error("Source '%s' has no snapshots, cannot copy!",
+                           source)
+            return
+
+        # all incremental bases are known before the first byte is sent,
+        # a hop may only rely on what the previous hop has or receives
+        links = self._links()
+        present = set([s.name for s in snapshots])
+        arriving: List[str] = []
+        held: List[Set[str]] = []
+        for hop in links:
+            try:
+                after = self._plan(hop, snapshots, present, arriving)
+            except Exception as e:
+                self.log.error(str(e))
+                hop._failed = True
+                after = self._snapshots(
+                    hop.destination.joined, zfs=hop.dzfs).get(
+                        hop.destination.joined, [])
+            present = set([s.name for s in after]) - set(hop.checkpoints)
+            held.append(present)
+            arriving = hop.checkpoints
+            snapshots = after
+
+        committed = list([set(h) for h in held])
+        finished = list([False for _ in links])
+        cond = threading.Condition()
+        with self._locks(datasets=[source] + list(
+                [self._destination_key(d) for d in self.hops])):
+            threads = []
+            for hop in links:
+                if hop.failed:
+                    finished[hop.index] = True
+                    continue
+                thread = threading.Thread(
+                    target=self._follow, args=(hop, committed, finished, cond),
+                    name="%s.%d" % (self.name, hop.index))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+
+        failed = list([h.destination.joined for h in links if h.failed])
+        if failed:
+            raise Exception("copy to %d hops failed: %s" % (
+                len(failed), ", ".join(failed)))
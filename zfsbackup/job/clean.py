@@ -1,14 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
+import logging
+import time
+from typing import Dict, List, Set, Tuple
 import xml.etree.ElementTree as ET
 
 import dateutil.relativedelta as RD
 
-from . import JobBase, JobType, lock_dataset
-from ..helpers import missing_option
+from . import JobBase, JobType
+from ..cache import CacheWriter
+from ..helpers import ConfigError, missing_option
+from ..lock import LockTimeout
 from ..models.dataset import Dataset
+from ..models.snapshot import SnapshotTable
 
 
 class Clean(JobBase):
+    # snapshots destroyed by a single zfs destroy without a throttle
+    BATCH = 16
+
     def __init__(self, name: str, file: str,
                  enabled: bool, globalCfg, cfg: ET.Element):
         super().__init__(name, file, JobType.clean, enabled, globalCfg)
@@ -19,8 +29,7 @@ class Clean(JobBase):
         recurse = cfg.find("recurse")
 
         if target is None:
-            self.log.critical(missing_option, "target")
-            exit(1)
+            raise ConfigError(missing_option % "target")
         self._dataset = Dataset(cfg=target)
 
         if keep is None:
@@ -35,10 +44,16 @@ class Clean(JobBase):
 
         self._squash = squash is not None
         self._recurse = recurse is not None
+        self._workers = 1
+        if self._recurse:
+            self._workers = max(int(recurse.attrib.get("workers", 1)), 1)
+        self._parse_naming(cfg.find("naming"))
 
     @property
     def dataset(self): return self._dataset
 
+    def pools(self) -> List[str]: return [self.dataset.pool]
+
     @property
     def keep(self): return self._keep
 
@@ -48,51 +63,169 @@ class Clean(JobBase):
     @property
     def recurse(self): return self._recurse
 
-    @lock_dataset(target="dataset", timeout=30)
-    def _clean(self, dataset: Dataset,
-               keep_until: datetime.datetime,
-               parent: Dataset = None):
+    @property
+    def workers(self): return self._workers
+
+    def _decide(self, decisions: Dict[str, int], dataset: str,
+                snapshot: str, action: str, msg: str, *args):
+        # single decisions are only logged in verbose mode,
+        # otherwise _plan logs a summary per dataset
+        decisions[action] = decisions.get(action, 0) + 1
+        if self.globalCfg.verbose:
+            self.log.info("%s@%s " + msg, dataset, snapshot, *args,
+                          extra={"job": self.name, "dataset": dataset,
+                                 "snapshot": snapshot, "action": action})
+
+    def _protected(self) -> Dict[str, Set[str]]:
+        # protected snapshots of the whole tree are looked up once
+        root = self.dataset.joined
+        datasets = [root]
+        if self.recurse:
+            datasets = list([d["name"] for d in self.zfs.datasets(
+                dataset=root, recurse=True, options=["name"],
+                sort="name", sort_ascending=True)])
+        return self.protection.protected(self.zfs, root, datasets)
+
+    def _plan(self, dataset: str, keep_until: datetime.datetime,
+              protected: Set[str], snapshots: SnapshotTable = None
+              ) -> Tuple[List[str], List[str], Dict[str, int]]:
         prev = ""
-        dataset = dataset.joined
-        parent = parent.joined if parent else dataset
         to_delete = []
-        with self.cache as cache:
-            snapshots = self.zfs.datasets(dataset=dataset,
-                                          snapshot=True,
-                                          options=["name"], sort="name",
-                                          sort_ascending=True)
-
-            for snapshot in snapshots:
-                name = snapshot["name"].split("@")[1]
-                time = self._parse_time(name)
-
-                if prev and not self.zfs.diff_snapshots(dataset, prev, name):
-                    self.log.info("%s@%s marked for deletion: " +
-                                  "Same as %s@%s",
-                                  dataset, prev, dataset, name)
-                    to_delete.append(prev)
-
-                snapshot_copy_count = cache.snapshot_keep(parent, name)
-                self.log.debug("%s@%s has a total copy count of %d",
-                               dataset, name, snapshot_copy_count)
-                if snapshot_copy_count > 0:
-                    self.log.info("%s@%s skipped: " +
-                                  "Marked for incremental copies",
-                                  dataset, name)
-                    continue
+        decisions: Dict[str, int] = {}
+        started = time.monotonic()
+        if snapshots is None:
+            snapshots = self._snapshot_tables(dataset).get(
+                dataset, SnapshotTable(dataset))
 
-                if time < keep_until:
-                    self.log.info("%s@%s marked for deletion: Too old",
-                                  dataset, name)
-                    to_delete.append(name)
-                    continue
+        # snapshots not named by our scheme belong to someone else
+        index = self.naming.index(snapshots)
+        self.log.debug("%s: %d of %d snapshots match the naming scheme",
+                       dataset, len(index), len(snapshots))
+        expired = self.naming.older_than(index, keep_until)
 
-                if not self.squash:
-                    continue
-                prev = name
+        for (i, (_, name)) in enumerate(index):
+            if prev and not self.zfs.diff_snapshots(dataset, prev, name):
+                self._decide(decisions, dataset, prev, "squash",
+                             "marked for deletion: Same as %s@%s",
+                             dataset, name)
+                to_delete.append(prev)
+
+            if name in protected:
+                self._decide(decisions, dataset, name, "keep",
+                             "skipped: Marked for incremental copies")
+                continue
+
+            if i < expired:
+                self._decide(decisions, dataset, name, "expire",
+                             "marked for deletion: Too old")
+                to_delete.append(name)
+                continue
+
+            if not self.squash:
+                continue
+            prev = name
+
+        # recursive cleans summarize the whole tree instead
+        duration = time.monotonic() - started
+        self.log.log(logging.DEBUG if self.recurse else logging.INFO,
+                     "%s: %d snapshots, %d too old, %d squashed, "
+                     + "%d kept for copies", dataset, len(index),
+                     decisions.get("expire", 0), decisions.get("squash", 0),
+                     decisions.get("keep", 0),
+                     extra={"job": self.name, "dataset": dataset,
+                            "action": "plan", "count": len(to_delete),
+                            "duration": round(duration, 3)})
+
+        return (to_delete, snapshots.names, decisions)
+
+    def _clean(self, dataset: str, keep_until: datetime.datetime,
+               protected: Set[str], snapshots: SnapshotTable = None,
+               unneeded: List[str] = None, bookmarks: Set[str] = None,
+               writer: CacheWriter = None) -> Dict[str, int]:
+        started = time.time()
+        (to_delete, _, decisions) = self._plan(dataset, keep_until,
+                                               protected, snapshots)
+
+        failed = 0
+        throttle = self.globalCfg.throttle
+        batch = throttle.batch if throttle else self.BATCH
+        for i in range(0, len(to_delete), batch):
+            snapshots = to_delete[i:i + batch]
+            if throttle:
+                self._throttle("destroys on %s" % dataset)
+            missed = self.zfs.destroy_snapshots(dataset, snapshots)
+            failed += len(missed)
+            self._destroyed.extend(["%s@%s" % (dataset, s)
+                                    for s in snapshots if s not in missed])
+        self._record(dataset, "clean", started, exitcode=1 if failed else 0)
+
+        self._prune_bookmarks(dataset, unneeded, bookmarks, writer)
+        decisions["destroyed"] = len(to_delete) - failed
+        decisions["failed"] = failed
+        return decisions
+
+    def _estimate(self, dataset: str, keep_until: datetime.datetime,
+                  protected: Set[str]) -> Tuple[int, int]:
+        (to_delete, order, _) = self._plan(dataset, keep_until, protected)
+        if not to_delete:
+            return (0, 0)
+        return (len(set(to_delete)),
+                self.zfs.destroy_estimate(dataset, to_delete, order))
+
+    def estimate(self, now: datetime.datetime,
+                 workers=4) -> Dict[str, Tuple[int, int]]:
+        if not self.enabled:
+            return {}
+        if not self._check_dataset(self.dataset.joined):
+            return {}
+
+        keep_until = now - self.keep
+        protected = self._protected()
 
-        for snapshot in to_delete:
-            self.zfs.destroy(dataset, snapshot)
+        # estimates only read, so datasets are asked concurrently
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            futures = list([(d, pool.submit(
+                self._estimate, d, keep_until, p))
+                for (d, p) in protected.items()])
+            return {d: future.result() for (d, future) in futures}
+
+    def _bookmarks(self, dataset: str,
+                   recurse=False) -> Dict[str, Set[str]]:
+        # bookmark names per dataset
+        result: Dict[str, Set[str]] = {}
+        for row in self.zfs.datasets(dataset=dataset, recurse=recurse,
+                                     bookmark=True, options=["name"]) or []:
+            (ds, _, name) = row["name"].partition("#")
+            result.setdefault(ds, set()).add(name)
+        return result
+
+    def _prune_bookmarks(self, dataset: str, unneeded: List[str] = None,
+                         existing: Set[str] = None,
+                         writer: CacheWriter = None):
+        # recursive cleans look up the bookmarks of all datasets at once
+        # and hand their updates to the writer
+        if unneeded is None:
+            with self.cache as cache:
+                unneeded = cache.bookmarks_unneeded(dataset)
+        if not unneeded:
+            return
+
+        if existing is None:
+            existing = self._bookmarks(dataset).get(dataset, set())
+        to_delete = list([b for b in unneeded if b in existing])
+        self.log.info("%s: pruning %d bookmarks no longer needed " +
+                      "by any destination", dataset, len(to_delete))
+        failed = self.zfs.destroy_bookmarks(dataset, to_delete)
+
+        if not self.really:
+            return
+        removed = list([b for b in unneeded if b not in failed])
+        if writer:
+            writer.submit(lambda cache: cache.bookmarks_remove(dataset,
+                                                               removed))
+            return
+        with self.cache as cache:
+            cache.bookmarks_remove(dataset, removed)
 
     def _before(self):
         args = {
@@ -106,6 +239,62 @@ class Clean(JobBase):
         }
         return self.globalCfg.events.run("after_clean", args=args) == 0
 
+    def _run_locked(self, now: datetime.datetime):
+        if not self.recurse:
+            for (dataset, protected) in self._protected().items():
+                self._clean(dataset, keep_until=now - self.keep,
+                            protected=protected)
+            return
+        self._run_recursive(now)
+
+    def _run_recursive(self, now: datetime.datetime):
+        # the whole tree is planned from a single listing, the children
+        # are cleaned by workers sharing one cache connection
+        root = self.dataset.joined
+        started = time.monotonic()
+        protected = self._protected()
+        tables = self._snapshot_tables(root, recurse=True)
+        with self.cache as cache:
+            unneeded = dict({d: cache.bookmarks_unneeded(d)
+                             for d in protected})
+        # like the snapshots, bookmarks are listed once for the tree
+        bookmarks = self._bookmarks(root, recurse=True) \
+            if any(unneeded.values()) else {}
+
+        totals: Dict[str, int] = {}
+        errors = []
+        with CacheWriter(self.cache) as writer, \
+                ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = dict({pool.submit(
+                self._clean, d, now - self.keep, p,
+                tables.get(d, SnapshotTable(d)), unneeded[d],
+                bookmarks.get(d, set()), writer): d
+                for (d, p) in protected.items()})
+            for future in as_completed(futures):
+                try:
+                    decisions = future.result()
+                except Exception as e:
+                    self.log.error("Clean of %s failed: %s",
+                                   futures[future], e)
+                    errors.append(futures[future])
+                    continue
+                for (action, count) in decisions.items():
+                    totals[action] = totals.get(action, 0) + count
+
+        duration = time.monotonic() - started
+        self.log.info("%s: %d datasets, %d snapshots destroyed (%d too "
+                      + "old, %d squashed), %d kept for copies, %d failed",
+                      root, len(protected), totals.get("destroyed", 0),
+                      totals.get("expire", 0), totals.get("squash", 0),
+                      totals.get("keep", 0), totals.get("failed", 0),
+                      extra={"job": self.name, "dataset": root,
+                             "action": "clean",
+                             "count": totals.get("destroyed", 0),
+                             "duration": round(duration, 3)})
+        if errors:
+            raise Exception("clean of %d datasets failed: %s" % (
+                len(errors), ", ".join(sorted(errors))))
+
     def run(self, now: datetime.datetime, *args, **kwargs):
         if not self.enabled:
             return
@@ -118,16 +307,16 @@ class Clean(JobBase):
         if not self._check_dataset(self.dataset.joined):
             return
 
-        if self.recurse:
-            for dataset in self.zfs.datasets(dataset=self.dataset.joined,
-                                             recurse=True, options=["name"],
-                                             sort="name"):
-                self._clean(dataset=Dataset(dataset=dataset["name"]),
-                            keep_until=now - self.keep,
-                            parent=self.dataset)
-        else:
-            self._clean(dataset=self.dataset,
-                        keep_until=now - self.keep)
+        # recursive cleans lock the whole subtree once
+        root = self.dataset.joined
+        try:
+            with self._locks(datasets=[] if self.recurse else [root],
+                             subtrees=[root] if self.recurse else [],
+                             timeout=30):
+                self._run_locked(now)
+        except LockTimeout as e:
+            self._log.error("Could not lock dataset %s: %s", root, e)
+            return
 
         if not self._after():
             self._log.error("after event failed")
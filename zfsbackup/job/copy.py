@@ -1,43 +1,193 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
+import time
+from typing import Dict, List, Tuple
 import xml.etree.ElementTree as ET
 
-from . import JobBase, JobType, lock_dataset
-from ..helpers import missing_option
+import humanfriendly
+
+from . import JobBase, JobType
+from ..helpers import ConfigError, missing_option
 from ..models.dataset import Dataset, DestinationDataset
+from ..models.snapshot import SnapshotInfo, IncrementalBase, \
+    find_incremental_base, latest_snapshot
+from ..runner.relay import StreamDigest
+from ..runner.zfs import ZFS
+from ..status import Replica
+from ..transport import Transport
 
 
-class Copy(JobBase):
-    def __init__(self, name: str, file: str,
+class CopyBase(JobBase):
+    def __init__(self, name: str, file: str, typ: JobType,
                  enabled: bool, globalCfg, cfg: ET.Element):
-        super().__init__(name, file, JobType.copy, enabled, globalCfg)
+        super().__init__(name, file, typ, enabled, globalCfg)
 
         source = cfg.find("source")
-        destination = cfg.find("destination")
-        replicate = cfg.find("replicate")
         incremental = cfg.find("incremental")
+        rpo = cfg.find("rpo")
 
         if source is None:
-            self.log.critical(missing_option, "source")
-            exit(1)
+            raise ConfigError(missing_option % "source")
         try:
             self._source = Dataset(cfg=source)
         except KeyError as e:
-            self.log.critical(str(e))
-            exit(1)
+            raise ConfigError(str(e))
+
+        self._incremental = incremental is not None
+
+        # how old the newest copied snapshot may get, checked by status
+        self._rpo_warning = None
+        self._rpo_critical = None
+        if rpo is not None:
+            attr = rpo.attrib
+            if "warning" in attr:
+                self._rpo_warning = humanfriendly.parse_timespan(
+                    attr["warning"])
+            if "critical" in attr:
+                self._rpo_critical = humanfriendly.parse_timespan(
+                    attr["critical"])
+
+    @property
+    def source(self): return self._source
+
+    @property
+    def incremental(self): return self._incremental
+
+    @property
+    def rpo_warning(self): return self._rpo_warning
+
+    @property
+    def rpo_critical(self): return self._rpo_critical
+
+    def replicas(self) -> List[Replica]:
+        # the destinations status compares with their source
+        return []
+
+    def _transport(self, destination: DestinationDataset) -> Transport:
+        return self.globalCfg.transport(destination.transport)
+
+    def _local_pools(self, destinations: List[DestinationDataset]
+                     ) -> List[str]:
+        # zpool only sees pools of this host
+        return [self.source.pool] + list(
+            [d.pool for d in destinations if not d.transport.get("host")])
+
+    def _snapshots(self, dataset: str, recurse=False, zfs: ZFS = None,
+                   bookmarks=False) -> Dict[str, List[SnapshotInfo]]:
+        # plain snapshot listings come as tables, which behave like
+        # lists of SnapshotInfo
+        if not bookmarks:
+            return self._snapshot_tables(dataset, recurse=recurse, zfs=zfs)
+        zfs = zfs if zfs else self.zfs
+        snapshots = zfs.datasets(dataset=dataset, snapshot=True,
+                                 bookmark=True, recurse=recurse,
+                                 options=["name", "guid", "createtxg"],
+                                 sort="createtxg", sort_ascending=True,
+                                 parsable=True)
+        result: Dict[str, List[SnapshotInfo]] = {}
+        for snapshot in snapshots or []:
+            snapshot = SnapshotInfo.parse(snapshot)
+            result.setdefault(snapshot.dataset, []).append(snapshot)
+        return result
+
+    def _destination_key(self, destination: DestinationDataset,
+                         dataset: str = None) -> str:
+        dataset = dataset if dataset else destination.joined
+        host = destination.transport.get("host")
+        return "%s:%s" % (host, dataset) if host else dataset
+
+    def _incremental_base(self, source: str, destination: str,
+                          ssnaps: List[SnapshotInfo],
+                          dsnaps: List[SnapshotInfo],
+                          rollback=False) -> IncrementalBase:
+        if not dsnaps:
+            self.log.info("Destination '%s' has no snapshots,"
+                          + " cannot do incremental copy!", destination)
+            return None
+        base = find_incremental_base(ssnaps, dsnaps)
+        if not base:
+            self.log.warning("No common snapshot between '%s' and '%s'."
+                             + " Cannot do incremental copy!",
+                             source, destination)
+            return None
+
+        self.log.info("Using %s (guid %d, txg %d) as incremental base"
+                      + " for %s", base.source.joined, base.source.guid,
+                      base.source.createtxg, destination)
+        if base.newer:
+            names = ", ".join([s.name for s in base.newer])
+            if not rollback:
+                raise Exception(
+                    "destination %s has diverged from %s after %s (%s)" % (
+                        destination, source, base.destination.name, names))
+            self.log.warning("Rolling back %s to %s, discarding %s",
+                             destination, base.destination.name, names)
+        return base
+
+    def _expected(self, source: str, destination: str,
+                  ssnaps: Dict[str, List[SnapshotInfo]],
+                  dsnaps: Dict[str, List[SnapshotInfo]],
+                  bookmark=False, szfs: ZFS = None,
+                  dzfs: ZFS = None) -> List[Tuple[str, str]]:
+        # datasets are named like the cache protection counts them
+        szfs = szfs if szfs else self.zfs
+        dzfs = dzfs if dzfs else self.zfs
+        keeps = []
+        for (child, snapshots) in ssnaps.items():
+            target = destination + child[len(source):]
+            base = find_incremental_base(snapshots, dsnaps.get(target, []))
+            if not base:
+                continue
+            # bookmarked sources release their snapshot after the copy
+            if not bookmark and not base.source.bookmark:
+                keeps.append((szfs.key(child), base.source.name))
+            keeps.append((dzfs.key(target), base.destination.name))
+        return keeps
+
+    @staticmethod
+    def _up_to_date(ssnap: SnapshotInfo, base: IncrementalBase) -> bool:
+        return (base is not None and not base.newer
+                and base.source.guid == ssnap.guid)
+
+
+class Copy(CopyBase):
+    def __init__(self, name: str, file: str,
+                 enabled: bool, globalCfg, cfg: ET.Element):
+        super().__init__(name, file, JobType.copy, enabled, globalCfg, cfg)
+
+        destination = cfg.find("destination")
+        replicate = cfg.find("replicate")
+        parallel = cfg.find("parallel")
+        bookmark = cfg.find("bookmark")
+        verify = cfg.find("verify")
 
         if destination is None:
-            self.log.critical(missing_option, destination)
-            exit(1)
+            raise ConfigError(missing_option % "destination")
         try:
             self._destination = DestinationDataset(destination)
         except KeyError as e:
-            self.log.critical(str(e))
-            exit(1)
+            raise ConfigError(str(e))
 
         self._replicate = replicate is not None
-        self._incremental = incremental is not None
 
-    @property
-    def source(self): return self._source
+        self._parallel = parallel is not None
+        self._workers = 1
+        if self._parallel:
+            if self._replicate:
+                raise ConfigError("<parallel> and <replicate> are "
+                                  "mutually exclusive")
+            self._workers = max(int(parallel.attrib.get("workers", 4)), 1)
+
+        self._bookmark = bookmark is not None
+        if self._bookmark and self._replicate:
+            raise ConfigError("<bookmark> cannot be used with <replicate>")
+
+        self._verify = None
+        if verify is not None:
+            self._verify = verify.attrib.get("algorithm", "blake2b")
+            if self._verify not in hashlib.algorithms_available:
+                raise ConfigError("Unknown hash algorithm %s" % self._verify)
+        self._verifications: List[Dict[str, str]] = []
 
     @property
     def destination(self): return self._destination
@@ -46,18 +196,55 @@ class Copy(JobBase):
     def replicate(self): return self._replicate
 
     @property
-    def incremental(self): return self._incremental
+    def parallel(self): return self._parallel
+
+    @property
+    def workers(self): return self._workers
+
+    @property
+    def bookmark(self): return self._bookmark
+
+    @property
+    def verify(self): return self._verify
+
+    @property
+    def transport(self) -> Transport:
+        return self._transport(self.destination)
 
-    @lock_dataset("source")
-    @lock_dataset("destination")
-    def _copy(self, source, source_snap, destination, dest_snap):
+    @property
+    def dzfs(self) -> ZFS: return self.transport.zfs
+
+    def pools(self) -> List[str]:
+        return self._local_pools([self.destination])
+
+    def replicas(self) -> List[Replica]:
+        return [Replica(self.source.joined, self.zfs,
+                        self.destination.joined, self.dzfs,
+                        recurse=self.replicate)]
+
+    def expected_keeps(self) -> List[Tuple[str, str]]:
+        if not self.incremental:
+            return []
+        source = self.source.joined
+        destination = self.destination.joined
+        return self._expected(
+            source, destination,
+            self._snapshots(source, recurse=self.parallel,
+                            bookmarks=self.bookmark),
+            self._snapshots(destination, recurse=self.parallel,
+                            zfs=self.dzfs),
+            bookmark=self.bookmark, dzfs=self.dzfs)
+
+    def _copy(self, source, source_snap, destination, dest_snap,
+              digest: StreamDigest = None):
         return self.zfs.copy(source=source.joined, snapshot=source_snap,
                              target=destination.joined,
                              incremental=dest_snap,
                              replicate=self.replicate,
-                             rollback=destination.rollback,
-                             overwrites=destination.overwrite_properties,
-                             ignores=destination.ignore_properties)
+                             rollback=self.destination.rollback,
+                             overwrites=self.destination.overwrite_properties,
+                             ignores=self.destination.ignore_properties,
+                             transport=self.transport, digest=digest)
 
     def _before(self) -> bool:
         args = {
@@ -71,98 +258,324 @@ class Copy(JobBase):
             "source": self.source.joined,
             "source_snapshot": source_snap,
             "destination": self.destination.joined,
-            "destination_snapshot": dest_snap,
+            "destination_snapshot": dest_snap if dest_snap else "",
         }
+        if self.verify:
+            # single copies pass their digest and guids as well
+            verifications = self._verifications
+            args["verified"] = "yes" if all(
+                [v["verified"] == "yes" for v in verifications]) else "no"
+            if len(verifications) == 1:
+                args.update(verifications[0])
         return self.globalCfg.events.run("after_copy", args=args) == 0
 
-    def run(self, *args, **kwargs):
-        self.log.info("Copying %s to %s",
-                      self.source.joined, self.destination.joined)
-
-        if not self._before():
-            self._log.error("before event failed")
-            return
-
-        if not self._check_dataset(self.source.joined,
-                                   msg="Source dataset '%s' does not exist!"):
-            return
-        if not self._check_dataset(
-                self.destination.joined,
-                msg="Destination dataset '%s' does not exist!"):
-            return
-
-        ssnap = self.zfs.datasets(dataset=self.source.joined, snapshot=True,
-                                  options=["name"], sort="name",
-                                  sort_ascending=True)
-        if not ssnap:
-            self.log.error("Source '%s' has no snapshots, cannot copy!",
-                           self.source.joined)
-            return
-        ssnap = list([s["name"].split("@")[1] for s in ssnap])
+    def _verify_copy(self, source: Dataset, ssnap: SnapshotInfo,
+                     destination: Dataset, digest: StreamDigest):
+        # the received snapshots have to carry the guids of the sent
+        # ones. Listed without the inventory, it may not know them yet.
+        sroot = source.joined
+        droot = destination.joined
+        if self.replicate:
+            stables = self.zfs.snapshot_tables(sroot, recurse=True) or {}
+        else:
+            stables = {sroot: [ssnap]}
+        dtables = self.dzfs.snapshot_tables(
+            droot, recurse=self.replicate) or {}
 
-        if self.incremental:
-            dsnap = self.zfs.datasets(dataset=self.destination.joined,
-                                      snapshot=True, options=["name"],
-                                      sort="name", sort_ascending=True)
-            if not dsnap:
-                self.log.info("Destination '%s' has no snapshots,"
-                              + " cannot do incremental copy!",
-                              self.destination.joined)
-                dsnap = None
+        checked = time.time()
+        pairs = []
+        for (child, table) in sorted(stables.items()):
+            if self.replicate:
+                i = table.position(ssnap.name)
+                if i is None:
+                    continue
+                sguid = table.guid(i)
             else:
-                dsnap = dsnap[-1]["name"].split("@")[1]
-                if dsnap not in ssnap:
-                    self.log.info("Destination snapshot '%s' not available"
-                                  + " on source anymore."
-                                  + " Cannot do incremental copy!",
-                                  self.destination.joined)
-                    dsnap = None
+                sguid = ssnap.guid
+            target = droot + child[len(sroot):]
+            dtable = dtables.get(target)
+            i = dtable.position(ssnap.name) if dtable is not None else None
+            pairs.append((child, sguid, target,
+                          dtable.guid(i) if i is not None else None))
 
-        ssnap = ssnap[-1]
+        verified = all([sguid == dguid for (_, sguid, _, dguid) in pairs])
+        for (child, sguid, target, dguid) in pairs:
+            if sguid != dguid:
+                self.log.error("%s@%s has guid %s instead of %d",
+                               target, ssnap.name, dguid, sguid)
+        if verified:
+            self.log.info("Verified %s: %d guids match, %s %s of %s",
+                          ssnap.joined, len(pairs), digest.algorithm,
+                          digest.hexdigest, humanfriendly.format_size(
+                              digest.bytes, binary=True))
 
-        if dsnap and dsnap == ssnap:
-            self.log.info("Source and destination snapshots equal."
-                          + " Nothing to do!")
+        self._verifications.append({
+            "verified": "yes" if verified else "no",
+            "digest": "%s:%s" % (digest.algorithm, digest.hexdigest),
+            "stream_bytes": str(digest.bytes),
+            "source_guid": str(ssnap.guid),
+            "destination_guid": str(pairs[0][3]) if pairs else "",
+        })
+        if not self.really:
             return
+        with self.cache as cache:
+            for (child, sguid, target, dguid) in pairs:
+                cache.verification_add(
+                    self.owner, child, ssnap.name,
+                    self._destination_key(self.destination, target), sguid,
+                    dguid, digest.algorithm, digest.hexdigest,
+                    digest.bytes, sguid == dguid, checked)
 
-        self.log.debug("Using source snapshot %s@%s",
-                       self.source.joined, ssnap)
+    def _release(self, source: Dataset, ssnap: SnapshotInfo,
+                 destination: Dataset, bookmarked: bool):
+        # the bookmark is enough to send incremental streams from,
+        # so the source snapshot doesn't have to be kept any longer
+        if not bookmarked:
+            if not self.zfs.bookmark(source.joined, ssnap.name):
+                self.log.warn("Could not bookmark %s, keeping snapshot",
+                              ssnap.joined)
+                return
+        self.protection.release(self.zfs, source.joined, [ssnap.name],
+                                self.owner)
+        if not self.really:
+            return
+        with self.cache as cache:
+            cache.bookmark_add(source.joined, ssnap.name,
+                               self._destination_key(self.destination,
+                                                     destination.joined))
 
-        if dsnap:
-            self.log.debug("Using destination snapshot %s@%s"
-                           + " for incremental copy",
-                           self.destination.joined, dsnap)
+    def _transfer(self, source: Dataset, ssnap: SnapshotInfo,
+                  destination: Dataset, base: IncrementalBase = None,
+                  bookmarked=False):
+        self._throttle("copy of %s" % ssnap.joined)
+        if base and base.newer:
+            if not self.dzfs.rollback(destination.joined,
+                                      base.destination.name):
+                raise Exception("rollback of %s to %s failed" % (
+                    destination.joined, base.destination.name))
 
-        if self.really:
-            # we mark our new source snapshot before copy
-            # to keep us running into trouble
-            with self.cache as cache:
-                cache.snapshot_keep_increase(self.source.joined, ssnap)
-                cache.snapshot_keep_increase(self.destination.joined, ssnap)
+        # we mark our new source snapshot before copy
+        # to keep us running into trouble
+        self._protect(self.zfs, source.joined, [ssnap.name], self.owner,
+                      recurse=self.replicate)
 
+        started = time.time()
+        size = self.zfs.send_size(source.joined, ssnap.name,
+                                  base.reference if base else None,
+                                  self.replicate) if self.really else None
+        digest = StreamDigest(self.verify) if self.verify else None
         try:
-            self._copy(source=self.source, source_snap=ssnap,
-                       destination=self.destination, dest_snap=dsnap)
+            if self._copy(source=source, source_snap=ssnap.name,
+                          destination=destination,
+                          dest_snap=base.reference if base else None,
+                          digest=digest):
+                raise Exception("copy of %s to %s failed" % (
+                    ssnap.joined, destination.joined))
         except Exception as e:
+            self._record(source.joined, "copy", started,
+                         snapshot=ssnap.name, size=size, exitcode=1)
+
             # log exception so user knows what's going on
             self._log.error("Catched exception on copy, decreasing counters..")
             self._log.exception(e)
 
-            if self.really:
-                # decrease snapshot counter again on failure
-                with self.cache as cache:
-                    cache.snapshot_keep_decrease(self.source.joined, ssnap)
-                    cache.snapshot_keep_decrease(self.destination.joined,
-                                                 ssnap)
+            # unprotect snapshot again on failure
+            self.protection.release(self.zfs, source.joined, [ssnap.name],
+                                    self.owner, recurse=self.replicate)
 
             # re-raise exception
             raise
 
-        if dsnap and self.really:
+        self._record(source.joined, "copy", started, snapshot=ssnap.name,
+                     size=digest.bytes if digest and self.really else size)
+        # the received snapshot exists only now
+        self._protect(self.dzfs, destination.joined, [ssnap.name],
+                      self.owner, recurse=self.replicate)
+        if digest and self.really:
+            self._verify_copy(source, ssnap, destination, digest)
+
+        if self.bookmark:
+            self._release(source, ssnap, destination, bookmarked)
+
+        if base:
             # now demark old snapshot
-            with self.cache as cache:
-                cache.snapshot_keep_decrease(self.source.joined, dsnap)
-                cache.snapshot_keep_decrease(self.destination.joined, dsnap)
+            if not base.source.bookmark and not self.bookmark:
+                self.protection.release(self.zfs, source.joined,
+                                        [base.source.name], self.owner,
+                                        recurse=self.replicate)
+            self.protection.release(self.dzfs, destination.joined,
+                                    [base.destination.name], self.owner,
+                                    recurse=self.replicate)
+
+    def _prepare(self, source: str, destination: str,
+                 ssnaps: List[SnapshotInfo], dsnaps: List[SnapshotInfo]
+                 ) -> Tuple[SnapshotInfo, IncrementalBase]:
+        ssnap = latest_snapshot(ssnaps)
+        if not ssnap:
+            return (None, None)
+        base = None
+        if self.incremental:
+            base = self._incremental_base(source, destination,
+                                          ssnaps, dsnaps,
+                                          self.destination.rollback_base)
+        return (ssnap, base)
+
+    @staticmethod
+    def _bookmarked(ssnap: SnapshotInfo,
+                    ssnaps: List[SnapshotInfo]) -> bool:
+        return any([s.bookmark and s.guid == ssnap.guid for s in ssnaps])
+
+    def _copy_child(self, source: str, destination: str,
+                    ssnaps: List[SnapshotInfo],
+                    dsnaps: List[SnapshotInfo]) -> bool:
+        (ssnap, base) = self._prepare(source, destination, ssnaps, dsnaps)
+        if not ssnap:
+            self.log.warn("Source '%s' has no snapshots, skipping", source)
+            return False
+        if self._up_to_date(ssnap, base):
+            self.log.debug("%s is up to date with %s",
+                           destination, ssnap.joined)
+            return False
+
+        self.log.info("Copying %s to %s%s", ssnap.joined, destination,
+                      " from %s" % base.reference if base else "")
+        self._transfer(source=Dataset(dataset=source), ssnap=ssnap,
+                       destination=Dataset(dataset=destination), base=base,
+                       bookmarked=self._bookmarked(ssnap, ssnaps))
+        return True
+
+    def _run_parallel(self):
+        sroot = self.source.joined
+        droot = self.destination.joined
+
+        children = self.zfs.datasets(dataset=sroot, recurse=True,
+                                     options=["name"], sort="name",
+                                     sort_ascending=True)
+        children = list([c["name"] for c in children or []])
+        ssnaps = self._snapshots(sroot, recurse=True, bookmarks=self.bookmark)
+        dsnaps = self._snapshots(droot, recurse=True, zfs=self.dzfs) \
+            if self.incremental else {}
+
+        # children are only started once their parent has been copied,
+        # so every receive finds its parent on the destination
+        kids: Dict[str, List[str]] = {}
+        for child in children:
+            if child == sroot:
+                continue
+            parent = child.rsplit("/", 1)[0]
+            kids.setdefault(parent, []).append(child)
+
+        def subtree(child: str) -> List[str]:
+            result = []
+            for kid in kids.get(child, []):
+                result += [kid] + subtree(kid)
+            return result
+
+        copied, failed = 0, []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            def submit(child):
+                destination = droot + child[len(sroot):]
+                future = pool.submit(self._copy_child, child, destination,
+                                     ssnaps.get(child, []),
+                                     dsnaps.get(destination, []))
+                running[future] = child
+
+            running = {}
+            submit(sroot)
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    child = running.pop(future)
+                    try:
+                        if future.result():
+                            copied += 1
+                    except Exception as e:
+                        self.log.error("Copy of %s failed: %s", child, e)
+                        failed.append(child)
+                        # nothing below a failed parent can be received
+                        skipped = subtree(child)
+                        if skipped:
+                            self.log.error("Skipping %d datasets below %s:"
+                                           + " %s", len(skipped), child,
+                                           ", ".join(skipped))
+                            failed += skipped
+                        continue
+                    for kid in kids.get(child, []):
+                        submit(kid)
+
+        self.log.info("Copied %d of %d datasets from %s to %s",
+                      copied, len(children), sroot, droot)
+        if failed:
+            raise Exception("copy of %d datasets failed: %s" % (
+                len(failed), ", ".join(failed)))
 
-        if not self._after(ssnap, dsnap):
+    def _run_single(self) -> Tuple[str, str]:
+        source = self.source.joined
+        destination = self.destination.joined
+        ssnaps = self._snapshots(source, bookmarks=self.bookmark).get(
+            source, [])
+        dsnaps = self._snapshots(destination, zfs=self.dzfs).get(
+            destination, []) if self.incremental else []
+
+        (ssnap, base) = self._prepare(source, destination, ssnaps, dsnaps)
+        if not ssnap:
+            self.log.error("Source '%s' has no snapshots, cannot copy!",
+                           source)
+            return None
+
+        if self._up_to_date(ssnap, base):
+            self.log.info("Source and destination snapshots equal."
+                          + " Nothing to do!")
+            return None
+
+        self.log.debug("Using source snapshot %s", ssnap.joined)
+
+        if base:
+            self.log.debug("Using destination snapshot %s@%s"
+                           + " for incremental copy",
+                           destination, base.destination.name)
+
+        self._transfer(source=self.source, ssnap=ssnap,
+                       destination=self.destination, base=base,
+                       bookmarked=self._bookmarked(ssnap, ssnaps))
+        return (ssnap.name, base.destination.name if base else None)
+
+    def run(self, *args, **kwargs):
+        self.log.info("Copying %s to %s",
+                      self.source.joined, self.destination.joined)
+
+        if not self._before():
+            self._log.error("before event failed")
+            return
+
+        if not self._check_dataset(self.source.joined,
+                                   msg="Source dataset '%s' does not exist!"):
+            return
+        if not self._check_dataset(
+                self.destination.joined,
+                msg="Destination dataset '%s' does not exist!",
+                zfs=self.dzfs):
+            return
+
+        # the whole tree is locked once for recursive copies
+        self._verifications = []
+        targets = [self.source.joined, self._destination_key(self.destination)]
+        recursive = self.replicate or self.parallel
+        with self._locks(datasets=[] if recursive else targets,
+                         subtrees=targets if recursive else []):
+            if self.parallel:
+                self._run_parallel()
+                snapshots = ("", "")
+            else:
+                snapshots = self._run_single()
+        if not snapshots:
+            return
+
+        if not self._after(*snapshots):
             self._log.error("after event failed")
+
+        unverified = list([v for v in self._verifications
+                           if v["verified"] != "yes"])
+        if unverified:
+            raise Exception("%d of %d copies could not be verified" % (
+                len(unverified), len(self._verifications)))
@@ -0,0 +1,242 @@
+import time
+from typing import Dict, List, Tuple
+import xml.etree.ElementTree as ET
+
+from .base import JobType
+from .copy import CopyBase
+from ..helpers import ConfigError, missing_option
+from ..models.dataset import DestinationDataset
+from ..models.snapshot import SnapshotInfo, IncrementalBase, latest_snapshot
+from ..status import Replica
+
+
+class Fanout(CopyBase):
+    def __init__(self, name: str, file: str,
+                 enabled: bool, globalCfg, cfg: ET.Element):
+        super().__init__(name, file, JobType.fanout, enabled, globalCfg, cfg)
+
+        destinations = cfg.findall("destination")
+        if not destinations:
+            raise ConfigError(missing_option % "destination")
+        try:
+            self._destinations = list([DestinationDataset(d)
+                                       for d in destinations])
+        except KeyError as e:
+            raise ConfigError(str(e))
+
+    @property
+    def destinations(self): return self._destinations
+
+    def pools(self) -> List[str]:
+        return self._local_pools(self.destinations)
+
+    def replicas(self) -> List[Replica]:
+        return list([Replica(self.source.joined, self.zfs, d.joined,
+                             self._transport(d).zfs)
+                     for d in self.destinations])
+
+    def _owner(self, destination: DestinationDataset) -> str:
+        # every destination needs its own hold on the shared source
+        return "%s:%s" % (self.owner, self._destination_key(destination))
+
+    def expected_keeps(self) -> List[Tuple[str, str]]:
+        return list([(d, s) for (d, s, _) in self.expected_holds()])
+
+    def expected_holds(self) -> List[Tuple[str, str, str]]:
+        if not self.incremental:
+            return []
+        source = self.source.joined
+        ssnaps = self._snapshots(source)
+        holds = []
+        for destination in self.destinations:
+            zfs = self._transport(destination).zfs
+            owner = self._owner(destination)
+            holds += list([(d, s, owner) for (d, s) in self._expected(
+                source, destination.joined, ssnaps,
+                self._snapshots(destination.joined, zfs=zfs), dzfs=zfs)])
+        return holds
+
+    def _before(self, destination: DestinationDataset) -> bool:
+        args = {
+            "source": self.source.joined,
+            "destination": destination.joined,
+        }
+        return self.globalCfg.events.run("before_copy", args=args) == 0
+
+    def _after(self, destination: DestinationDataset,
+               source_snap: str, dest_snap: str) -> bool:
+        args = {
+            "source": self.source.joined,
+            "source_snapshot": source_snap,
+            "destination": destination.joined,
+            "destination_snapshot": dest_snap if dest_snap else "",
+        }
+        return self.globalCfg.events.run("after_copy", args=args) == 0
+
+    def _rollback(self, ssnap: SnapshotInfo,
+                  targets: List[Tuple[DestinationDataset, IncrementalBase]],
+                  failed: List[str]
+                  ) -> List[Tuple[DestinationDataset, IncrementalBase]]:
+        # a destination that can't be rolled back to its base is left
+        # out of the send, the others still get it
+        ready = []
+        for (destination, base) in targets:
+            if base and base.newer:
+                try:
+                    ok = self._transport(destination).zfs.rollback(
+                        destination.joined, base.destination.name)
+                except Exception as e:
+                    self.log.exception(e)
+                    ok = False
+                if not ok:
+                    self.log.error("Rollback of %s to %s failed",
+                                   destination.joined,
+                                   base.destination.name)
+                    self.protection.release(self.zfs, self.source.joined,
+                                            [ssnap.name],
+                                            self._owner(destination))
+                    failed.append(destination.joined)
+                    continue
+            ready.append((destination, base))
+        return ready
+
+    def _send(self, ssnap: SnapshotInfo, reference: str,
+              targets: List[Tuple[DestinationDataset, IncrementalBase]]
+              ) -> List[str]:
+        source = self.source.joined
+        failed = []
+        protected = []
+        for (destination, base) in targets:
+            if self.protection.protect(self.zfs, source, [ssnap.name],
+                                       self._owner(destination)):
+                self.log.error("Could not protect %s for %s, skipping it",
+                               ssnap.joined, destination.joined)
+                failed.append(destination.joined)
+                continue
+            protected.append((destination, base))
+        targets = protected
+        if not targets:
+            return failed
+
+        self._throttle("send of %s" % ssnap.joined)
+        started = time.time()
+        size = self.zfs.send_size(source, ssnap.name, reference) \
+            if self.really else None
+        results = []
+        try:
+            with self._locks(datasets=[source] + list(
+                    [self._destination_key(d) for (d, _) in targets])):
+                targets = self._rollback(ssnap, targets, failed)
+                destinations = list([d for (d, _) in targets])
+                if destinations:
+                    self.log.info("Sending %s%s to %s", ssnap.joined,
+                                  " from %s" % reference if reference
+                                  else "",
+                                  ", ".join([d.joined for d in destinations]))
+                    results = self.zfs.fanout(source, ssnap.name, [{
+                        "target": d.joined,
+                        "rollback": d.rollback,
+                        "overwrites": d.overwrite_properties,
+                        "ignores": d.ignore_properties,
+                        "transport": self._transport(d),
+                    } for d in destinations], incremental=reference)
+        except Exception as e:
+            # the stream is shared, every receiver left failed with it
+            self._log.error("Catched exception on copy, decreasing counters..")
+            self._log.exception(e)
+            results = [True] * len(targets)
+        if not targets:
+            return failed
+        self._record(source, "fanout", started, snapshot=ssnap.name,
+                     size=size, exitcode=1 if any(results) else 0)
+
+        for (destination, base), fail in zip(targets, results):
+            owner = self._owner(destination)
+            if fail:
+                self.protection.release(self.zfs, source, [ssnap.name],
+                                        owner)
+                self.log.error("Copy to %s failed", destination.joined)
+                failed.append(destination.joined)
+                continue
+            dzfs = self._transport(destination).zfs
+            try:
+                self._protect(dzfs, destination.joined, [ssnap.name], owner)
+            except Exception as e:
+                # the old bases stay protected, nothing is lost
+                self.log.error("Copy to %s failed: %s", destination.joined,
+                               e)
+                failed.append(destination.joined)
+                continue
+            if base:
+                self.protection.release(self.zfs, source,
+                                        [base.source.name], owner)
+                self.protection.release(dzfs, destination.joined,
+                                        [base.destination.name], owner)
+            if not self._after(destination, ssnap.name,
+                               base.destination.name if base else None):
+                self._log.error("after event failed for %s",
+                                destination.joined)
+        return failed
+
+    def run(self, *args, **kwargs):
+        if not self.enabled:
+            return
+
+        source = self.source.joined
+        self.log.info("Copying %s to %d destinations",
+                      source, len(self.destinations))
+
+        if not self._check_dataset(source,
+                                   msg="Source dataset '%s' does not exist!"):
+            return
+
+        ssnaps = self._snapshots(source).get(source, [])
+        ssnap = latest_snapshot(ssnaps)
+        if not ssnap:
+            self.log.error("Source '%s' has no snapshots, cannot copy!",
+                           source)
+            return
+
+        # destinations sharing the same incremental base
+        # are served by a single zfs send
+        groups: Dict[str, List[Tuple[DestinationDataset,
+                                     IncrementalBase]]] = {}
+        failed = []
+        for destination in self.destinations:
+            if not self._before(destination):
+                self._log.error("before event failed for %s",
+                                destination.joined)
+                continue
+
+            zfs = self._transport(destination).zfs
+            if not self._check_dataset(
+                    destination.joined,
+                    msg="Destination dataset '%s' does not exist!",
+                    zfs=zfs):
+                continue
+
+            base = None
+            if self.incremental:
+                try:
+                    base = self._incremental_base(
+                        source, destination.joined, ssnaps,
+                        self._snapshots(destination.joined, zfs=zfs).get(
+                            destination.joined, []),
+                        destination.rollback_base)
+                except Exception as e:
+                    self.log.error(str(e))
+                    failed.append(destination.joined)
+                    continue
+            if self._up_to_date(ssnap, base):
+                self.log.info("%s is up to date. Nothing to do!",
+                              destination.joined)
+                continue
+            groups.setdefault(base.reference if base else None, []).append(
+                (destination, base))
+
+        for reference, targets in groups.items():
+            failed += self._send(ssnap, reference, targets)
+
+        if failed:
+            raise Exception("copy to %d destinations failed: %s" % (
+                len(failed), ", ".join(failed)))
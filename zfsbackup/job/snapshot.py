@@ -1,8 +1,12 @@
 import datetime
+import time
+from typing import List, Set, Tuple
 import xml.etree.ElementTree as ET
 
+import humanfriendly
+
 from .base import JobBase, JobType
-from ..helpers import missing_option
+from ..helpers import ConfigError, missing_option
 from ..models.dataset import Dataset
 
 
@@ -15,18 +19,81 @@ class Snapshot(JobBase):
         recursive = cfg.find("recursive")
 
         if target is None:
-            self.log.critical(missing_option, "target")
-            exit(1)
+            raise ConfigError(missing_option % "target")
         self._dataset = Dataset(cfg=target)
 
         self._recursive = recursive is not None
+        self._parse_naming(cfg.find("naming"))
+
+        self._skip_unchanged = False
+        self._threshold = 0
+        self._max_age: datetime.timedelta = None
+        skip = cfg.find("skip-unchanged")
+        if skip is not None:
+            self._skip_unchanged = True
+            try:
+                self._threshold = humanfriendly.parse_size(
+                    skip.attrib.get("threshold", "0"), binary=True)
+                if "max-age" in skip.attrib:
+                    self._max_age = datetime.timedelta(
+                        seconds=humanfriendly.parse_timespan(
+                            skip.attrib["max-age"]))
+            except (humanfriendly.InvalidSize,
+                    humanfriendly.InvalidTimespan) as e:
+                raise ConfigError(str(e))
 
     @property
     def dataset(self): return self._dataset
 
+    def pools(self) -> List[str]: return [self.dataset.pool]
+
     @property
     def recursive(self): return self._recursive
 
+    @property
+    def skip_unchanged(self): return self._skip_unchanged
+
+    @property
+    def threshold(self): return self._threshold
+
+    @property
+    def max_age(self): return self._max_age
+
+    def _due(self, now: datetime.datetime) -> Set[str]:
+        # datasets whose latest snapshot of our scheme is too old
+        tables = self._snapshot_tables(self.dataset.joined,
+                                       recurse=self.recursive)
+        due = set()
+        for (dataset, table) in tables.items():
+            index = self.naming.index(table)
+            if index and index[-1][0] <= now - self.max_age:
+                due.add(dataset)
+        return due
+
+    def _changed(self, now: datetime.datetime) -> Tuple[List[str], int]:
+        # written is the amount of data since the latest snapshot,
+        # a single listing covers the whole tree
+        datasets = self.zfs.datasets(dataset=self.dataset.joined,
+                                     recurse=self.recursive,
+                                     options=["name", "written"],
+                                     sort="name", sort_ascending=True,
+                                     parsable=True) or []
+        due = self._due(now) if self.max_age else set()
+        changed = []
+        for dataset in datasets:
+            (name, written) = (dataset["name"], dataset["written"])
+            if not isinstance(written, int) or written > self.threshold:
+                changed.append(name)
+            elif name in due:
+                self.log.debug("%s: forcing snapshot, max-age reached", name)
+                changed.append(name)
+            else:
+                self.log.debug("%s: skipped, %d bytes written", name,
+                               written)
+        self.log.info("%d of %d datasets changed", len(changed),
+                      len(datasets))
+        return (changed, len(datasets))
+
     def _before(self):
         args = {
             "dataset": self.dataset.joined,
@@ -51,8 +118,23 @@ class Snapshot(JobBase):
         if not self._check_dataset(self.dataset.joined):
             return
 
-        self.zfs.snapshot(self.dataset.joined, self._get_time(now),
-                          recurse=self.recursive)
+        started = time.time()
+        snapshot = self._get_time(now)
+        if not self.skip_unchanged:
+            ok = self.zfs.snapshot(self.dataset.joined, snapshot,
+                                   recurse=self.recursive)
+        else:
+            (changed, total) = self._changed(now)
+            if not changed:
+                ok = True
+                snapshot = None
+            elif len(changed) == total:
+                ok = self.zfs.snapshot(self.dataset.joined, snapshot,
+                                       recurse=self.recursive)
+            else:
+                ok = self.zfs.snapshot_datasets(changed, snapshot)
+        self._record(self.dataset.joined, "snapshot", started,
+                     snapshot=snapshot, exitcode=0 if ok else 1)
 
         if not self._after():
             self._log.error("after event failed")
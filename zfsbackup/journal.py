@@ -0,0 +1,144 @@
+import logging
+import random
+import time
+import xml.etree.ElementTree as ET
+from typing import Callable, Dict, List
+
+import humanfriendly
+
+from .cache import Cache
+
+
+class RetryPolicy:
+    def __init__(self, cfg: ET.Element = None, attempts=3, delay=60.0,
+                 max_delay=900.0, resume=6 * 3600.0):
+        if cfg is not None:
+            attempts = int(cfg.attrib.get("attempts", attempts))
+            delay = self._timespan(cfg, "delay", delay)
+            max_delay = self._timespan(cfg, "max-delay", max_delay)
+            resume = self._timespan(cfg, "resume", resume)
+        self._attempts = max(attempts, 1)
+        self._delay = delay
+        self._max_delay = max_delay
+        self._resume = resume
+
+    @staticmethod
+    def _timespan(cfg: ET.Element, name: str, default: float) -> float:
+        if name not in cfg.attrib:
+            return default
+        return humanfriendly.parse_timespan(cfg.attrib[name])
+
+    @property
+    def attempts(self): return self._attempts
+
+    @property
+    def delay(self): return self._delay
+
+    @property
+    def max_delay(self): return self._max_delay
+
+    @property
+    def resume(self): return self._resume
+
+    def backoff(self, attempt: int) -> float:
+        # exponential backoff with jitter, so jobs failing on the same
+        # cause don't all retry at once
+        delay = min(self._delay * 2 ** (attempt - 1), self._max_delay)
+        return random.uniform(delay / 2, delay)
+
+
+class Journal:
+    PENDING = "pending"
+    RUNNING = "running"
+    OK = "ok"
+    FAILED = "failed"
+    TIMEOUT = "timeout"
+
+    def __init__(self, cache: Callable[[], Cache], key: str,
+                 policy: RetryPolicy, really: bool):
+        self._cache = cache
+        self._key = key
+        self._policy = policy
+        self._really = really
+        self._id: int = None
+        # attempts of this run, the journal counts all attempts
+        self._tries: Dict[str, int] = {}
+        self._attempts: Dict[str, int] = {}
+        self._log = logging.getLogger("Journal")
+
+    @property
+    def log(self): return self._log
+
+    @property
+    def key(self): return self._key
+
+    @property
+    def policy(self): return self._policy
+
+    def start(self, jobs: List[str]) -> List[str]:
+        # returns the jobs still to run, an interrupted journal of the
+        # same invocation is picked up if it is recent enough
+        if not self._really:
+            return jobs
+        now = time.time()
+        with self._cache() as cache:
+            self._id = cache.journal_unfinished(
+                self._key, now - self._policy.resume)
+            if self._id is None:
+                self._id = cache.journal_create(self._key, now)
+                cache.journal_add_jobs(self._id, list(enumerate(jobs)), now)
+                return jobs
+            states = cache.journal_jobs(self._id)
+
+            self.log.info("Resuming interrupted run of '%s'", self._key)
+            remaining = []
+            for job in jobs:
+                (state, attempts) = states.get(job, (self.PENDING, 0))
+                self._attempts[job] = attempts
+                if state == self.OK:
+                    self.log.info("%s already finished", job)
+                    continue
+                remaining.append(job)
+            cache.journal_add_jobs(self._id, list(
+                [(len(states) + i, job) for (i, job)
+                 in enumerate([j for j in jobs if j not in states])]), now)
+        return remaining
+
+    def _update(self, job: str, state: str, next_retry: float = None,
+                error: str = None):
+        if not self._really:
+            return
+        with self._cache() as cache:
+            cache.journal_update(self._id, job, state,
+                                 self._attempts.get(job, 0),
+                                 next_retry=next_retry, error=error,
+                                 updated=time.time())
+
+    def running(self, job: str):
+        self._tries[job] = self._tries.get(job, 0) + 1
+        self._attempts[job] = self._attempts.get(job, 0) + 1
+        self._update(job, self.RUNNING)
+
+    def ok(self, job: str):
+        self._update(job, self.OK)
+
+    def failed(self, job: str, error: str) -> float:
+        # returns when to retry the job, None if it is out of attempts
+        tries = self._tries.get(job, 0)
+        if not self._really or tries >= self._policy.attempts:
+            self._update(job, self.FAILED, error=error)
+            return None
+        retry = time.time() + self._policy.backoff(tries)
+        self._update(job, self.FAILED, next_retry=retry, error=error)
+        return retry
+
+    def timed_out(self, job: str, error: str):
+        # a timed out job is not retried in the same run,
+        # whatever hung will most likely hang again
+        self._update(job, self.TIMEOUT, error=error)
+
+    def finish(self):
+        if not self._really:
+            return
+        with self._cache() as cache:
+            cache.journal_finish(self._id, time.time())
@@ -0,0 +1,130 @@
+import fcntl
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Dict, List
+from urllib.parse import quote
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class DatasetLock:
+    def __init__(self, lockdir: str, modes: Dict[str, int], timeout: float,
+                 really: bool, name: str):
+        self._lockdir = lockdir
+        self._modes = modes
+        self._timeout = timeout
+        self._really = really
+        self._fds: List[int] = []
+        self._log = logging.getLogger("Lock.%s" % name)
+
+    @property
+    def files(self): return sorted(self._modes)
+
+    def _flock(self, fd: int, mode: int, timeout: float):
+        if timeout == 0:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            return
+        if (timeout < 0
+                or threading.current_thread() is not threading.main_thread()):
+            # signals are only delivered to the main thread,
+            # everywhere else we block without a timeout
+            fcntl.flock(fd, mode)
+            return
+
+        def expired(signum, frame):
+            raise LockTimeout()
+
+        previous = signal.signal(signal.SIGALRM, expired)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            fcntl.flock(fd, mode)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    def acquire(self):
+        if not self._really:
+            for filename in self.files:
+                self._log.info("Would lock file %s (%s)", filename,
+                               "exclusive" if self._modes[filename]
+                               == fcntl.LOCK_EX else "shared")
+            return
+
+        started = time.monotonic()
+        try:
+            # a global order (sorted by path) keeps us free of deadlocks
+            for filename in self.files:
+                remaining = self._timeout
+                if self._timeout > 0:
+                    remaining = self._timeout - (time.monotonic() - started)
+                    if remaining <= 0:
+                        raise LockTimeout()
+                fd = os.open(os.path.join(self._lockdir, filename),
+                             os.O_RDWR | os.O_CREAT, 0o644)
+                self._fds.append(fd)
+                try:
+                    self._flock(fd, self._modes[filename], remaining)
+                except BlockingIOError:
+                    raise LockTimeout()
+        except LockTimeout:
+            self.release()
+            raise LockTimeout("could not lock %s within %ss" % (
+                ", ".join(self.files), self._timeout))
+
+        waited = time.monotonic() - started
+        self._log.log(logging.INFO if waited >= 1 else logging.DEBUG,
+                      "Acquired %d locks after %.3fs", len(self._fds), waited)
+
+    def release(self):
+        if not self._really:
+            self._log.info("Would unlock files %s", ", ".join(self.files))
+            return
+        while self._fds:
+            fd = self._fds.pop()
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return None
+
+
+class LockManager:
+    # Every dataset has two lock files: "tree" guards the whole subtree,
+    # "self" only the dataset itself. Operations take shared intention
+    # locks on the tree files of all ancestors, so a subtree lock on an
+    # ancestor excludes them while siblings don't block each other.
+    def __init__(self, lockdir: str, really: bool):
+        self._lockdir = lockdir
+        self._really = really
+
+    @staticmethod
+    def _filename(dataset: str, kind: str) -> str:
+        return "%s.%s.lock" % (quote(dataset, safe=""), kind)
+
+    def _intent(self, modes: Dict[str, int], dataset: str):
+        parts = dataset.split("/")
+        for i in range(1, len(parts)):
+            filename = self._filename("/".join(parts[:i]), "tree")
+            modes.setdefault(filename, fcntl.LOCK_SH)
+
+    def lock(self, datasets: List[str] = None, subtrees: List[str] = None,
+             timeout: float = -1, name: str = "zfsbackup") -> DatasetLock:
+        modes: Dict[str, int] = {}
+        for dataset in datasets or []:
+            self._intent(modes, dataset)
+            modes.setdefault(self._filename(dataset, "tree"), fcntl.LOCK_SH)
+            modes[self._filename(dataset, "self")] = fcntl.LOCK_EX
+        for dataset in subtrees or []:
+            self._intent(modes, dataset)
+            modes[self._filename(dataset, "tree")] = fcntl.LOCK_EX
+        return DatasetLock(self._lockdir, modes, timeout, self._really, name)
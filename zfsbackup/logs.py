@@ -0,0 +1,76 @@
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+
+TEXT_FORMAT = "%(asctime)-15s %(name)s [%(levelname)s]: %(message)s"
+
+# structured fields passed through the extra argument of log calls
+FIELDS = ["job", "dataset", "snapshot", "action", "duration", "count"]
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    # the stock prepare() folds the traceback into the message, keep it
+    # apart as text so the formatter can still put it in its own field
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class LogPipeline:
+    def __init__(self, level: str, fmt: str = "text"):
+        self._listener: logging.handlers.QueueListener = None
+
+        if fmt != "json":
+            logging.basicConfig(format=TEXT_FORMAT, level=level)
+            return
+
+        # records are formatted and written by a background thread,
+        # so jobs never block on a slow log sink
+        handler = logging.StreamHandler()
+        handler.setFormatter(JSONFormatter())
+        records = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(
+            records, handler, respect_handler_level=True)
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(RecordQueueHandler(records))
+        self._listener.start()
+        # exit() is used for fatal errors, flush whatever is queued
+        atexit.register(self.close)
+
+    def close(self):
+        if not self._listener:
+            return
+        self._listener.stop()
+        self._listener = None
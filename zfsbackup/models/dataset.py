@@ -2,6 +2,7 @@ import xml.etree.ElementTree as ET
 
 from ..helpers import missing_attribute
 from ..runner.zfs import ZFS
+from ..transport import check_transport
 
 
 class Dataset:
@@ -41,9 +42,19 @@ class DestinationDataset(Dataset):
         super().__init__(cfg=cfg)
 
         rollback = cfg.find("rollback")
+        rollback_base = cfg.find("rollback-to-base")
         properties = cfg.find("properties")
+        transport = cfg.find("transport")
 
         self._rollback = rollback is not None
+        self._rollback_base = rollback_base is not None
+
+        self._transport = {"type": "local"}
+        if transport is not None:
+            self._transport.update(transport.attrib)
+            if transport.text and transport.text.strip():
+                self._transport["command"] = transport.text.strip()
+        check_transport(self._transport)
 
         self._overwrite = {}
         self._ignore = []
@@ -61,8 +72,14 @@ class DestinationDataset(Dataset):
     @property
     def rollback(self): return self._rollback
 
+    @property
+    def rollback_base(self): return self._rollback_base
+
     @property
     def overwrite_properties(self): return self._overwrite
 
     @property
     def ignore_properties(self): return self._ignore
+
+    @property
+    def transport(self): return self._transport
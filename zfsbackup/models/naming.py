@@ -0,0 +1,101 @@
+import bisect
+import datetime
+import xml.etree.ElementTree as ET
+from typing import List, Tuple
+
+from .snapshot import SnapshotTable
+
+
+class NamingScheme:
+    # resolution -> (strftime format, number of two digit fields after
+    # the four digit year)
+    RESOLUTIONS = {
+        "day": ("%Y%m%d", 2),
+        "hour": ("%Y%m%d%H", 3),
+        "minute": ("%Y%m%d%H%M", 4),
+        "second": ("%Y%m%d%H%M%S", 5),
+    }
+    TIME_SOURCES = ["name", "creation"]
+
+    def __init__(self, cfg: ET.Element = None, prefix: str = "",
+                 resolution: str = "minute", suffix: str = "",
+                 time: str = "name"):
+        if cfg is not None:
+            prefix = cfg.attrib.get("prefix", prefix)
+            resolution = cfg.attrib.get("resolution", resolution)
+            suffix = cfg.attrib.get("suffix", suffix)
+            time = cfg.attrib.get("time", time)
+
+        if resolution not in self.RESOLUTIONS:
+            raise KeyError("unknown naming resolution '%s'" % resolution)
+        if time not in self.TIME_SOURCES:
+            raise KeyError("unknown naming time source '%s'" % time)
+
+        self._prefix = prefix
+        self._resolution = resolution
+        self._suffix = suffix
+        self._time = time
+
+        (self._format, self._fields) = self.RESOLUTIONS[resolution]
+        start = len(prefix)
+        width = 4 + 2 * self._fields
+        self._length = start + width + len(suffix)
+        self._digits = slice(start, start + width)
+
+    @property
+    def prefix(self): return self._prefix
+
+    @property
+    def resolution(self): return self._resolution
+
+    @property
+    def suffix(self): return self._suffix
+
+    @property
+    def time(self): return self._time
+
+    def format(self, now: datetime.datetime) -> str:
+        return "%s%s%s" % (self._prefix, now.strftime(self._format),
+                           self._suffix)
+
+    def owns(self, name: str) -> bool:
+        return (len(name) == self._length
+                and name.startswith(self._prefix)
+                and name.endswith(self._suffix)
+                and name[self._digits].isdigit())
+
+    def parse(self, name: str) -> datetime.datetime:
+        # strptime is way too slow for large snapshot lists, as every
+        # field has a fixed width we split a single integer instead
+        if not self.owns(name):
+            return None
+        value = int(name[self._digits])
+        fields = []
+        for _ in range(self._fields):
+            (value, field) = divmod(value, 100)
+            fields.append(field)
+        fields.append(value)
+        try:
+            return datetime.datetime(*reversed(fields))
+        except ValueError:
+            return None
+
+    def index(self, snapshots: SnapshotTable
+              ) -> List[Tuple[datetime.datetime, str]]:
+        index = []
+        creation = snapshots.column("creation")
+        for (i, name) in enumerate(snapshots.names):
+            time = self.parse(name)
+            if time is None:
+                continue
+            if self._time == "creation":
+                time = datetime.datetime.fromtimestamp(
+                    creation[i], datetime.timezone.utc).replace(tzinfo=None)
+            index.append((time, name))
+        index.sort()
+        return index
+
+    @staticmethod
+    def older_than(index: List[Tuple[datetime.datetime, str]],
+                   until: datetime.datetime) -> int:
+        return bisect.bisect_left(index, (until, ""))
@@ -0,0 +1,224 @@
+from array import array
+import bisect
+import sys
+from typing import Dict, Iterable, List, Union
+
+
+class SnapshotInfo:
+    def __init__(self, dataset: str, name: str, guid: int, createtxg: int,
+                 bookmark=False):
+        self._dataset = dataset
+        self._name = name
+        self._guid = guid
+        self._createtxg = createtxg
+        self._bookmark = bookmark
+
+    @staticmethod
+    def parse(row: Dict[str, Union[str, int]]) -> "SnapshotInfo":
+        name = row["name"]
+        bookmark = "#" in name
+        (dataset, name) = name.split("#" if bookmark else "@", 1)
+        return SnapshotInfo(dataset, name, int(row["guid"]),
+                            int(row["createtxg"]), bookmark=bookmark)
+
+    @property
+    def dataset(self): return self._dataset
+
+    @property
+    def name(self): return self._name
+
+    @property
+    def guid(self): return self._guid
+
+    @property
+    def createtxg(self): return self._createtxg
+
+    @property
+    def bookmark(self): return self._bookmark
+
+    @property
+    def joined(self):
+        return "%s%s%s" % (self._dataset, "#" if self._bookmark else "@",
+                           self._name)
+
+
+class SnapshotTable:
+    # snapshots of a single dataset sorted by createtxg. Instead of one
+    # dict per snapshot the dataset is stored once, names are interned
+    # and the numeric properties are kept in arrays, unknown values
+    # ("-") are stored as -1 (0 for guids, which are never 0).
+    COLUMNS = ["creation", "createtxg", "guid", "written"]
+    OPTIONS = ["name"] + COLUMNS
+
+    def __init__(self, dataset: str):
+        self._dataset = sys.intern(dataset)
+        self._names: List[str] = []
+        self._index: Dict[str, int] = {}
+        self._guids: Dict[int, int] = None
+        self._columns = dict({c: array("q") for c in self.COLUMNS})
+
+    @staticmethod
+    def _int(value: Union[str, int], unknown=-1) -> int:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return unknown
+
+    def append(self, name: str, creation: Union[str, int] = -1,
+               createtxg: Union[str, int] = -1, guid: Union[str, int] = 0,
+               written: Union[str, int] = -1):
+        name = sys.intern(name)
+        guid = self._int(guid, unknown=0)
+        # guids are unsigned 64 bit, the array is signed
+        if guid >= 1 << 63:
+            guid -= 1 << 64
+        self._index[name] = len(self._names)
+        self._names.append(name)
+        self._columns["creation"].append(self._int(creation))
+        self._columns["createtxg"].append(self._int(createtxg))
+        self._columns["guid"].append(guid)
+        self._columns["written"].append(self._int(written))
+        self._guids = None
+
+    @staticmethod
+    def group(rows: Iterable[Dict[str, Union[str, int]]]
+              ) -> Dict[str, "SnapshotTable"]:
+        # rows of a (recursive) snapshot listing sorted by createtxg
+        tables: Dict[str, SnapshotTable] = {}
+        for row in rows:
+            (dataset, name) = row["name"].split("@", 1)
+            table = tables.get(dataset)
+            if table is None:
+                table = tables[dataset] = SnapshotTable(dataset)
+            table.append(name, row.get("creation"), row.get("createtxg"),
+                         row.get("guid"), row.get("written"))
+        return tables
+
+    @staticmethod
+    def parse(lines: Iterable[str]) -> Dict[str, "SnapshotTable"]:
+        # output of zfs list -H -p -o name,creation,createtxg,guid,written
+        tables: Dict[str, SnapshotTable] = {}
+        for line in lines:
+            if not line:
+                continue
+            (name, creation, createtxg, guid, written) = line.split("\t")
+            (dataset, name) = name.split("@", 1)
+            table = tables.get(dataset)
+            if table is None:
+                table = tables[dataset] = SnapshotTable(dataset)
+            table.append(name, creation, createtxg, guid, written)
+        return tables
+
+    @property
+    def dataset(self): return self._dataset
+
+    @property
+    def names(self) -> List[str]: return self._names
+
+    def column(self, name: str) -> array: return self._columns[name]
+
+    def position(self, name: str) -> int:
+        return self._index.get(name)
+
+    def guid(self, i: int) -> int:
+        guid = self._columns["guid"][i]
+        return guid + (1 << 64) if guid < 0 else guid
+
+    def find_guid(self, guid: int) -> int:
+        # position of the snapshot with the given guid, None if missing
+        if self._guids is None:
+            self._guids = {}
+            for (i, value) in enumerate(self._columns["guid"]):
+                self._guids.setdefault(value, i)
+        if guid >= 1 << 63:
+            guid -= 1 << 64
+        return self._guids.get(guid)
+
+    def bisect_txg(self, txg: int) -> int:
+        # number of snapshots created before txg
+        return bisect.bisect_left(self._columns["createtxg"], txg)
+
+    def bisect_creation(self, timestamp: int) -> int:
+        # number of snapshots created before timestamp,
+        # creation times grow with the txg
+        return bisect.bisect_left(self._columns["creation"], timestamp)
+
+    def _info(self, i: int) -> SnapshotInfo:
+        return SnapshotInfo(self._dataset, self._names[i], self.guid(i),
+                            self._columns["createtxg"][i])
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name: str):
+        return name in self._index
+
+    def __getitem__(self, i: Union[int, slice]
+                    ) -> Union[SnapshotInfo, List[SnapshotInfo]]:
+        if isinstance(i, slice):
+            return list([self._info(j)
+                         for j in range(*i.indices(len(self)))])
+        return self._info(range(len(self))[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._info(i)
+
+    def __reversed__(self):
+        for i in range(len(self) - 1, -1, -1):
+            yield self._info(i)
+
+
+class IncrementalBase:
+    def __init__(self, source: SnapshotInfo, destination: SnapshotInfo,
+                 newer: List[SnapshotInfo]):
+        self._source = source
+        self._destination = destination
+        self._newer = newer
+
+    @property
+    def source(self) -> SnapshotInfo: return self._source
+
+    @property
+    def destination(self) -> SnapshotInfo: return self._destination
+
+    @property
+    def newer(self) -> List[SnapshotInfo]: return self._newer
+
+    @property
+    def reference(self) -> str:
+        # bookmarks have to be referenced by their full name
+        return (self._source.joined if self._source.bookmark
+                else self._source.name)
+
+
+def latest_snapshot(snapshots: List[SnapshotInfo]) -> SnapshotInfo:
+    for snapshot in reversed(snapshots):
+        if not snapshot.bookmark:
+            return snapshot
+    return None
+
+
+def find_incremental_base(source: List[SnapshotInfo],
+                          destination: List[SnapshotInfo]) -> IncrementalBase:
+    # both lists are expected to be sorted by createtxg
+    if isinstance(source, SnapshotTable):
+        # tables hold no bookmarks and know their guids already
+        for i in range(len(destination) - 1, -1, -1):
+            match = source.find_guid(destination[i].guid)
+            if match is not None:
+                return IncrementalBase(source[match], destination[i],
+                                       destination[i + 1:])
+        return None
+
+    guids: Dict[int, SnapshotInfo] = {}
+    for snapshot in source:
+        known = guids.get(snapshot.guid)
+        if known is None or known.bookmark:
+            guids[snapshot.guid] = snapshot
+
+    for i in range(len(destination) - 1, -1, -1):
+        match = guids.get(destination[i].guid)
+        if match is not None:
+            return IncrementalBase(match, destination[i], destination[i + 1:])
+    return None
@@ -0,0 +1,147 @@
+import abc
+import logging
+from typing import Callable, Dict, List, Set
+
+from .cache import Cache
+from .runner.zfs import ZFS
+
+
+class Protection(metaclass=abc.ABCMeta):
+    def __init__(self, really: bool):
+        self._really = really
+        self._log = logging.getLogger("Protection.%s" % self.name)
+
+    @property
+    def name(self): return self.__class__.__name__
+
+    @property
+    def log(self): return self._log
+
+    @property
+    def really(self): return self._really
+
+    # protect and release return the snapshots they failed on
+
+    @abc.abstractmethod
+    def protect(self, zfs: ZFS, dataset: str, snapshots: List[str],
+                owner: str, recurse=False) -> List[str]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def release(self, zfs: ZFS, dataset: str, snapshots: List[str],
+                owner: str, recurse=False) -> List[str]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def protected(self, zfs: ZFS, root: str,
+                  datasets: List[str]) -> Dict[str, Set[str]]:
+        raise NotImplementedError()
+
+
+class CacheProtection(Protection):
+    # keep counts in the sqlite cache, owners are not tracked
+    def __init__(self, cache: Callable[[], Cache], really: bool):
+        super().__init__(really)
+        self._cache = cache
+
+    def protect(self, zfs: ZFS, dataset: str, snapshots: List[str],
+                owner: str, recurse=False) -> List[str]:
+        if not self.really:
+            return []
+        with self._cache() as cache:
+            for snapshot in snapshots:
+                cache.snapshot_keep_increase(zfs.key(dataset), snapshot)
+        return []
+
+    def release(self, zfs: ZFS, dataset: str, snapshots: List[str],
+                owner: str, recurse=False) -> List[str]:
+        if not self.really:
+            return []
+        with self._cache() as cache:
+            for snapshot in snapshots:
+                cache.snapshot_keep_decrease(zfs.key(dataset), snapshot)
+        return []
+
+    def protected(self, zfs: ZFS, root: str,
+                  datasets: List[str]) -> Dict[str, Set[str]]:
+        with self._cache() as cache:
+            keeps = cache.snapshots()
+        # replicated copies only count on the root of the tree
+        inherited = set([s for s, c in keeps.get(zfs.key(root), {}).items()
+                         if c > 0])
+        return {ds: inherited | set([
+            s for s, c in keeps.get(zfs.key(ds), {}).items() if c > 0])
+            for ds in datasets}
+
+
+class HoldProtection(Protection):
+    TAG_PREFIX = "zfsbackup:"
+    BATCH = 256
+
+    @classmethod
+    def tag(cls, owner: str) -> str:
+        return cls.TAG_PREFIX + owner
+
+    def _batched(self, func, zfs: ZFS, dataset: str, snapshots: List[str],
+                 owner: str, recurse: bool, held: bool) -> List[str]:
+        tag = self.tag(owner)
+        names = ["%s@%s" % (dataset, s) for s in snapshots]
+        failed = []
+        for i in range(0, len(names), self.BATCH):
+            batch = names[i:i + self.BATCH]
+            if func(tag, batch, recurse=recurse):
+                continue
+            # a single existing (or missing) tag fails the whole batch
+            missed = list([name for name in batch
+                           if not func(tag, [name], recurse=recurse)])
+            if not missed:
+                continue
+            # the tag may have been there (or gone) before, which is
+            # what we wanted anyway
+            holds = zfs.holds(missed)
+            for name in missed:
+                if holds is not None and \
+                        (tag in holds.get(name, set())) == held:
+                    continue
+                self.log.warning("Could not %s hold %s on %s",
+                                 "place" if held else "release", tag, name)
+                failed.append(name.split("@", 1)[1])
+        return failed
+
+    def protect(self, zfs: ZFS, dataset: str, snapshots: List[str],
+                owner: str, recurse=False) -> List[str]:
+        return self._batched(zfs.hold, zfs, dataset, snapshots, owner,
+                             recurse, True)
+
+    def release(self, zfs: ZFS, dataset: str, snapshots: List[str],
+                owner: str, recurse=False) -> List[str]:
+        return self._batched(zfs.release, zfs, dataset, snapshots, owner,
+                             recurse, False)
+
+    def protected(self, zfs: ZFS, root: str,
+                  datasets: List[str]) -> Dict[str, Set[str]]:
+        # userrefs counts the holds of every snapshot, so a single
+        # listing of the tree is enough. zfs destroy refuses held
+        # snapshots anyway, so foreign holds protect them as well.
+        snapshots = zfs.datasets(dataset=root, snapshot=True,
+                                 recurse=len(datasets) > 1 or
+                                 datasets[0] != root,
+                                 options=["name", "userrefs"]) or []
+        result: Dict[str, Set[str]] = {ds: set() for ds in datasets}
+        for snapshot in snapshots:
+            if not isinstance(snapshot["userrefs"], int) or \
+                    snapshot["userrefs"] <= 0:
+                continue
+            (ds, name) = snapshot["name"].split("@", 1)
+            if ds in result:
+                result[ds].add(name)
+        return result
+
+
+def get_protection(name: str, cache: Callable[[], Cache],
+                   really: bool) -> Protection:
+    if name == "cache":
+        return CacheProtection(cache, really)
+    if name == "holds":
+        return HoldProtection(really)
+    raise KeyError("unknown protection '%s'" % name)
@@ -1,32 +1,66 @@
 import abc
 import logging
+import os
 import humanfriendly
-from subprocess import Popen, PIPE
+from subprocess import DEVNULL, PIPE
+from threading import Thread
 from typing import Union, List, Dict, Tuple, Any, Callable, IO
 
+from .process import Watchdog
+from ..timeouts import Timeouts
+
 
 class RunnerBase(metaclass=abc.ABCMeta):
-    def __init__(self, prog: str, sudo: str, really: bool, name: str = None):
+    def __init__(self, prog: str, sudo: str, really: bool, name: str = None,
+                 wrapper: Callable[[List[str]], List[str]] = None,
+                 timeouts: Timeouts = None):
         self._prog = prog
         self._sudo = sudo
         self._really = really
+        self._wrapper = wrapper
+        self._timeouts = timeouts
         if not name:
             name = self.__class__.__name__
         self._log = logging.getLogger("Runner." + name)
 
+    @property
+    def prog(self): return self._prog
+
+    @property
+    def sudo(self): return self._sudo
+
     @property
     def really(self): return self._really
 
     @property
     def log(self): return self._log
 
+    @property
+    def timeouts(self): return self._timeouts
+
+    def _subcommand(self, args: List[str]) -> str:
+        return args[0] if args else ""
+
+    def _watchdog(self, name: str, cleanup=False) -> Watchdog:
+        # name is the subcommand the timeout is configured for, cleanups
+        # run after a deadline passed and only get the grace period
+        what = "%s %s" % (os.path.basename(self._prog), name)
+        if not self._timeouts:
+            return Watchdog(what, log=self.log)
+        timeout = (self._timeouts.grace if cleanup
+                   else self._timeouts.command(name))
+        return Watchdog(what, timeout, self._timeouts.grace,
+                        self._timeouts.expired, self.log)
+
     def _cmdline(self, args: Union[str, List[str]], sudo=False):
         cmd = [self._sudo, self._prog] if sudo and self._sudo else [self._prog]
-        return cmd + args if isinstance(args, list) else cmd + [args]
+        cmd = cmd + args if isinstance(args, list) else cmd + [args]
+        return self._wrapper(cmd) if self._wrapper else cmd
 
     def _run(self, args: List[str], sudo=False,
              parser: Callable = None, parser_args: Dict[str, Any] = None,
-             stdin: IO = None, readonly=False) -> Tuple[int, Any]:
+             stdin: IO = None, readonly=False,
+             cleanup=False) -> Tuple[int, Any]:
         cmd = self._cmdline(args, sudo=sudo)
         if not self._really and not readonly:
             self.log.info("Would run '%s'", " ".join(cmd))
@@ -36,8 +70,9 @@ class RunnerBase(metaclass=abc.ABCMeta):
         else:
             self.log.debug("Running '%s'", " ".join(cmd))
 
-        p = Popen(cmd, stdout=PIPE, stderr=PIPE, stdin=PIPE)
-        (stdout, stderr) = p.communicate(stdin)
+        with self._watchdog(self._subcommand(args), cleanup) as watchdog:
+            p = watchdog.popen(cmd, stdout=PIPE, stderr=PIPE, stdin=PIPE)
+            (stdout, stderr) = p.communicate(stdin)
         stdout = stdout.decode("utf8").split("\n")
         stderr = stderr.decode("utf8").split("\n")
         if parser:
@@ -45,6 +80,72 @@ class RunnerBase(metaclass=abc.ABCMeta):
                                          **parser_args))
         return (p.returncode, (stdout, stderr))
 
+    def _pipeline(self, cmds: List[List[str]],
+                  name: str) -> List[Tuple[int, List[str]]]:
+        procs = []
+        with open(os.devnull, "wb") as devnull, \
+                self._watchdog(name) as watchdog:
+            stdin = None
+            for i, cmd in enumerate(cmds):
+                last = i == len(cmds) - 1
+                proc = watchdog.popen(cmd, stdin=stdin,
+                                      stdout=devnull if last else PIPE,
+                                      stderr=PIPE)
+                if stdin is not None:
+                    # only the next process in line may hold the pipe
+                    stdin.close()
+                stdin = proc.stdout
+                procs.append(proc)
+
+            # drain stderr of every process concurrently, so no process
+            # blocks on a full pipe while we wait for another one
+            stderr = [[] for _ in procs]
+
+            def drain(i: int):
+                stderr[i] = procs[i].stderr.read().decode("utf8").split("\n")
+                procs[i].stderr.close()
+
+            threads = [Thread(target=drain, args=(i,))
+                       for i in range(len(procs))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            result = [(proc.wait(), err) for proc, err in zip(procs, stderr)]
+        return result
+
+    def _stream(self, cmd: List[str], name: str,
+                handler: Callable[[IO], None],
+                output=True) -> Tuple[int, List[str]]:
+        # handler reads the output of cmd or writes its input from
+        # python code while stderr is drained in the background
+        with self._watchdog(name) as watchdog:
+            proc = watchdog.popen(cmd, stdin=None if output else PIPE,
+                                  stdout=PIPE if output else DEVNULL,
+                                  stderr=PIPE)
+            stderr = []
+
+            def drain():
+                stderr.extend(proc.stderr.read().decode("utf8").split("\n"))
+                proc.stderr.close()
+
+            thread = Thread(target=drain)
+            thread.start()
+            pipe = proc.stdout if output else proc.stdin
+            try:
+                handler(pipe)
+            except BrokenPipeError:
+                # the process went away, its exit code tells why
+                self.log.debug("%s closed its input", cmd[0])
+            finally:
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+                thread.join()
+            result = (proc.wait(), stderr)
+        return result
+
     def _parse_list(self, stdout: List[str], stderr: List[str],
                     returncode: int,
                     options: List[str]):
@@ -1,17 +1,24 @@
 from typing import List
 
 from .base import RunnerBase
+from ..timeouts import Timeouts
 
 
 class Command(RunnerBase):
     def __init__(self, name: str, cmd: str, args: List[str],
-                 sudo: str, use_sudo: bool, readonly: bool, really: bool):
+                 sudo: str, use_sudo: bool, readonly: bool, really: bool,
+                 timeouts: Timeouts = None):
+        self._name = name
         self._cmd = cmd
         self._arguments = args
         self._use_sudo = use_sudo
         self._readonly = readonly
         super().__init__(prog=self._cmd, sudo=sudo,
-                         really=really, name=name)
+                         really=really, name=name, timeouts=timeouts)
+
+    def _subcommand(self, args: List[str]) -> str:
+        # commands are timed out by their configured name
+        return self._name
 
     def run(self):
         (retcode, _) = self._run(args=self._arguments,
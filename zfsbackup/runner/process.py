@@ -0,0 +1,112 @@
+import logging
+import os
+import signal
+import threading
+import time
+from subprocess import Popen, TimeoutExpired
+from typing import Callable, List
+
+
+class CommandTimeout(Exception):
+    def __init__(self, what: str, timeout: float):
+        super().__init__("%s timed out after %.0fs" % (what, timeout))
+        self._what = what
+        self._timeout = timeout
+
+    @property
+    def what(self): return self._what
+
+    @property
+    def timeout(self): return self._timeout
+
+
+class Watchdog:
+    # every process is started in its own session, so a timeout can
+    # signal the whole process group including sudo and its children.
+    # Processes still running when the block is left by an exception
+    # (e.g. KeyboardInterrupt) are terminated as well.
+    def __init__(self, what: str = "command", timeout: float = None,
+                 grace=10.0, expired: Callable[[str], None] = None,
+                 log: logging.Logger = None):
+        self._what = what
+        self._timeout = timeout
+        self._grace = grace
+        self._expired = expired
+        self._log = log if log else logging.getLogger("Watchdog")
+        self._procs: List[Popen] = []
+        self._timer: threading.Timer = None
+        self._fired = False
+
+    @property
+    def timeout(self): return self._timeout
+
+    @property
+    def fired(self): return self._fired
+
+    def popen(self, cmd: List[str], **kwargs) -> Popen:
+        proc = Popen(cmd, start_new_session=True, **kwargs)
+        self._procs.append(proc)
+        return proc
+
+    @staticmethod
+    def _signal(procs: List[Popen], sig: int):
+        for proc in procs:
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                # some of the group run as another user, sudo
+                # passes the signal on to its command
+                try:
+                    proc.send_signal(sig)
+                except OSError:
+                    pass
+
+    def kill(self):
+        alive = list([p for p in self._procs if p.poll() is None])
+        if not alive:
+            return
+        self._signal(alive, signal.SIGTERM)
+        until = time.monotonic() + self._grace
+        for proc in alive:
+            try:
+                proc.wait(max(until - time.monotonic(), 0))
+            except TimeoutExpired:
+                pass
+        alive = list([p for p in alive if p.poll() is None])
+        if alive:
+            self._log.warning("%s: %d processes ignored SIGTERM, killing",
+                              self._what, len(alive))
+            self._signal(alive, signal.SIGKILL)
+
+    def _expire(self):
+        self._fired = True
+        self._log.error("%s timed out after %.0fs, terminating",
+                        self._what, self._timeout)
+        if self._expired:
+            self._expired(self._what)
+        self.kill()
+
+    def __enter__(self):
+        if self._timeout is None:
+            return self
+        if self._timeout <= 0:
+            self._fired = True
+            if self._expired:
+                self._expired(self._what)
+            raise CommandTimeout(self._what, 0)
+        self._timer = threading.Timer(self._timeout, self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        if self._timer:
+            self._timer.cancel()
+            # the timer may be killing right now
+            self._timer.join()
+        if typ is not None and not self._fired:
+            self.kill()
+        if self._fired:
+            raise CommandTimeout(self._what, self._timeout)
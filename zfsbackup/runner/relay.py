@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+from subprocess import Popen, PIPE
+from threading import Thread
+from typing import List, Tuple
+
+from .process import Watchdog
+
+
+class StreamDigest:
+    # hashes a stream while it is relayed, so it never has to be read
+    # twice. hashlib releases the GIL for larger buffers.
+    def __init__(self, algorithm="blake2b"):
+        self._algorithm = algorithm
+        self._hash = hashlib.new(algorithm)
+        self._bytes = 0
+
+    @property
+    def algorithm(self): return self._algorithm
+
+    @property
+    def bytes(self): return self._bytes
+
+    @property
+    def hexdigest(self): return self._hash.hexdigest()
+
+    def update(self, data: bytes):
+        self._hash.update(data)
+        self._bytes += len(data)
+
+
+class Relay:
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, source: List[str], sinks: List[List[List[str]]],
+                 name: str = "Relay", watchdog: Watchdog = None,
+                 digest: StreamDigest = None):
+        self._source = source
+        self._sinks = sinks
+        self._watchdog = watchdog if watchdog else Watchdog(name)
+        self._digest = digest
+        self._bytes = 0
+        self._log = logging.getLogger("Runner.%s" % name)
+
+    @property
+    def log(self): return self._log
+
+    @property
+    def bytes(self): return self._bytes
+
+    def _start(self, pipeline: List[List[str]], devnull) -> List[Popen]:
+        procs = []
+        stdin = PIPE
+        for i, cmd in enumerate(pipeline):
+            last = i == len(pipeline) - 1
+            proc = self._watchdog.popen(cmd, stdin=stdin,
+                                        stdout=devnull if last else PIPE,
+                                        stderr=PIPE)
+            if stdin is not PIPE:
+                stdin.close()
+            stdin = proc.stdout
+            procs.append(proc)
+        return procs
+
+    def _write(self, sinks: List[List[Popen]], alive: List[bool],
+               data: bytes):
+        for i, procs in enumerate(sinks):
+            if not alive[i]:
+                continue
+            try:
+                procs[0].stdin.write(data)
+            except OSError:
+                # receiver went away, the others keep going
+                self.log.debug("Sink %d closed its input", i)
+                alive[i] = False
+                self._close(procs[0].stdin)
+
+    @staticmethod
+    def _close(stream):
+        try:
+            stream.close()
+        except OSError:
+            pass
+
+    def run(self) -> Tuple[Tuple[int, List[str]],
+                           List[List[Tuple[int, List[str]]]]]:
+        with open(os.devnull, "wb") as devnull, self._watchdog:
+            sender = self._watchdog.popen(self._source, stdout=PIPE,
+                                          stderr=PIPE)
+            sinks = list([self._start(p, devnull) for p in self._sinks])
+            procs = [sender] + [p for procs in sinks for p in procs]
+
+            stderr = {}
+
+            def drain(proc: Popen):
+                stderr[proc.pid] = \
+                    proc.stderr.read().decode("utf8").split("\n")
+                proc.stderr.close()
+
+            threads = [Thread(target=drain, args=(p,)) for p in procs]
+            for thread in threads:
+                thread.start()
+
+            alive = [True] * len(sinks)
+            try:
+                while any(alive):
+                    data = sender.stdout.read1(self.CHUNK_SIZE)
+                    if not data:
+                        break
+                    self._bytes += len(data)
+                    if self._digest:
+                        self._digest.update(data)
+                    self._write(sinks, alive, data)
+            finally:
+                # closing our end makes the sender fail with EPIPE
+                # in case every receiver already went away
+                self._close(sender.stdout)
+                for procs in sinks:
+                    self._close(procs[0].stdin)
+
+            for thread in threads:
+                thread.join()
+
+            result = (sender.wait(), stderr[sender.pid])
+            receivers = list([[(p.wait(), stderr[p.pid]) for p in s]
+                              for s in sinks])
+        return (result, receivers)
@@ -0,0 +1,371 @@
+import random
+import time
+from typing import List, Dict, Union, Any, Tuple
+
+from .zfs import ZFS
+from ..models.snapshot import SnapshotTable
+
+
+class SimulatedZFS(ZFS):
+    # Only the listings of the real runner are ever executed. The state is
+    # loaded once per pool and every change is applied in memory, so later
+    # jobs of a dry run see what earlier jobs would have done.
+    PROPERTIES = ["name", "guid", "createtxg", "creation",
+                  "used", "referenced", "written", "userrefs"]
+
+    def __init__(self, loader: ZFS):
+        super().__init__(zfs=loader.prog, sudo=loader.sudo, really=False,
+                         host=loader.host)
+        self._loader = loader
+        self._pools: Dict[str, bool] = {}
+        self._datasets: Dict[str, Dict[str, Any]] = {}
+        self._snapshots: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._bookmarks: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._initial: Dict[str, Tuple[int, int]] = {}
+        self._txg = 0
+        self._clock: float = None
+
+    @property
+    def clock(self) -> float:
+        return self._clock if self._clock is not None else time.time()
+
+    @clock.setter
+    def clock(self, value: float): self._clock = value
+
+    @staticmethod
+    def _int(value) -> int:
+        return value if isinstance(value, int) else 0
+
+    def _load(self, dataset: str):
+        pool = dataset.split("/", 1)[0]
+        if pool in self._pools:
+            return
+        self._pools[pool] = True
+        self.log.debug("Loading state of pool %s", pool)
+
+        for ds in self._loader.datasets(dataset=pool, recurse=True,
+                                        options=self.PROPERTIES,
+                                        parsable=True) or []:
+            self._datasets[ds["name"]] = ds
+            self._snapshots[ds["name"]] = {}
+            self._bookmarks[ds["name"]] = {}
+        for snap in self._loader.datasets(dataset=pool, recurse=True,
+                                          snapshot=True, bookmark=True,
+                                          options=self.PROPERTIES,
+                                          parsable=True) or []:
+            bookmark = "#" in snap["name"]
+            (ds, name) = snap["name"].split("#" if bookmark else "@", 1)
+            snap["real"] = True
+            store = self._bookmarks if bookmark else self._snapshots
+            store.setdefault(ds, {})[name] = snap
+            self._txg = max(self._txg, self._int(snap["createtxg"]))
+
+        for ds in self._datasets:
+            if ds == pool or ds.startswith(pool + "/"):
+                self._initial[ds] = (len(self._snapshots[ds]),
+                                     self._space(ds))
+
+    def _exists(self, dataset: str) -> bool:
+        self._load(dataset)
+        return dataset in self._datasets
+
+    def _next_txg(self) -> int:
+        self._txg += 1
+        return self._txg
+
+    def _children(self, dataset: str, recurse: bool) -> List[str]:
+        return list([ds for ds in self._datasets if ds == dataset
+                     or (recurse and ds.startswith(dataset + "/"))])
+
+    def _ordered(self, dataset: str, bookmarks=False) -> List[Dict]:
+        store = self._bookmarks if bookmarks else self._snapshots
+        return sorted(store.get(dataset, {}).values(),
+                      key=lambda s: s["createtxg"])
+
+    def _churn(self, dataset: str) -> int:
+        # new snapshots are assumed to grow like the existing ones did
+        used = list([self._int(s["used"])
+                     for s in self._snapshots[dataset].values()])
+        if used:
+            return sum(used) // len(used)
+        return self._int(self._datasets[dataset].get("written"))
+
+    def _space(self, dataset: str) -> int:
+        return (self._int(self._datasets[dataset].get("referenced"))
+                + sum([self._int(s["used"])
+                       for s in self._snapshots[dataset].values()]))
+
+    def datasets(self, dataset: str = None, recurse=False,
+                 snapshot=False, options: List[str] = None,
+                 sort: str = None, sort_ascending=False,
+                 bookmark=False,
+                 parsable=False) -> List[Dict[str, Union[str, int]]]:
+        if not options:
+            options = ["name", "used", "available", "referenced", "mountpoint"]
+        if not self._exists(dataset):
+            return None
+
+        rows = []
+        for ds in self._children(dataset, recurse):
+            if not snapshot and not bookmark:
+                rows.append(self._datasets[ds])
+            if snapshot:
+                rows += list(self._snapshots[ds].values())
+            if bookmark:
+                rows += list(self._bookmarks[ds].values())
+
+        sort = sort if sort else "name"
+
+        def key(row):
+            value = row.get(sort)
+            return ((0, value, "") if isinstance(value, int)
+                    else (1, 0, str(value)))
+
+        rows.sort(key=key, reverse=not sort_ascending)
+        return list([{o: r.get(o, "-") for o in options} for r in rows])
+
+    def snapshot_tables(self, dataset: str,
+                        recurse=False) -> Dict[str, SnapshotTable]:
+        rows = self.datasets(dataset=dataset, recurse=recurse, snapshot=True,
+                             options=SnapshotTable.OPTIONS, sort="createtxg",
+                             sort_ascending=True, parsable=True)
+        return SnapshotTable.group(rows) if rows is not None else None
+
+    def snapshot(self, dataset: str, snapshot: str,
+                 recurse=False):
+        if not self._exists(dataset):
+            self.log.error("Simulated snapshot of missing dataset %s", dataset)
+            return False
+        if not self._snapshot(self._children(dataset, recurse), snapshot):
+            return False
+        self.log.info("Simulated snapshot %s@%s%s", dataset, snapshot,
+                      " (recursive)" if recurse else "")
+        return True
+
+    def snapshot_datasets(self, datasets: List[str], snapshot: str):
+        for ds in datasets:
+            if not self._exists(ds):
+                self.log.error("Simulated snapshot of missing dataset %s",
+                               ds)
+                return False
+        if not self._snapshot(datasets, snapshot):
+            return False
+        self.log.info("Simulated snapshot %s of %d datasets", snapshot,
+                      len(datasets))
+        return True
+
+    def _snapshot(self, targets: List[str], snapshot: str) -> bool:
+        for ds in targets:
+            if snapshot in self._snapshots[ds]:
+                self.log.error("Simulated snapshot %s@%s already exists",
+                               ds, snapshot)
+                return False
+
+        txg = self._next_txg()
+        for ds in targets:
+            churn = self._churn(ds)
+            self._snapshots[ds][snapshot] = {
+                "name": "%s@%s" % (ds, snapshot),
+                "guid": random.getrandbits(63),
+                "createtxg": txg,
+                "creation": int(self.clock),
+                "used": churn,
+                "referenced": self._datasets[ds].get("referenced"),
+                "written": churn,
+            }
+        return True
+
+    def destroy(self, dataset: str, snapshot: str = None,
+                recurse=False):
+        if not self._exists(dataset):
+            return False
+        if not snapshot:
+            for ds in self._children(dataset, recurse):
+                del self._datasets[ds]
+                del self._snapshots[ds]
+                del self._bookmarks[ds]
+            self.log.info("Simulated destroy of %s", dataset)
+            return True
+
+        found = False
+        for ds in self._children(dataset, recurse):
+            found = self._snapshots[ds].pop(snapshot, None) is not None \
+                or found
+        self.log.info("Simulated destroy of %s@%s", dataset, snapshot)
+        return found
+
+    def destroy_snapshots(self, dataset: str,
+                          snapshots: List[str]) -> List[str]:
+        return list([s for s in snapshots if not self.destroy(dataset, s)])
+
+    def send_size(self, source: str, snapshot: str,
+                  incremental: str = None, replicate=False) -> int:
+        return None
+
+    def destroy_estimate(self, dataset: str, snapshots: List[str],
+                         order: List[str] = None) -> int:
+        # unique space only, snapshots are not expected to share blocks
+        snaps = self._snapshots.get(dataset, {})
+        return sum([self._int(snaps[s]["used"])
+                    for s in set(snapshots) if s in snaps])
+
+    def rollback(self, dataset: str, snapshot: str):
+        if not self._exists(dataset) or \
+                snapshot not in self._snapshots[dataset]:
+            return False
+        self._rollback(dataset, self._snapshots[dataset][snapshot])
+        self.log.info("Simulated rollback of %s to %s", dataset, snapshot)
+        return True
+
+    def _rollback(self, dataset: str, base: Dict[str, Any]):
+        for snap in self._ordered(dataset):
+            if snap["createtxg"] > base["createtxg"]:
+                del self._snapshots[dataset][snap["name"].split("@", 1)[1]]
+
+    def _held(self, snapshots: List[str], recurse: bool):
+        for full in snapshots:
+            (dataset, name) = full.split("@", 1)
+            self._load(dataset)
+            for ds in self._children(dataset, recurse):
+                if name in self._snapshots[ds]:
+                    yield self._snapshots[ds][name]
+
+    def hold(self, tag: str, snapshots: List[str], recurse=False):
+        for snap in self._held(snapshots, recurse):
+            snap["userrefs"] = self._int(snap.get("userrefs")) + 1
+        return True
+
+    def release(self, tag: str, snapshots: List[str], recurse=False):
+        for snap in self._held(snapshots, recurse):
+            snap["userrefs"] = max(self._int(snap.get("userrefs")) - 1, 0)
+        return True
+
+    def bookmark(self, dataset: str, snapshot: str, bookmark: str = None):
+        if not self._exists(dataset) or \
+                snapshot not in self._snapshots[dataset]:
+            return False
+        bookmark = bookmark if bookmark else snapshot
+        self._bookmarks[dataset][bookmark] = dict(
+            self._snapshots[dataset][snapshot],
+            name="%s#%s" % (dataset, bookmark), used="-", written="-")
+        return True
+
+    def destroy_bookmarks(self, dataset: str, bookmarks: List[str]):
+        self._load(dataset)
+        failed = []
+        for bookmark in bookmarks:
+            if self._bookmarks.get(dataset, {}).pop(bookmark, None) is None:
+                failed.append(bookmark)
+        return failed
+
+    def diff_snapshots(self, dataset: str, lsnap: str, rsnap: str):
+        snaps = self._snapshots.get(dataset, {})
+        (left, right) = (snaps.get(lsnap), snaps.get(rsnap))
+        if not left or not right:
+            return False
+        if left.get("real") and right.get("real"):
+            return self._loader.diff_snapshots(dataset, lsnap, rsnap)
+        return self._int(right.get("written")) > 0
+
+    def _receive(self, target: "SimulatedZFS", source: str, dest: str,
+                 snaps: List[Dict[str, Any]], base: Dict[str, Any],
+                 rollback: bool) -> str:
+        if not target._exists(dest):
+            if base:
+                return "destination %s does not exist" % dest
+            parent = dest.rsplit("/", 1)[0]
+            if "/" in dest and parent not in target._datasets:
+                return "parent of %s does not exist" % dest
+            target._datasets[dest] = dict(self._datasets[source], name=dest)
+            target._snapshots[dest] = {}
+            target._bookmarks[dest] = {}
+        elif not base:
+            if target._snapshots[dest]:
+                return "destination %s has snapshots" % dest
+        else:
+            existing = target._ordered(dest)
+            matches = [s for s in existing if s["guid"] == base["guid"]]
+            if not matches:
+                return "incremental source of %s does not exist" % dest
+            if existing[-1]["guid"] != base["guid"]:
+                if not rollback:
+                    return "destination %s has been modified" % dest
+                target._rollback(dest, matches[0])
+
+        for snap in snaps:
+            name = snap["name"].split("@", 1)[1]
+            target._snapshots[dest][name] = dict(
+                snap, name="%s@%s" % (dest, name),
+                createtxg=target._next_txg(), real=False)
+        target._datasets[dest]["referenced"] = \
+            self._datasets[source].get("referenced")
+        return None
+
+    def copy(self, source: str, snapshot: str, target: str,
+             incremental: str = None, replicate=False, rollback=False,
+             overwrites: Dict[str, str] = None, ignores: List[str] = None,
+             transport=None, digest=None):
+        zfs: SimulatedZFS = transport.zfs if transport else self
+        if not self._exists(source):
+            self.log.error("Simulated copy of missing dataset %s", source)
+            return True
+
+        for ds in self._children(source, replicate):
+            dest = target + ds[len(source):]
+            snaps = self._ordered(ds)
+            names = [s["name"].split("@", 1)[1] for s in snaps]
+            if snapshot not in names:
+                if ds == source:
+                    self.log.error("Snapshot %s@%s does not exist",
+                                   ds, snapshot)
+                    return True
+                continue
+            last = names.index(snapshot)
+
+            base = None
+            if incremental and "#" in incremental:
+                base = self._bookmarks[ds].get(incremental.split("#", 1)[1])
+                snaps = [snaps[last]]
+            elif incremental:
+                if incremental not in names:
+                    self.log.error("Simulated copy of %s: base %s is gone",
+                                   ds, incremental)
+                    return True
+                first = names.index(incremental)
+                base = snaps[first]
+                snaps = snaps[first + 1:last + 1]
+            elif replicate:
+                snaps = snaps[:last + 1]
+            else:
+                snaps = [snaps[last]]
+            if incremental and base is None:
+                self.log.error("Simulated copy of %s: base %s is gone",
+                               ds, incremental)
+                return True
+
+            error = self._receive(zfs, ds, dest, snaps, base, rollback)
+            if error:
+                self.log.error("Simulated receive failed: %s", error)
+                return True
+            self.log.info("Simulated copy of %d snapshots from %s to %s",
+                          len(snaps), ds, dest)
+        return False
+
+    def fanout(self, source: str, snapshot: str,
+               targets: List[Dict[str, Any]],
+               incremental: str = None) -> List[bool]:
+        return list([self.copy(source, snapshot, t["target"],
+                               incremental=incremental,
+                               rollback=t.get("rollback", False),
+                               transport=t.get("transport"))
+                     for t in targets])
+
+    def report(self) -> List[Tuple[str, Tuple[int, int], Tuple[int, int]]]:
+        result = []
+        for ds in sorted(set(self._initial) | set(self._datasets)):
+            before = self._initial.get(ds, (0, 0))
+            after = ((len(self._snapshots[ds]), self._space(ds))
+                     if ds in self._datasets else (0, 0))
+            if before != after:
+                result.append((ds, before, after))
+        return result
@@ -1,13 +1,28 @@
-import os
-from subprocess import Popen, PIPE
-from typing import List, Dict, Union
+from typing import List, Dict, Set, Union, Callable, Tuple, Any, IO
 
 from .base import RunnerBase
+from .process import CommandTimeout
+from .relay import Relay, StreamDigest
+from ..models.snapshot import SnapshotTable
+from ..timeouts import Timeouts
 
 
 class ZFS(RunnerBase):
-    def __init__(self, zfs="/usr/bin/zfs", sudo="/usr/bin/sudo", really=False):
-        super().__init__(zfs, sudo, really)
+    def __init__(self, zfs="/usr/bin/zfs", sudo="/usr/bin/sudo", really=False,
+                 wrapper: Callable[[List[str]], List[str]] = None,
+                 timeouts: Timeouts = None, host: str = None):
+        super().__init__(zfs, sudo, really, wrapper=wrapper,
+                         timeouts=timeouts)
+        # set for runners of remote hosts
+        self._host = host
+
+    @property
+    def host(self): return self._host
+
+    def key(self, dataset: str) -> str:
+        # cache rows of remote datasets are kept apart from local
+        # datasets of the same name
+        return "%s:%s" % (self._host, dataset) if self._host else dataset
 
     @staticmethod
     def join(*args):
@@ -17,8 +32,9 @@ class ZFS(RunnerBase):
 
     def datasets(self, dataset: str = None, recurse=False,
                  snapshot=False, options: List[str] = None,
-                 sort: str = None,
-                 sort_ascending=False) -> List[Dict[str, Union[str, int]]]:
+                 sort: str = None, sort_ascending=False,
+                 bookmark=False,
+                 parsable=False) -> List[Dict[str, Union[str, int]]]:
         if not options:
             options = ["name", "used", "available", "referenced", "mountpoint"]
         args = [
@@ -26,16 +42,40 @@ class ZFS(RunnerBase):
             "-o", ",".join(options),
             "-s" if sort_ascending else "-S", sort if sort else "name"
         ]
-        if snapshot:
-            args += ["-t", "snapshot"]
+        types = [t for t, wanted in (("snapshot", snapshot),
+                                     ("bookmark", bookmark)) if wanted]
+        if types:
+            args += ["-t", ",".join(types)]
         if recurse:
             args += ["-r"]
+        if parsable:
+            args += ["-p"]
         args.append(dataset)
         ret = self._run(args, parser=self._parse_list,
                         parser_args={"options": options},
                         readonly=True)
         return ret[1] if ret[0] == 0 else None
 
+    def snapshot_tables(self, dataset: str,
+                        recurse=False) -> Dict[str, SnapshotTable]:
+        # snapshots sorted by createtxg, parsed straight into a table
+        # per dataset instead of a dict per snapshot
+        args = ["list", "-H", "-p", "-t", "snapshot",
+                "-o", ",".join(SnapshotTable.OPTIONS), "-s", "createtxg"]
+        if recurse:
+            args += ["-r"]
+        args.append(dataset)
+        ret = self._run(args, parser=self._parse_tables, parser_args={},
+                        readonly=True)
+        return ret[1] if ret[0] == 0 else None
+
+    @staticmethod
+    def _parse_tables(stdout: List[str], stderr: List[str],
+                      returncode: int) -> Dict[str, SnapshotTable]:
+        if returncode != 0:
+            return stderr
+        return SnapshotTable.parse(stdout)
+
     def has_dataset(self, dataset: str):
         return self.datasets(dataset=dataset, options=["name"]) is not None
 
@@ -47,6 +87,12 @@ class ZFS(RunnerBase):
         args.append("%s@%s" % (dataset, snapshot))
         return self._run(args, sudo=True)[0] == 0
 
+    def snapshot_datasets(self, datasets: List[str], snapshot: str):
+        # all snapshots of a single call are taken atomically
+        args = ["snapshot"] + list(["%s@%s" % (ds, snapshot)
+                                    for ds in datasets])
+        return self._run(args, sudo=True)[0] == 0
+
     def destroy(self, dataset: str, snapshot: str = None,
                 recurse=False):
         args = ["destroy"]
@@ -55,6 +101,98 @@ class ZFS(RunnerBase):
         args.append(dataset if not snapshot else "%s@%s" % (dataset, snapshot))
         return self._run(args, sudo=True)[0] == 0
 
+    def destroy_snapshots(self, dataset: str,
+                          snapshots: List[str]) -> List[str]:
+        # a single zfs destroy for all of them. It destroys all or
+        # nothing, so after a failure they are retried one by one to
+        # find those that can't go. Returns the ones left.
+        if not snapshots:
+            return []
+        args = ["destroy", "%s@%s" % (dataset, ",".join(snapshots))]
+        if self._run(args, sudo=True)[0] == 0:
+            return []
+        if len(snapshots) == 1:
+            return list(snapshots)
+        return list([s for s in snapshots if not self.destroy(dataset, s)])
+
+    @staticmethod
+    def _ranges(snapshots: List[str], order: List[str] = None) -> List[str]:
+        # consecutive snapshots (by the given order) are collapsed
+        # into first%last ranges to keep the command line short
+        if not order:
+            return list(snapshots)
+        wanted = set(snapshots)
+        ranges: List[List[str]] = []
+        previous = False
+        for name in order:
+            if name not in wanted:
+                previous = False
+                continue
+            if previous:
+                ranges[-1][1] = name
+            else:
+                ranges.append([name, name])
+            previous = True
+        return list([a if a == b else "%s%%%s" % (a, b) for (a, b) in ranges])
+
+    def destroy_estimate(self, dataset: str, snapshots: List[str],
+                         order: List[str] = None) -> int:
+        args = ["destroy", "-nvp", "%s@%s" % (
+            dataset, ",".join(self._ranges(snapshots, order)))]
+        (retcode, (stdout, stderr)) = self._run(args, sudo=True,
+                                                readonly=True)
+        if retcode != 0:
+            self.log.error("Could not estimate space of %s: %s",
+                           dataset, "\n".join(stderr))
+            return 0
+        for line in stdout:
+            fields = line.split("\t")
+            if fields[0] == "reclaim" and len(fields) > 1:
+                return int(fields[1])
+        return 0
+
+    def rollback(self, dataset: str, snapshot: str):
+        args = ["rollback", "-r", "%s@%s" % (dataset, snapshot)]
+        return self._run(args, sudo=True)[0] == 0
+
+    def hold(self, tag: str, snapshots: List[str], recurse=False):
+        args = ["hold"] + (["-r"] if recurse else []) + [tag] + snapshots
+        return self._run(args, sudo=True)[0] == 0
+
+    def release(self, tag: str, snapshots: List[str], recurse=False):
+        args = ["release"] + (["-r"] if recurse else []) + [tag] + snapshots
+        return self._run(args, sudo=True)[0] == 0
+
+    def holds(self, snapshots: List[str]) -> Dict[str, Set[str]]:
+        # the tags held on every snapshot, None if zfs holds failed
+        ret = self._run(["holds", "-H"] + snapshots, sudo=True,
+                        readonly=True)
+        if ret[0] != 0:
+            return None
+        result: Dict[str, Set[str]] = {s: set() for s in snapshots}
+        for line in ret[1][0]:
+            fields = line.split("\t")
+            if len(fields) >= 2 and fields[0] in result:
+                result[fields[0]].add(fields[1])
+        return result
+
+    def bookmark(self, dataset: str, snapshot: str, bookmark: str = None):
+        args = [
+            "bookmark",
+            "%s@%s" % (dataset, snapshot),
+            "%s#%s" % (dataset, bookmark if bookmark else snapshot),
+        ]
+        return self._run(args, sudo=True)[0] == 0
+
+    def destroy_bookmarks(self, dataset: str, bookmarks: List[str]):
+        # zfs destroy only accepts a single bookmark per call
+        failed = []
+        for bookmark in bookmarks:
+            args = ["destroy", "%s#%s" % (dataset, bookmark)]
+            if self._run(args, sudo=True)[0] != 0:
+                failed.append(bookmark)
+        return failed
+
     def diff_snapshots(self, dataset: str, lsnap: str, rsnap: str):
         args = [
             "diff",
@@ -64,57 +202,168 @@ class ZFS(RunnerBase):
         (retcode, (stdout, stderr)) = self._run(args, sudo=True, readonly=True)
         return retcode == 0 and len(stdout) >= 1 and stdout[0]
 
-    def copy(self, source: str, snapshot: str, target: str,
-             incremental: str = None, replicate=False, rollback=False,
-             overwrites: Dict[str, str] = None, ignores: List[str] = None):
-        send_args = ["send"]
+    def _send_args(self, source: str, snapshot: str,
+                   incremental: str = None, replicate=False) -> List[str]:
+        args = ["send"]
         if replicate:
-            send_args.append("-R")
+            args.append("-R")
         if incremental:
-            send_args += ["-I", incremental]
-        send_args.append("%s@%s" % (source, snapshot))
+            # bookmarks can only be used as base for -i streams
+            args += ["-i" if "#" in incremental else "-I", incremental]
+        args.append("%s@%s" % (source, snapshot))
+        return args
+
+    def send_size(self, source: str, snapshot: str,
+                  incremental: str = None, replicate=False) -> int:
+        args = self._send_args(source, snapshot, incremental, replicate)
+        args.insert(1, "-nvP")
+        (retcode, (stdout, _)) = self._run(args, sudo=True, readonly=True)
+        if retcode != 0:
+            return None
+        for line in stdout:
+            fields = line.split("\t")
+            if fields[0] == "size" and len(fields) > 1:
+                return int(fields[1])
+        return None
 
-        recv_args = ["recv"]
+    def _recv_args(self, target: str, rollback=False,
+                   overwrites: Dict[str, str] = None,
+                   ignores: List[str] = None) -> List[str]:
+        args = ["recv"]
         if rollback:
-            recv_args.append("-F")
+            args.append("-F")
         if overwrites:
             for k, v in overwrites.items():
-                recv_args.append("-o")
-                recv_args.append("%s=%s" % (k, v))
+                args.append("-o")
+                args.append("%s=%s" % (k, v))
         if ignores:
             for v in ignores:
-                recv_args.append("-x")
-                recv_args.append(v)
-        recv_args.append(target)
+                args.append("-x")
+                args.append(v)
+        args.append(target)
+        return args
+
+    def _report(self, ret: List[Tuple[int, List[str]]],
+                recv_cmds: List[List[str]], first="Sender") -> bool:
+        msg = "%s process failed with return code %d:\n%s"
+        failed = False
+        for i, (returncode, stderr) in enumerate(ret):
+            if returncode == 0:
+                continue
+            failed = True
+            if i == 0:
+                name = first
+            elif i == len(ret) - 1:
+                name = "Receiver"
+            else:
+                name = "Pipeline (%s)" % recv_cmds[i - 1][0]
+            self._log.error(msg % (name, returncode, stderr))
+        return failed
+
+    def copy(self, source: str, snapshot: str, target: str,
+             incremental: str = None, replicate=False, rollback=False,
+             overwrites: Dict[str, str] = None, ignores: List[str] = None,
+             transport=None, digest: StreamDigest = None):
+        # with a digest the stream is relayed through us to be hashed
+        send_args = self._send_args(source, snapshot, incremental, replicate)
+        recv_args = self._recv_args(target, rollback, overwrites, ignores)
 
         send_cmd = self._cmdline(send_args, sudo=True)
-        recv_cmd = self._cmdline(recv_args, sudo=True)
+        recv_cmds = (transport.receive(recv_args) if transport
+                     else [self._cmdline(recv_args, sudo=True)])
+        pipeline = " | ".join([" ".join(c) for c in [send_cmd] + recv_cmds])
 
         if not self._really:
-            self.log.info("Would run '%s | %s'",
-                          " ".join(send_cmd),
-                          " ".join(recv_cmd))
+            self.log.info("Would run '%s'", pipeline)
             return
         else:
-            self.log.debug("Running '%s | %s'",
-                           " ".join(send_cmd),
-                           " ".join(recv_cmd))
-
-        with open(os.devnull) as devnull:
-            sender = Popen(send_cmd, stdout=PIPE, stderr=PIPE)
-            receiver = Popen(recv_cmd, stdin=sender.stdout,
-                             stdout=devnull, stderr=PIPE)
-            sender.stdout.close()
-            sstderr = sender.stderr.read().decode("utf8").split("\n")
-            sender.stderr.close()
-            rstderr = receiver.stderr.read().decode("utf8").split("\n")
-            receiver.stderr.close()
-            ret = [sender.wait(), receiver.wait()]
+            self.log.debug("Running '%s'", pipeline)
 
-        msg = "%s process failed with return code %d:\n%s"
-        failed = ret[0] != 0 or ret[1] != 0
-        if ret[0] != 0:
-            self._log.error(msg % ("Sender", ret[0], sstderr))
-        if ret[1] != 0:
-            self._log.error(msg % ("Receiver", ret[1], rstderr))
-        return failed
+        try:
+            # the timeout of send covers the whole pipeline
+            if digest:
+                (sender, receivers) = Relay(
+                    send_cmd, [recv_cmds], watchdog=self._watchdog("send"),
+                    digest=digest).run()
+                result = [sender] + receivers[0]
+            else:
+                result = self._pipeline([send_cmd] + recv_cmds, "send")
+        except CommandTimeout:
+            (transport.zfs if transport else self).abort_receive(target)
+            raise
+        return self._report(result, recv_cmds)
+
+    def send_stream(self, source: str, snapshot: str,
+                    consumer: Callable[[IO], None], incremental: str = None,
+                    replicate=False) -> bool:
+        # consumer reads the send stream, returns whether sending failed
+        cmd = self._cmdline(self._send_args(source, snapshot, incremental,
+                                            replicate), sudo=True)
+        if not self._really:
+            self.log.info("Would run '%s'", " ".join(cmd))
+            return False
+        self.log.debug("Running '%s'", " ".join(cmd))
+        return self._report([self._stream(cmd, "send", consumer)], [])
+
+    def receive_stream(self, target: str, producer: Callable[[IO], None],
+                       rollback=False) -> bool:
+        # producer writes the stream to receive, returns whether
+        # receiving failed
+        cmd = self._cmdline(self._recv_args(target, rollback), sudo=True)
+        if not self._really:
+            self.log.info("Would run '%s'", " ".join(cmd))
+            return False
+        self.log.debug("Running '%s'", " ".join(cmd))
+        try:
+            result = self._stream(cmd, "recv", producer, output=False)
+        except CommandTimeout:
+            self.abort_receive(target)
+            raise
+        return self._report([result], [], first="Receiver")
+
+    def abort_receive(self, target: str):
+        # discards what an interrupted receive left behind,
+        # failing is fine if there is nothing to discard
+        ret = self._run(["recv", "-A", target], sudo=True, cleanup=True)
+        if ret[0] == 0:
+            self.log.info("Discarded partial receive state of %s", target)
+
+    def fanout(self, source: str, snapshot: str,
+               targets: List[Dict[str, Any]],
+               incremental: str = None) -> List[bool]:
+        send_cmd = self._cmdline(self._send_args(source, snapshot,
+                                                 incremental), sudo=True)
+        sinks = []
+        for target in targets:
+            recv_args = self._recv_args(target["target"],
+                                        target.get("rollback", False),
+                                        target.get("overwrites"),
+                                        target.get("ignores"))
+            transport = target.get("transport")
+            sinks.append(transport.receive(recv_args) if transport
+                         else [self._cmdline(recv_args, sudo=True)])
+
+        pipeline = "%s | tee %s" % (" ".join(send_cmd), " ".join(
+            ["'%s'" % " | ".join([" ".join(c) for c in s]) for s in sinks]))
+        if not self._really:
+            self.log.info("Would run %s", pipeline)
+            return [False] * len(targets)
+        else:
+            self.log.debug("Running %s", pipeline)
+
+        relay = Relay(send_cmd, sinks, watchdog=self._watchdog("send"))
+        try:
+            (sender, receivers) = relay.run()
+        except CommandTimeout:
+            for target in targets:
+                transport = target.get("transport")
+                (transport.zfs if transport else self).abort_receive(
+                    target["target"])
+            raise
+        self.log.debug("Relayed %d bytes to %d receivers",
+                       relay.bytes, len(sinks))
+
+        # a failed sender fails every receiver of this stream
+        send_failed = self._report([sender], [])
+        return list([self._report([(0, [])] + ret, sink) or send_failed
+                     for sink, ret in zip(sinks, receivers)])
@@ -0,0 +1,39 @@
+from typing import List, Callable
+
+from .base import RunnerBase
+from ..timeouts import Timeouts
+
+
+class ZPool(RunnerBase):
+    def __init__(self, zpool="/usr/bin/zpool", sudo="/usr/bin/sudo",
+                 really=False,
+                 wrapper: Callable[[List[str]], List[str]] = None,
+                 timeouts: Timeouts = None):
+        super().__init__(zpool, sudo, really, wrapper=wrapper,
+                         timeouts=timeouts)
+
+    def guid(self, pool: str) -> int:
+        ret = self._run(["get", "-Hp", "-o", "value", "guid", pool],
+                        readonly=True)
+        if ret[0] != 0:
+            return None
+        try:
+            return int(ret[1][0][0])
+        except (IndexError, ValueError):
+            return None
+
+    def history(self, pool: str) -> List[str]:
+        # internal events carry the txg they were written in
+        ret = self._run(["history", "-i", pool], sudo=True, readonly=True)
+        return ret[1][0] if ret[0] == 0 else None
+
+    def scanning(self, pool: str) -> str:
+        # returns "scrub" or "resilver" while one is running, None otherwise
+        ret = self._run(["status", pool], readonly=True)
+        if ret[0] != 0:
+            return None
+        for line in ret[1][0]:
+            (key, _, value) = line.strip().partition(":")
+            if key == "scan" and "in progress" in value:
+                return value.split()[0]
+        return None
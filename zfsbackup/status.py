@@ -0,0 +1,240 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+from typing import Any, Dict, List, Tuple
+
+from .models.snapshot import SnapshotInfo, SnapshotTable, \
+    find_incremental_base
+from .runner.zfs import ZFS
+
+
+# nagios plugin exit codes
+OK = 0
+WARNING = 1
+CRITICAL = 2
+UNKNOWN = 3
+STATES = ["OK", "WARNING", "CRITICAL", "UNKNOWN"]
+
+
+class Replica:
+    # a destination of a copy job. Destinations without zfs (archives)
+    # pass the snapshots they hold instead.
+    def __init__(self, source: str, szfs: ZFS, destination: str,
+                 dzfs: ZFS = None, recurse=False,
+                 snapshots: List[SnapshotInfo] = None):
+        self._source = source
+        self._szfs = szfs
+        self._destination = destination
+        self._dzfs = dzfs
+        self._recurse = recurse
+        self._snapshots = snapshots
+
+    @property
+    def source(self): return self._source
+
+    @property
+    def szfs(self): return self._szfs
+
+    @property
+    def destination(self): return self._destination
+
+    @property
+    def dzfs(self): return self._dzfs
+
+    @property
+    def recurse(self): return self._recurse
+
+    @property
+    def snapshots(self): return self._snapshots
+
+
+class Lag:
+    def __init__(self, job: str, source: str, destination: str,
+                 state: int, reason: str = None, common: str = None,
+                 created: int = None, lag: float = None, behind: int = None,
+                 latest: str = None):
+        self._job = job
+        self._source = source
+        self._destination = destination
+        self._state = state
+        self._reason = reason
+        self._common = common
+        self._created = created
+        self._lag = lag
+        self._behind = behind
+        self._latest = latest
+
+    @property
+    def job(self): return self._job
+
+    @property
+    def source(self): return self._source
+
+    @property
+    def destination(self): return self._destination
+
+    @property
+    def state(self): return self._state
+
+    @property
+    def reason(self): return self._reason
+
+    @property
+    def common(self): return self._common
+
+    @property
+    def created(self): return self._created
+
+    @property
+    def lag(self): return self._lag
+
+    @property
+    def behind(self): return self._behind
+
+    @property
+    def latest(self): return self._latest
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "job": self._job,
+            "source": self._source,
+            "destination": self._destination,
+            "state": STATES[self._state],
+            "reason": self._reason,
+            "common": self._common,
+            "created": self._created,
+            "lag": self._lag,
+            "behind": self._behind,
+            "latest": self._latest,
+        }
+
+
+def overall(lags: List[Lag]) -> int:
+    # like nagios, unknowns only count if nothing is worse
+    states = set([lag.state for lag in lags])
+    for state in (CRITICAL, WARNING, UNKNOWN):
+        if state in states:
+            return state
+    return OK
+
+
+class StatusReport:
+    # every pool involved is listed once, however many jobs copy from
+    # or into it. Pools on different hosts are listed concurrently.
+    def __init__(self, globalCfg, workers=8):
+        self._globalCfg = globalCfg
+        self._workers = max(workers, 1)
+        self._log = logging.getLogger("Status")
+
+    @property
+    def log(self): return self._log
+
+    def _list(self, zfs: ZFS, pool: str) -> Dict[str, SnapshotTable]:
+        inventory = self._globalCfg.inventory
+        if inventory and zfs is self._globalCfg.zfs:
+            rows = inventory.snapshots(pool, recurse=True,
+                                       options=SnapshotTable.OPTIONS)
+            return None if rows is None else SnapshotTable.group(rows)
+        return zfs.snapshot_tables(pool, recurse=True)
+
+    def _listings(self, replicas: List[Replica]
+                  ) -> Dict[Tuple[int, str], Dict[str, SnapshotTable]]:
+        wanted: Dict[Tuple[int, str], Tuple[ZFS, str]] = {}
+        for replica in replicas:
+            sides = [(replica.szfs, replica.source)]
+            if replica.dzfs is not None:
+                sides.append((replica.dzfs, replica.destination))
+            for (zfs, dataset) in sides:
+                pool = dataset.split("/", 1)[0]
+                wanted[(id(zfs), pool)] = (zfs, pool)
+
+        started = time.monotonic()
+        keys = list(wanted)
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            tables = list(pool.map(lambda k: self._list(*wanted[k]), keys))
+        self.log.debug("Listed %d pools in %.3fs", len(keys),
+                       time.monotonic() - started)
+        return dict(zip(keys, tables))
+
+    @staticmethod
+    def _tree(tables: Dict[str, SnapshotTable], dataset: str,
+              recurse: bool) -> Dict[str, SnapshotTable]:
+        tree = {dataset: tables.get(dataset, SnapshotTable(dataset))}
+        if recurse:
+            tree.update({d: t for (d, t) in tables.items()
+                         if d.startswith(dataset + "/")})
+        return tree
+
+    def _measure(self, job, source: SnapshotTable,
+                 destination: str, dsnaps: List[SnapshotInfo],
+                 now: float) -> Lag:
+        name = source.dataset
+        if not len(source):
+            return Lag(job.owner, name, destination, UNKNOWN,
+                       reason="source has no snapshots")
+        latest = source.names[-1]
+        base = find_incremental_base(source, dsnaps) if dsnaps else None
+        if not base:
+            return Lag(job.owner, name, destination, CRITICAL,
+                       reason="no common snapshot", behind=len(source),
+                       latest=latest)
+
+        i = source.position(base.source.name)
+        created = source.column("creation")[i]
+        lag = max(now - created, 0) if created >= 0 else None
+        state = OK
+        reason = None
+        if lag is not None:
+            for (limit, breach) in ((job.rpo_critical, CRITICAL),
+                                    (job.rpo_warning, WARNING)):
+                if limit is not None and lag > limit:
+                    state = breach
+                    reason = "rpo of %ds exceeded" % limit
+                    break
+        return Lag(job.owner, name, destination, state, reason=reason,
+                   common=base.source.name,
+                   created=created if created >= 0 else None, lag=lag,
+                   behind=len(source) - i - 1, latest=latest)
+
+    @staticmethod
+    def _worse(a: Lag, b: Lag) -> bool:
+        # by state first, then by how far behind
+        order = [OK, UNKNOWN, WARNING, CRITICAL]
+        if a.state != b.state:
+            return order.index(a.state) > order.index(b.state)
+        return (a.lag or 0) > (b.lag or 0)
+
+    def collect(self, jobs: List, now: float = None) -> List[Lag]:
+        # one lag per replica, recursive ones report their worst child
+        now = now if now else time.time()
+        replicas = list([(job, r) for job in jobs for r in job.replicas()])
+        listings = self._listings(list([r for (_, r) in replicas]))
+
+        lags = []
+        for (job, replica) in replicas:
+            stables = listings[(id(replica.szfs),
+                                replica.source.split("/", 1)[0])]
+            dtables = {}
+            if replica.dzfs is not None:
+                dtables = listings[(id(replica.dzfs),
+                                    replica.destination.split("/", 1)[0])]
+            if stables is None or dtables is None:
+                lags.append(Lag(job.owner, replica.source,
+                                replica.destination, UNKNOWN,
+                                reason="cannot list %s" % (
+                                    "source" if stables is None
+                                    else "destination")))
+                continue
+
+            worst = None
+            for (child, table) in self._tree(stables, replica.source,
+                                             replica.recurse).items():
+                target = replica.destination + child[len(replica.source):]
+                dsnaps = replica.snapshots
+                if dsnaps is None:
+                    dsnaps = dtables.get(target)
+                lag = self._measure(job, table, target, dsnaps, now)
+                if worst is None or self._worse(lag, worst):
+                    worst = lag
+            lags.append(worst)
+        return lags
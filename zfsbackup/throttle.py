@@ -0,0 +1,123 @@
+import logging
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Tuple
+
+import humanfriendly
+
+from .runner.zpool import ZPool
+
+
+class Throttle:
+    RESOURCES = ["io", "cpu", "memory"]
+    WINDOWS = ["avg10", "avg60", "avg300"]
+
+    def __init__(self, cfg: ET.Element, zpool: ZPool, really: bool):
+        # thresholds are percentages of time stalled on a resource,
+        # taken from the "some" line of /proc/pressure/<resource>
+        self._limits: Dict[str, float] = {}
+        for resource in self.RESOURCES:
+            if resource in cfg.attrib:
+                self._limits[resource] = float(cfg.attrib[resource])
+        self._window = cfg.attrib.get("window", "avg10")
+        if self._window not in self.WINDOWS:
+            raise ValueError("unknown window %s" % self._window)
+        self._scrub = cfg.attrib.get("scrub", "yes").lower() in [
+            "yes", "true", "1"]
+        self._interval = humanfriendly.parse_timespan(
+            cfg.attrib.get("interval", "30s"))
+        self._max_wait = humanfriendly.parse_timespan(
+            cfg.attrib.get("max-wait", "2h"))
+        self._batch = max(int(cfg.attrib.get("batch", 16)), 1)
+        self._psi = cfg.attrib.get("psi", "/proc/pressure")
+        self._zpool = zpool
+        self._really = really
+        self._scans: Dict[str, Tuple[float, str]] = {}
+        self._lock = threading.Lock()
+        self._log = logging.getLogger("Throttle")
+
+    @property
+    def log(self): return self._log
+
+    @property
+    def limits(self): return self._limits
+
+    @property
+    def window(self): return self._window
+
+    @property
+    def interval(self): return self._interval
+
+    @property
+    def max_wait(self): return self._max_wait
+
+    @property
+    def batch(self): return self._batch
+
+    def pressure(self, resource: str) -> float:
+        # None if the kernel has no PSI support
+        try:
+            with open(os.path.join(self._psi, resource)) as f:
+                for line in f:
+                    fields = line.split()
+                    if not fields or fields[0] != "some":
+                        continue
+                    values = dict([v.split("=", 1) for v in fields[1:]])
+                    return float(values[self._window])
+        except (OSError, KeyError, ValueError):
+            pass
+        return None
+
+    def _scanning(self, pool: str) -> str:
+        # zpool status is asked at most once per interval and pool
+        now = time.monotonic()
+        with self._lock:
+            cached = self._scans.get(pool)
+        if cached and now - cached[0] < self._interval:
+            return cached[1]
+        scan = self._zpool.scanning(pool)
+        with self._lock:
+            self._scans[pool] = (now, scan)
+        return scan
+
+    def busy(self, pools: List[str] = None) -> str:
+        # returns why we should back off, None if we don't have to
+        for (resource, limit) in self._limits.items():
+            pressure = self.pressure(resource)
+            if pressure is not None and pressure > limit:
+                return "%s pressure %.2f%% above %.2f%%" % (
+                    resource, pressure, limit)
+        if self._scrub:
+            for pool in sorted(set(pools or [])):
+                scan = self._scanning(pool)
+                if scan:
+                    return "%s running on %s" % (scan, pool)
+        return None
+
+    def wait(self, what: str, pools: List[str] = None) -> bool:
+        # blocks while the system is busy, gives up after max-wait so
+        # backups can't be starved completely. Returns whether the
+        # pressure is gone.
+        reason = self.busy(pools)
+        if not reason:
+            return True
+        if not self._really:
+            self.log.info("Would pause %s: %s", what, reason)
+            return True
+
+        self.log.info("Pausing %s: %s", what, reason)
+        started = time.monotonic()
+        while reason:
+            waited = time.monotonic() - started
+            if waited >= self._max_wait:
+                self.log.warning("Going on with %s after %.0fs,"
+                                 + " still throttled: %s",
+                                 what, waited, reason)
+                return False
+            time.sleep(min(self._interval, self._max_wait - waited))
+            reason = self.busy(pools)
+        self.log.info("Resuming %s after %.0fs", what,
+                      time.monotonic() - started)
+        return True
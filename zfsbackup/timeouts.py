@@ -0,0 +1,93 @@
+from contextlib import contextmanager
+import threading
+import time
+import xml.etree.ElementTree as ET
+from typing import Dict, List
+
+import humanfriendly
+
+
+class Timeouts:
+    def __init__(self, cfg: ET.Element = None):
+        # all timeouts are in seconds, None waits forever
+        self._grace = 30.0
+        self._run: float = None
+        self._events: float = None
+        self._commands: Dict[str, float] = {}
+        self._jobs: Dict[str, float] = {}
+        if cfg is not None:
+            self._grace = self._timespan(cfg.attrib.get("grace"),
+                                         self._grace)
+            self._run = self._timespan(cfg.attrib.get("run"))
+            self._events = self._timespan(cfg.attrib.get("events"))
+            for (tag, timeouts) in (("commands", self._commands),
+                                    ("jobs", self._jobs)):
+                element = cfg.find(tag)
+                if element is None:
+                    continue
+                for (name, value) in element.attrib.items():
+                    timeouts[name] = self._timespan(value)
+        self._deadlines: List[float] = []
+        self._expired: List[str] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _timespan(value: str, default: float = None) -> float:
+        if value is None:
+            return default
+        return humanfriendly.parse_timespan(value)
+
+    @property
+    def grace(self): return self._grace
+
+    @property
+    def run(self): return self._run
+
+    @property
+    def events(self): return self._limit(self._events)
+
+    def command(self, name: str) -> float:
+        # subcommands without their own timeout use "default"
+        return self._limit(self._commands.get(
+            name, self._commands.get("default")))
+
+    def job(self, typ: str) -> float:
+        return self._jobs.get(typ)
+
+    def remaining(self) -> float:
+        # time left until the nearest deadline, None without any
+        with self._lock:
+            if not self._deadlines:
+                return None
+            return min(self._deadlines) - time.monotonic()
+
+    def _limit(self, timeout: float) -> float:
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+    @contextmanager
+    def deadline(self, timeout: float):
+        # every command started within the block has to finish
+        # before the deadline
+        if timeout is None:
+            yield
+            return
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self._deadlines.append(deadline)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._deadlines.remove(deadline)
+
+    def expired(self, what: str):
+        with self._lock:
+            self._expired.append(what)
+
+    @property
+    def expirations(self) -> int:
+        with self._lock:
+            return len(self._expired)
@@ -0,0 +1,176 @@
+import abc
+import logging
+import os
+import re
+import shlex
+from subprocess import Popen, DEVNULL
+from typing import List, Dict
+
+from .helpers import missing_attribute
+from .runner.zfs import ZFS
+
+
+class Transport(metaclass=abc.ABCMeta):
+    def __init__(self, zfs: ZFS):
+        self._zfs = zfs
+        self._log = logging.getLogger("Transport.%s" % self.name)
+
+    @property
+    def name(self): return self.__class__.__name__
+
+    @property
+    def log(self): return self._log
+
+    @property
+    def zfs(self) -> ZFS: return self._zfs
+
+    @abc.abstractmethod
+    def receive(self, args: List[str]) -> List[List[str]]:
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class Local(Transport):
+    def receive(self, args: List[str]) -> List[List[str]]:
+        return [self.zfs._cmdline(args, sudo=True)]
+
+
+class SSH(Transport):
+    COMPRESSORS = {
+        "gzip": (["gzip", "-c"], ["gzip", "-dc"]),
+        "lz4": (["lz4", "-c"], ["lz4", "-dc"]),
+        "xz": (["xz", "-c", "-T0"], ["xz", "-dc"]),
+        "zstd": (["zstd", "-c", "-q"], ["zstd", "-dc", "-q"]),
+    }
+
+    def __init__(self, zfs: ZFS, ssh: str, host: str, controldir: str,
+                 user: str = None, port: str = None, compress: str = None,
+                 persist: int = 60, remote_zfs: str = None,
+                 remote_sudo: str = None):
+        super().__init__(zfs)
+        if compress and compress not in self.COMPRESSORS:
+            raise KeyError("unknown compression '%s'" % compress)
+
+        self._ssh = ssh
+        self._host = host
+        self._compress = compress
+        self._used = False
+        self._control = os.path.join(controldir, "ssh-%C")
+        self._options = [
+            "-o", "BatchMode=yes",
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=%s" % self._control,
+            "-o", "ControlPersist=%d" % persist,
+        ]
+        if user:
+            self._options += ["-l", user]
+        if port:
+            self._options += ["-p", str(port)]
+
+        # remote commands are built unwrapped first, so the receive side
+        # can be joined with the decompressor into a single remote shell
+        remote_zfs = remote_zfs or zfs.prog
+        remote_sudo = remote_sudo if remote_sudo is not None else zfs.sudo
+        self._remote = ZFS(zfs=remote_zfs, sudo=remote_sudo,
+                           really=zfs.really, timeouts=zfs.timeouts,
+                           host=host)
+        self._zfs = ZFS(zfs=remote_zfs, sudo=remote_sudo, really=zfs.really,
+                        wrapper=self.remote, timeouts=zfs.timeouts,
+                        host=host)
+
+    @property
+    def host(self): return self._host
+
+    def _command(self, command: str) -> List[str]:
+        self._used = True
+        return [self._ssh] + self._options + [self._host, command]
+
+    def remote(self, cmd: List[str]) -> List[str]:
+        return self._command(shlex.join(cmd))
+
+    def receive(self, args: List[str]) -> List[List[str]]:
+        recv = self._remote._cmdline(args, sudo=True)
+        if not self._compress:
+            return [self.remote(recv)]
+        (compress, decompress) = self.COMPRESSORS[self._compress]
+        return [compress, self._command("%s | %s" % (shlex.join(decompress),
+                                                     shlex.join(recv)))]
+
+    def close(self):
+        if not self._used:
+            return
+        self.log.debug("Closing master connection to %s", self._host)
+        # user and port are part of the control path (%C), the exit has
+        # to name them just like the connection did
+        Popen([self._ssh] + self._options + ["-O", "exit", self._host],
+              stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL).wait()
+        self._used = False
+
+
+class Command(Transport):
+    def __init__(self, zfs: ZFS, command: str):
+        super().__init__(zfs)
+        if not command:
+            raise KeyError("missing receive command")
+        self._command = command
+
+    PLACEHOLDER = re.compile(r"\{(recv|args|target)\}")
+
+    def receive(self, args: List[str]) -> List[List[str]]:
+        # only our placeholders are replaced, braces of the shell
+        # (${VAR}, find -exec {}) are left alone
+        values = {
+            "recv": shlex.join(self.zfs._cmdline(args, sudo=True)),
+            "args": shlex.join(args[1:]),
+            "target": shlex.quote(args[-1]),
+        }
+        return [["/bin/sh", "-c", self.PLACEHOLDER.sub(
+            lambda m: values[m.group(1)], self._command)]]
+
+
+class Simulated(Transport):
+    def __init__(self, zfs: ZFS, transport: Transport):
+        super().__init__(zfs)
+        self._transport = transport
+
+    def receive(self, args: List[str]) -> List[List[str]]:
+        return self._transport.receive(args)
+
+    def close(self):
+        self._transport.close()
+
+
+def check_transport(spec: Dict[str, str]):
+    # raises KeyError for specs get_transport can't build, so config
+    # errors show up while loading instead of halfway through a run
+    typ = spec.get("type", "local")
+    if typ == "ssh":
+        if not spec.get("host"):
+            raise KeyError(missing_attribute % "host")
+        if spec.get("compress") and \
+                spec["compress"] not in SSH.COMPRESSORS:
+            raise KeyError("unknown compression '%s'" % spec["compress"])
+        if not spec.get("persist", "60").isdigit():
+            raise KeyError("invalid persist '%s'" % spec["persist"])
+    elif typ == "command":
+        if not spec.get("command"):
+            raise KeyError("missing receive command")
+    elif typ != "local":
+        raise KeyError("unknown transport '%s'" % typ)
+
+
+def get_transport(spec: Dict[str, str], zfs: ZFS,
+                  ssh: str, controldir: str) -> Transport:
+    check_transport(spec)
+    typ = spec.get("type", "local")
+    if typ == "ssh":
+        return SSH(zfs, ssh, spec["host"], controldir,
+                   user=spec.get("user"), port=spec.get("port"),
+                   compress=spec.get("compress"),
+                   persist=int(spec.get("persist", 60)),
+                   remote_zfs=spec.get("zfs"), remote_sudo=spec.get("sudo"))
+    if typ == "command":
+        return Command(zfs, spec["command"])
+    return Local(zfs)